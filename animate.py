@@ -0,0 +1,246 @@
+"""
+Render a zoom from one view to another as a sequence of frames, without any user interface.  Like autozoom, but at a
+fixed frame rate and with every frame finished.
+
+Frames are assembled from the tile pyramid, as the interactive program draws them: every frame shows the tiles of the
+pyramid level closest to its zoom, so the frames of one level (a factor of two in zoom) share their tiles and only the
+tiles that come into view are computed.  The tiles are colored at their own size and the result scaled to the frame
+with bilinear filtering, by up to 1.41x either way, so frames are somewhat softer (when enlarged) or less detailed
+(when reduced) than a view rendered at the frame's exact scale with render.py.  The cost of a frame is mostly its new
+detail, plus colorizing, scaling and writing it out.
+
+Example: python3 animate.py -x -0.745 -y 0.11 -z 0 --to-zoomlevel 120 --duration 60 -o - | ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -r 30 -i - zoom.mp4
+"""
+
+from time import time
+from queue import SimpleQueue
+from multiprocessing import cpu_count
+from decimal import Decimal
+import argparse, threading, os, sys
+import logging
+
+import cffi_compute
+import tilegrid
+from tilegrid import minimum_pixel_size, zoom_level_to_screen_w, tile_rc_range, tile_screen_position, needs_perturbation, pyramid_level, pyramid_simcoord_per_tile, recursion_for_level
+from palettes import build_palettes
+from perturbation import ReferenceOrbit
+from lrucache import TileCache
+from diskcache import TilePack
+from render import compute_tile_depth, write_png, write_ppm
+
+
+
+logger = logging.getLogger('animate')
+
+memory_cache_bytes = 512 * 2**20   # memory budget for tiles, the zoom never goes back so only the current and next pyramid levels matter
+reference_digits = 10              # a reference orbit has this many digits to spare (of the 20 it gets) before a deeper one is computed
+
+
+
+class Tile():
+    """
+    The depth data of one tile, which is all a TilePack needs of a WorkUnit.
+    """
+
+    def __init__(self, cache_key, depth_data=None):
+        self.cache_key = cache_key
+        self.depth_data = depth_data
+
+    def nbytes(self):
+        return cffi_compute.ffi.sizeof(self.depth_data) + 512       # as WorkUnit.nbytes() reckons it
+
+
+
+def zoom_path(start_x, start_y, start_zoomlevel, end_x, end_y, end_zoomlevel, frames):
+    """
+    Give the center and zoom level of each frame of a zoom from the start view to the end view.
+
+    The zoom level changes at a steady rate, so the zoom is steady too.  The center moves along with it so that one point
+    stays at the same place on the screen all the way (the point the zoom closes in on), which looks the way zooming in
+    with the mouse does.  With no change of zoom the center simply moves at a steady rate.
+    """
+
+    ratio = zoom_level_to_screen_w(end_zoomlevel) / zoom_level_to_screen_w(start_zoomlevel)
+    for n in range(frames):
+        t = n / max(1, frames-1)
+        zoomlevel = start_zoomlevel + (end_zoomlevel - start_zoomlevel) * t
+        if abs(ratio - 1) < 1e-9:
+            f = Decimal(1-t)
+        else:
+            # the fixed point p satisfies end = p + (start-p)*ratio, and the frame with width w has center p + (start-p)*(w/start_w)
+            f = (Decimal(zoom_level_to_screen_w(zoomlevel) / zoom_level_to_screen_w(start_zoomlevel)) - Decimal(ratio)) / (1 - Decimal(ratio))
+        yield end_x + (start_x - end_x) * f, end_y + (start_y - end_y) * f, zoomlevel
+
+
+
+def animate(kernels, palette, coords, width, height, threads, write_frame, max_recursion=None, tile_mode='edge', subdivide_min_size=4, smooth=False, tile_pack=None):
+    """
+    Render every view (center x, center y, zoom level) of coords and pass each frame to write_frame() as RGB bytes.
+    Tiles are kept between frames in a TileCache, and loaded from (and stored to) tile_pack if one is given.
+    max_recursion is fixed if given, otherwise each pyramid level gets its default (see recursion_for_level()).
+    Returns the number of frames, and the number of tiles computed, loaded from disk and drawn.
+    """
+
+    tile_size = tilegrid.tile_size
+    tiles = TileCache(memory_cache_bytes, lambda tile: tile.nbytes())
+    palettes = {}
+    todo = SimpleQueue()
+    done = SimpleQueue()
+    def worker_thread():
+        while True:
+            job = todo.get()
+            if job is None:
+                return
+            computelib, cache_key, reference = job
+            level, row, col, simcoord_per_tile, size, cap = cache_key
+            depth_data = cffi_compute.new_depth(size, smooth, cffi_compute.wide_depth(cap))
+            compute_tile_depth(computelib, depth_data, row, col, simcoord_per_tile, reference, cap, tile_mode, subdivide_min_size, smooth)
+            done.put(Tile(cache_key, depth_data))
+    workers = [threading.Thread(target=worker_thread, daemon=True) for _ in range(threads)]
+    for t in workers:
+        t.start()
+
+    image = bytearray(width * height * 3)
+    canvas = bytearray()             # the visible tiles at their own size, scaled to make the frame
+    shifts = (0,8,16) if sys.byteorder == 'little' else (16,8,0)     # RGB byte order, for 3 byte pixels in native order
+    reference = None
+    reference_pixel_size = None
+    frames = computed = loaded = drawn = 0
+    for coord_x, coord_y, zoomlevel in coords:
+        coordrange_x = zoom_level_to_screen_w(zoomlevel)
+        coordrange_y = coordrange_x * height / width
+        simcoord_per_pixel = coordrange_x / width
+        coordmin_x = coord_x - Decimal(coordrange_x)/2
+        coordmin_y = coord_y - Decimal(coordrange_y)/2
+        level = pyramid_level(zoomlevel, width)
+        simcoord_per_tile = pyramid_simcoord_per_tile(level)
+        _, min_row, max_row, min_col, max_col = tile_rc_range(
+            simcoord_per_tile, coordmin_x, coord_x + Decimal(coordrange_x)/2, coordmin_y, coord_y + Decimal(coordrange_y)/2)
+        cap = max_recursion or recursion_for_level(level)
+        computelib = kernels(cap)
+        if cap not in palettes:
+            palettes[cap] = build_palettes(cap)[palette]
+
+        # a reference orbit serves until the view has moved a screen width away from it, or has gone too deep for its digits
+        if needs_perturbation(simcoord_per_tile):
+            if reference is None or reference.max_recursion < cap or simcoord_per_pixel < reference_pixel_size * 10**-reference_digits or \
+                    abs(reference.coord_x - coord_x) + abs(reference.coord_y - coord_y) > Decimal(coordrange_x):
+                reference = ReferenceOrbit(coord_x, coord_y, cap, simcoord_per_pixel)
+                reference_pixel_size = simcoord_per_pixel
+
+        # only the tiles that were not in view before are computed, the rest come from memory (or disk)
+        cache_keys = [(level, row, col, simcoord_per_tile, tile_size, cap) for row in range(min_row, max_row+1) for col in range(min_col, max_col+1)]
+        missing = 0
+        for cache_key in cache_keys:
+            if tiles.get(cache_key) is not None:
+                continue
+            tile = Tile(cache_key)
+            if tile_pack is not None and tile_pack.load(tile):
+                tiles[cache_key] = tile
+                loaded += 1
+                continue
+            todo.put((computelib, cache_key, reference))
+            missing += 1
+        for _ in range(missing):
+            tile = done.get()
+            tiles[tile.cache_key] = tile
+            if tile_pack is not None:
+                tile_pack.store(tile)
+        computed += missing
+
+        # the tiles are colored side by side at their own size, and that is scaled to the frame with bilinear filtering
+        canvas_width, canvas_height = (max_col - min_col + 1) * tile_size, (max_row - min_row + 1) * tile_size
+        if len(canvas) != canvas_width * canvas_height * 3:
+            canvas = bytearray(canvas_width * canvas_height * 3)
+        positions = [((cache_key[2] - min_col) * tile_size, (cache_key[1] - min_row) * tile_size) for cache_key in cache_keys]
+        cffi_compute.colorize_tiles(computelib, [tiles[cache_key].depth_data for cache_key in cache_keys], positions, tile_size, cap, palettes[cap], canvas, canvas_width, canvas_height, canvas_width*3, 3, shifts)
+        anchor_x, anchor_y = tile_screen_position(min_row, min_col, simcoord_per_tile, coordmin_x, coordmin_y, simcoord_per_pixel)
+        scale = simcoord_per_tile / simcoord_per_pixel / tile_size        # frame pixels per tile pixel
+        computelib.scale_rgb(cffi_compute.ffi.from_buffer(canvas), canvas_width, canvas_height, -anchor_x / scale, -anchor_y / scale, 1 / scale,
+                             cffi_compute.ffi.from_buffer(image, require_writable=True), width, height)
+        tiles.trim(keep=len(cache_keys))
+        write_frame(bytes(image))
+        frames += 1
+        drawn += len(cache_keys)
+        logger.debug("Frame %d at zoom level %.02f: %d tiles, %d computed." % (frames, zoomlevel, len(cache_keys), missing))
+
+    for _ in workers:
+        todo.put(None)
+    return frames, computed, loaded, drawn
+
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Render a zoom into the mandelbrot set as numbered image files, or raw frames to a pipe, without a display.")
+    parser.add_argument('-x', type=Decimal, default=Decimal(0.47 - 2.00)/2, help="center X coordinate (fractalspace) of the first frame")
+    parser.add_argument('-y', type=Decimal, default=Decimal(0), help="center Y coordinate (fractalspace) of the first frame")
+    parser.add_argument('-z', '--zoomlevel', type=float, default=0, help="zoom level of the first frame, as shown in the interactive program")
+    parser.add_argument('--to-x', type=Decimal, help="center X coordinate of the last frame, as many digits as its zoom level needs (defaults to -x)")
+    parser.add_argument('--to-y', type=Decimal, help="center Y coordinate of the last frame (defaults to -y)")
+    parser.add_argument('--to-zoomlevel', type=float, required=True, help="zoom level of the last frame")
+    parser.add_argument('--duration', type=float, default=10, help="seconds")
+    parser.add_argument('--fps', type=float, default=30, help="frames per second")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--palette', type=int, default=0, help="palette index")
+    parser.add_argument('--max-recursion', type=int, help="defaults to one that suits each zoom level, as the interactive program starts out with")
+    parser.add_argument('--tile-mode', choices=('edge','subdivide'), default='edge', help="skip tiles with an all-black border, or subdivide tiles and fill any uniform rectangle (Mariani-Silver)")
+    parser.add_argument('--subdivide-min-size', type=int, default=4, help="in subdivide mode, rectangles smaller than this are computed pixel by pixel")
+    parser.add_argument('--smooth', action='store_true', help="smooth escape values, blending the palette instead of showing bands")
+    parser.add_argument('--disk-cache', metavar='DIR', help="keep tiles in (and take them from) a tile pack, such as the interactive program's tilecache")
+    parser.add_argument('--threads', type=int, default=cpu_count(), help="worker threads, defaults to one per CPU")
+    parser.add_argument('-o', '--output', default=os.path.join('frames', 'frame%05d.png'), help="file name pattern for the frames (.png or .ppm, with a %%d for the frame number), or - for raw RGB frames to stdout")
+    args = parser.parse_args()
+
+    if args.to_x is None:
+        args.to_x = args.x
+    if args.to_y is None:
+        args.to_y = args.y
+    if args.output != '-':
+        if not args.output.lower().endswith(('.png','.ppm')):
+            parser.error("Output file pattern must end in .png or .ppm.")
+        try:
+            args.output % 0
+        except TypeError:
+            parser.error("Output file pattern must have a %d for the frame number.")
+    if min(args.zoomlevel, args.to_zoomlevel) < 0:
+        parser.error("Zoom levels must not be negative.")
+    if zoom_level_to_screen_w(max(args.zoomlevel, args.to_zoomlevel)) / args.width < minimum_pixel_size:
+        parser.error("Zoom level is too deep for this resolution.")
+    if args.max_recursion is not None and not 0 < args.max_recursion <= tilegrid.max_recursion_limit:
+        parser.error("Max recursion must be between 1 and %d." % tilegrid.max_recursion_limit)
+    if not 0 <= args.palette < len(build_palettes(1)):
+        parser.error("Palette index must be in the range 0 to %d." % (len(build_palettes(1))-1))
+    num_frames = max(2, int(round(args.duration * args.fps)))
+
+    if args.output == '-':
+        def write_frame(rgb):
+            sys.stdout.buffer.write(rgb)
+    else:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        writer = write_png if args.output.lower().endswith('.png') else write_ppm
+        frame_number = iter(range(num_frames))
+        def write_frame(rgb):
+            writer(args.output % next(frame_number), args.width, args.height, rgb)
+
+    tile_pack = None
+    if args.disk_cache:
+        tile_pack = TilePack(args.disk_cache, tilegrid.tile_size, args.tile_mode, args.smooth)
+
+    t1 = time()
+    coords = zoom_path(args.x, args.y, args.zoomlevel, args.to_x, args.to_y, args.to_zoomlevel, num_frames)
+    frames, computed, loaded, drawn = animate(cffi_compute.Kernels(), args.palette, coords, args.width, args.height, max(1,args.threads), write_frame,
+                                              args.max_recursion, args.tile_mode, args.subdivide_min_size, args.smooth, tile_pack)
+    t2 = time()
+    if tile_pack is not None:
+        tile_pack.close()
+
+    logger.info("Rendered %d frames (%.01fs at %g fps) in %.02fs: %.02f frames/s." % (frames, frames/args.fps, args.fps, t2-t1, frames/(t2-t1)))
+    logger.info("Computed %d tiles (%.01f per frame) and loaded %d from disk, for %d drawn: %.01f%% of the tiles were reused." % (computed, computed/frames, loaded, drawn, 100 - 100*computed/max(1,drawn)))
+
+
+
+if __name__ == '__main__':
+    main()
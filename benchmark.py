@@ -0,0 +1,210 @@
+"""
+Time the C kernels on a fixed set of regions, for every variant, several tile sizes and several recursion limits.  Results are JSON.
+
+Example: python3 benchmark.py -o bench.json
+Later:   python3 benchmark.py --compare bench.json     (exits with status 1 if anything got slower or computes differently than before)
+"""
+
+from time import perf_counter
+from decimal import Decimal
+import argparse, json, platform, sys, zlib
+import logging
+
+import cffi
+import cffi_compute
+from cffi_compute import new_depth, depth_buffer
+from perturbation import ReferenceOrbit
+from tilegrid import perturbation_pixel_size
+
+
+
+logger = logging.getLogger('benchmark')
+
+# each region is a square of pixels around a center, given as (center x, center y, width), strings so they stay exact
+regions = {
+    'interior': ("-0.15", "0", "0.2"),                    # inside the main cardioid, every tile takes the all-black shortcut
+    'exterior': ("1.0", "1.0", "0.5"),                    # outside the set, everything escapes within a few iterations
+    'boundary': ("-0.1592", "1.0338", "0.01"),            # dense filaments, a mix of everything
+    'seahorse': ("-0.7453", "0.1127", "0.01"),            # seahorse valley, slow escapes next to the set
+    'deep': ("-0.743643887037158704752191506114774", "0.131825904205311970493132056385139", "2.56e-14"),   # computed with perturbation
+}
+
+variants = {
+    'simple': cffi_compute.compile_simple,
+    'edge': cffi_compute.compile,
+    'unrolled': cffi_compute.compile_unrolled,
+    'vector': cffi_compute.compile_vector,
+}
+
+
+
+def run_case(computelib, region, tile_size, max_recursion, pixels_across, repeat):
+    """
+    Compute a square of pixels_across pixels in the given region as tiles, repeat times.  Give the best time, the iterations
+    the kernel did (pixels skipped by shortcuts or found periodic early cost fewer than their depth value) and a checksum of the depth data.
+    """
+
+    center_x, center_y, width = (Decimal(v) for v in regions[region])
+    pixel_size = float(width) / pixels_across
+    simcoord_per_tile = pixel_size * tile_size
+    tiles_across = pixels_across // tile_size
+    depth_data = new_depth(tile_size)
+
+    reference = None
+    if pixel_size < perturbation_pixel_size:
+        reference = ReferenceOrbit(center_x, center_y, max_recursion, pixel_size)
+    start_x = float(center_x) - float(width)/2
+    start_y = float(center_y) - float(width)/2
+
+    best = None
+    for _ in range(repeat):
+        elapsed = 0.0                    # only the kernel calls are timed, not the bookkeeping around them
+        iterations = 0
+        checksum = 0
+        for row in range(tiles_across):
+            for col in range(tiles_across):
+                if reference is not None:
+                    dx = (col - tiles_across/2) * simcoord_per_tile          # offsets from the center, where the reference is
+                    dy = (row - tiles_across/2) * simcoord_per_tile
+                    t = perf_counter()
+                    computelib.compute_tile_perturb(depth_data, reference.orbit, reference.length, dx, dy, simcoord_per_tile, tile_size, max_recursion)
+                else:
+                    x = start_x + col*simcoord_per_tile
+                    y = start_y + row*simcoord_per_tile
+                    t = perf_counter()
+                    computelib.compute_tile(depth_data, x, y, simcoord_per_tile, tile_size, max_recursion)
+                elapsed += perf_counter() - t
+                iterations += computelib.take_iterations()
+                checksum = zlib.crc32(depth_buffer(depth_data), checksum)
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, iterations, checksum
+
+
+
+def run(variant_names, region_names, tile_sizes, max_recursions, pixels_across, repeat):
+    """
+    Run every combination, giving a list of result dicts.
+    """
+
+    results = []
+    for variant in variant_names:
+        computelib = variants[variant]()
+        for region in region_names:
+            for tile_size in tile_sizes:
+                for max_recursion in max_recursions:
+                    seconds, iterations, checksum = run_case(computelib, region, tile_size, max_recursion, pixels_across, repeat)
+                    pixels = (pixels_across // tile_size * tile_size) ** 2
+                    results.append({
+                        'variant': variant,
+                        'region': region,
+                        'tile_size': tile_size,
+                        'max_recursion': max_recursion,
+                        'pixels': pixels,
+                        'seconds': seconds,
+                        'pixels_per_second': pixels / seconds,
+                        'iterations': iterations,
+                        'iterations_per_second': iterations / seconds,
+                        'checksum': checksum
+                    })
+                    logger.info("%-8s %-8s tile %3d, max %5d: %7.02f Mpixels/s, %8.01f Miterations/s" % (
+                        variant, region, tile_size, max_recursion, pixels / seconds / 1e6, iterations / seconds / 1e6))
+    return results
+
+
+
+def case_key(result):
+    return (result['variant'], result['region'], result['tile_size'], result['max_recursion'])
+
+
+
+def log_fastest(results):
+    """
+    Log the fastest variant for each region (over all tile sizes and recursion limits).
+    """
+
+    fastest = {}
+    for result in results:
+        totals = fastest.setdefault(result['region'], {})
+        totals[result['variant']] = totals.get(result['variant'], 0) + result['seconds']
+    for region, totals in fastest.items():
+        logger.info("Fastest for %s: %s." % (region, min(totals, key=totals.get)))
+
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare against earlier results, returning the number of cases that got slower by more than tolerance (a fraction) or changed their output.
+    Outputs are only compared within a variant, the variants do not all agree on every pixel (periodicity checking, unrolled escapes).
+    """
+
+    earlier = {case_key(result): result for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        old = earlier.get(case_key(result))
+        if old is None:
+            continue
+        if old['checksum'] != result['checksum']:
+            logger.warning("Output changed for %s %s, tile %d, max %d." % case_key(result))
+            regressions += 1
+        elif result['pixels_per_second'] < old['pixels_per_second'] * (1 - tolerance):
+            logger.warning("Slower for %s %s, tile %d, max %d: %.02f Mpixels/s, was %.02f." % (case_key(result) + (result['pixels_per_second']/1e6, old['pixels_per_second']/1e6)))
+            regressions += 1
+    return regressions
+
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Benchmark the C kernels, writing the results as JSON.")
+    parser.add_argument('--variants', nargs='+', choices=sorted(variants), default=list(variants))
+    parser.add_argument('--regions', nargs='+', choices=sorted(regions), default=list(regions))
+    parser.add_argument('--tile-sizes', nargs='+', type=int, default=[16, 32, 64, 128])
+    parser.add_argument('--max-recursions', nargs='+', type=int, default=[256, 1024, 4096])
+    parser.add_argument('--pixels', type=int, default=256, help="width (and height) of the square of pixels computed for each case")
+    parser.add_argument('--repeat', type=int, default=3, help="take the best of this many runs")
+    parser.add_argument('-o', '--output', help="write the results to this file instead of the standard output")
+    parser.add_argument('--compare', help="earlier results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown (as a fraction) that counts as a regression")
+    args = parser.parse_args()
+
+    for tile_size in args.tile_sizes:
+        if not 0 < tile_size <= min(cffi_compute.max_tile_size, args.pixels):
+            parser.error("Tile sizes must be between 1 and %d." % min(cffi_compute.max_tile_size, args.pixels))
+    for max_recursion in args.max_recursions:
+        if not 0 < max_recursion < 256*256:
+            parser.error("Max recursion must fit in 16 bits.")
+
+    results = run(args.variants, args.regions, args.tile_sizes, args.max_recursions, args.pixels, max(1,args.repeat))
+    log_fastest(results)
+    report = {
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor() or platform.machine(),
+            'python': sys.version.split()[0],
+            'cffi': cffi.__version__
+        },
+        'pixels': args.pixels,
+        'repeat': args.repeat,
+        'results': results
+    }
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        logger.info("%d regressions against %s." % (regressions, args.compare))
+    sys.exit(1 if regressions else 0)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,284 +1,1065 @@
 """
 This file is a library that provides C components for efficient (compared to raw Python) computation.
+
+Compiled kernels are kept in a cache directory, named after a hash of everything that goes into them, so the
+compiler only runs the first time a given kernel is used.  Tile size and max recursion are arguments of the C
+functions rather than part of the code, so that one build serves every configuration.  The one exception is the width
+of the depth values (depth_t): 16 bits normally, 32 bits in a separate "wide" build of each variant for max recursions
+that do not fit in 16 bits.
 """
 
 from cffi import FFI
+import cffi
+import os, sys, platform, sysconfig, hashlib, tempfile, shutil, threading
+from collections import OrderedDict
+import importlib.machinery, importlib.util
 import logging
 
 
 
 logger = logging.getLogger('cffi_compute')
 
+kernel_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kernelcache')
+max_tile_size = 256          # tile_size arguments must not be larger than this, some kernels keep a row on the stack
+max_narrow_recursion = 65535 # the largest max recursion that fits in 16-bit depth values, beyond it the wide builds are needed
+float_pixel_scale = 1.0e-6   # the vector variant computes pixels at least this times the max recursion large with floats, twice as many at a time (see mandlebrot_group())
+max_periodicity_tolerance = 1.0e-8   # orbits that come back this close to a saved point are taken to be periodic, see PERIODICITY_TOLERANCE
+max_antialias_samples = 16   # antialias_tile() samples a pixel on a grid of at most this many points across
+max_packed_palettes = 8      # tables of finished pixels kept by packed_palette(), one per palette, max recursion and pixel format in use
 
+ffi = FFI()                  # only for allocating buffers, C types are the same across every build of the kernels
+packed_palettes = OrderedDict()     # see packed_palette(), least recently used first
+packed_palettes_lock = threading.Lock()
 
-def compile_simple(tile_size, max_recursion, minimum_fractalspace_coord):
-    """
-    Compile the C code and return the handle needed to invoke it.
-    """
+# closed-form tests for the main cardioid and the period-2 bulb, shared by all the variants below
+# points inside them never escape, so there is no need to iterate them (at shallow zoom that is a large part of the screen)
+interior_source = """
+    #include <stdint.h>
 
-    # do some hacky inline C
-    ffi = FFI()
-    ffi.set_source("inlinehack", """
-    #define TILE_SIZE """+str(tile_size)+"""
-    #define MAX_RECURSION """+str(max_recursion)+"""
-    #define MIN_FRACTACLSPACE_X """+str(minimum_fractalspace_coord[0])+"""
-    #define MIN_FRACTACLSPACE_Y """+str(minimum_fractalspace_coord[1])+"""
+    static int known_interior(double x, double y) {
+        double q = (x - 0.25)*(x - 0.25) + y*y;
+        if( q*(q + (x - 0.25)) <= 0.25*y*y ) return 1;         /* main cardioid */
+        if( (x + 1.0)*(x + 1.0) + y*y <= 0.0625 ) return 1;    /* period-2 bulb */
+        return 0;
+    }
 
-    void store(unsigned char* data, int idx, int val){
-        if(idx >= (TILE_SIZE*TILE_SIZE) || idx < 0) fprintf(stderr,"store idx %d\\n",idx);
-        if(val < 0 || val >= 256*256) fprintf(stderr,"store val %d\\n",val);
-        data[(idx)*2] = ((val & 0xFF00) >> 8);
-        data[(idx)*2+1] = (val & 0xFF);
+    /* Brent-style cycle detection: each orbit is compared against a saved point, which is replaced at doubling intervals,
+    and an orbit that comes back to within this distance of it is taken to be periodic (inside the set)
+    the distance is a fraction of a pixel, so that it shrinks along with the pixels when zooming in, but never more than
+    MAX_PERIODICITY_TOLERANCE: the large pixels of shallow views would otherwise stop escaping orbits that merely pass
+    close to their saved point (such as -1.0625-0.25i, which escapes after 1063 iterations) */
+    #define MAX_PERIODICITY_TOLERANCE """+repr(max_periodicity_tolerance)+"""
+    #define PERIODICITY_TOLERANCE(simcoord_per_tile) ((simcoord_per_tile) / tile_size / 64 < MAX_PERIODICITY_TOLERANCE ? (simcoord_per_tile) / tile_size / 64 : MAX_PERIODICITY_TOLERANCE)
+
+    #define MAX_TILE_SIZE """+str(max_tile_size)+"""
+
+    /* iterations done by the calling thread, for metrics, every mandlebrot function adds to it
+    collected (and reset) by take_iterations() after computing a tile, on the same thread
+    the initial-exec model makes it a plain offset from the thread pointer, instead of a function call per pixel */
+    #if defined(_MSC_VER)
+    static __declspec(thread) long long iteration_counter = 0;
+    #elif defined(__GNUC__) || defined(__clang__)
+    static __thread long long iteration_counter __attribute__ ((tls_model ("initial-exec"))) = 0;
+    #else
+    static _Thread_local long long iteration_counter = 0;
+    #endif
+
+    long long take_iterations(void) {
+        long long iterations = iteration_counter;
+        iteration_counter = 0;
+        return iterations;
     }
+"""
+interior_cdef = """
+    long long take_iterations(void);
+"""
 
-    int load(unsigned char* data, int idx){
-        if(idx >= (TILE_SIZE*TILE_SIZE) || idx < 0) fprintf(stderr,"load idx %d\\n",idx);
-        return ((int)data[idx*2] << 8) + data[idx*2+1];
+# perturbation theory kernel, shared by all the variants below (see perturbation.py for the reference orbit)
+# the reference orbit arrives as doubles in a byte array (Z_0=0, Z_1, ... as interleaved x,y), as array.tobytes() produces it
+perturbation_source = """
+    #define SIMDELTA(start, i) start + (i) * simcoord_per_tile / tile_size
+
+    int mandlebrot_perturb(const double* ref, int ref_len, double dc_x, double dc_y, int max_recursion) {
+        double dz_x = 0.0;                                       /* difference between this pixel's orbit and the reference orbit */
+        double dz_y = 0.0;
+        double dz_x2;
+        double z_x;
+        double z_y;
+        int m = 0;                                               /* position in the reference orbit */
+        int count = 0;
+        while( count < max_recursion ){
+            dz_x2 = 2.0*(ref[m*2]*dz_x - ref[m*2+1]*dz_y) + dz_x*dz_x - dz_y*dz_y + dc_x;
+            dz_y = 2.0*(ref[m*2]*dz_y + ref[m*2+1]*dz_x) + 2.0*dz_x*dz_y + dc_y;
+            dz_x = dz_x2;
+            m += 1;
+            count += 1;
+            z_x = ref[m*2] + dz_x;
+            z_y = ref[m*2+1] + dz_y;
+            if( z_x*z_x + z_y*z_y > 4.0 ) break;
+
+            /* rebase onto the start of the reference when the difference grows larger than the orbit itself (a glitch
+            is coming, precision is being lost) or when the reference has escaped and has no more points to offer */
+            if( z_x*z_x + z_y*z_y < dz_x*dz_x + dz_y*dz_y || m == ref_len-1 ){
+                dz_x = z_x;
+                dz_y = z_y;
+                m = 0;
+            }
+        }
+        iteration_counter += count;
+        return count;
     }
 
-    void colorize_tile(unsigned char* pixel_depth, unsigned char* pixel_color,  unsigned char* palette_color, int palette_color_len){
-        int pixel_depth_idx;
-        int pixel_color_idx;
-        int palette_color_idx;
+    void compute_tile_perturb(depth_t* data, unsigned char* ref_data, int ref_len, double tile_dx, double tile_dy, double simcoord_per_tile, int tile_size, int max_recursion) {
+        const double* ref = (const double*)ref_data;
+        double dc_x;
+        double dc_y;
+        double alt_delta;
         int iterations;
-        for( int x=0; x<TILE_SIZE; ++x ){
-            for( int y=0; y<TILE_SIZE; ++y ){
-                pixel_depth_idx = x + y*TILE_SIZE;
-                pixel_color_idx = pixel_depth_idx*3;
-                iterations = load(pixel_depth,pixel_depth_idx);       /* pixel_depth[pixel_depth_idx] */
-                if( iterations == MAX_RECURSION ){
-                    pixel_color[pixel_color_idx]   = 0;
-                    pixel_color[pixel_color_idx+1] = 0;
-                    pixel_color[pixel_color_idx+2] = 0;
-                }else{
-                    palette_color_idx = (iterations % palette_color_len) * 3;
-                    pixel_color[pixel_color_idx]   = palette_color[palette_color_idx];
-                    pixel_color[pixel_color_idx+1] = palette_color[palette_color_idx+1];
-                    pixel_color[pixel_color_idx+2] = palette_color[palette_color_idx+2];
+        int prelimit = 0;                                        /* track edge pixels that do not reach max_recursion */
+
+        dc_x = tile_dx;
+        alt_delta = SIMDELTA(tile_dx,tile_size-1);
+        for( int y=0; y<tile_size; ++y ){                        /* calculate left & right edges */
+            dc_y = SIMDELTA(tile_dy,y);
+            iterations = mandlebrot_perturb(ref, ref_len, dc_x, dc_y, max_recursion);
+            data[y*tile_size] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot_perturb(ref, ref_len, alt_delta, dc_y, max_recursion);
+            data[y*tile_size+tile_size-1] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+        }
+        dc_y = tile_dy;
+        alt_delta = SIMDELTA(tile_dy,tile_size-1);
+        for( int x=1; x<tile_size-1; ++x ){                      /* calculate top & bottom edges */
+            dc_x = SIMDELTA(tile_dx,x);
+            iterations = mandlebrot_perturb(ref, ref_len, dc_x, dc_y, max_recursion);
+            data[x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot_perturb(ref, ref_len, dc_x, alt_delta, max_recursion);
+            data[tile_size*(tile_size-1)+x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+        }
+        if( prelimit == 0 ){                                     /* check for easy escape, big speedup inside the set */
+            for( int i=0; i<tile_size*tile_size; ++i ){
+                data[i] = max_recursion;
+            }
+            return;
+        }
+        for( int x=1; x<tile_size-1; ++x ){                      /* fill in the middle */
+            dc_x = SIMDELTA(tile_dx,x);
+            for( int y=1; y<tile_size-1; ++y ){
+                dc_y = SIMDELTA(tile_dy,y);
+                iterations = mandlebrot_perturb(ref, ref_len, dc_x, dc_y, max_recursion);
+                data[x + y*tile_size] = iterations;
+            }
+        }
+    }
+"""
+perturbation_cdef = """
+    int mandlebrot_perturb(const double *, int, double, double, int);
+    void compute_tile_perturb(depth_t *, unsigned char *, int, double, double, double, int, int);
+"""
+
+# Mariani-Silver subdivision, shared by all the variants below as an alternative to their compute_tile
+# a rectangle whose border pixels all share one iteration count is filled with it, otherwise it is split in two and each half checked
+subdivide_source = """
+    #ifndef SIMCOORD
+    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / tile_size
+    #endif
+
+    /* compute one pixel of the tile and store it */
+    int subdivide_pixel(depth_t* data, int x, int y, double start_coord_x, double start_coord_y, double simcoord_per_tile, int tile_size, int max_recursion) {
+        int iterations = mandlebrot(SIMCOORD(start_coord_x,x), SIMCOORD(start_coord_y,y), PERIODICITY_TOLERANCE(simcoord_per_tile), max_recursion);
+        data[x + y*tile_size] = iterations;
+        return iterations;
+    }
+
+    /* the border of the rectangle (x0,y0)-(x1,y1), inclusive, must already be computed */
+    void subdivide_rect(depth_t* data, int x0, int y0, int x1, int y1, double start_coord_x, double start_coord_y, double simcoord_per_tile, int min_size, int tile_size, int max_recursion) {
+        int first = data[x0 + y0*tile_size];
+        int uniform = 1;
+        int mid;
+
+        if( x1-x0 < 2 || y1-y0 < 2 ) return;                    /* no inside */
+        for( int x=x0; x<=x1 && uniform; ++x ){
+            if( (int)data[x + y0*tile_size] != first || (int)data[x + y1*tile_size] != first ) uniform = 0;
+        }
+        for( int y=y0+1; y<y1 && uniform; ++y ){
+            if( (int)data[x0 + y*tile_size] != first || (int)data[x1 + y*tile_size] != first ) uniform = 0;
+        }
+        if( uniform ){                                           /* fill in the inside without computing it */
+            for( int y=y0+1; y<y1; ++y ){
+                for( int x=x0+1; x<x1; ++x ){
+                    data[x + y*tile_size] = first;
+                }
+            }
+            return;
+        }
+        if( x1-x0 < min_size && y1-y0 < min_size ){              /* too small to be worth splitting, compute the inside */
+            for( int y=y0+1; y<y1; ++y ){
+                for( int x=x0+1; x<x1; ++x ){
+                    subdivide_pixel(data, x, y, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
                 }
             }
+            return;
+        }
+        if( x1-x0 >= y1-y0 ){                                    /* split across the longer side */
+            mid = (x0+x1)/2;
+            for( int y=y0+1; y<y1; ++y ) subdivide_pixel(data, mid, y, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
+            subdivide_rect(data, x0, y0, mid, y1, start_coord_x, start_coord_y, simcoord_per_tile, min_size, tile_size, max_recursion);
+            subdivide_rect(data, mid, y0, x1, y1, start_coord_x, start_coord_y, simcoord_per_tile, min_size, tile_size, max_recursion);
+        }else{
+            mid = (y0+y1)/2;
+            for( int x=x0+1; x<x1; ++x ) subdivide_pixel(data, x, mid, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
+            subdivide_rect(data, x0, y0, x1, mid, start_coord_x, start_coord_y, simcoord_per_tile, min_size, tile_size, max_recursion);
+            subdivide_rect(data, x0, mid, x1, y1, start_coord_x, start_coord_y, simcoord_per_tile, min_size, tile_size, max_recursion);
+        }
+    }
+
+    void compute_tile_subdivide(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int min_size, int tile_size, int max_recursion) {
+        for( int i=0; i<tile_size; ++i ){                        /* the border of the whole tile */
+            subdivide_pixel(data, i, 0, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
+            subdivide_pixel(data, i, tile_size-1, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
+        }
+        for( int i=1; i<tile_size-1; ++i ){
+            subdivide_pixel(data, 0, i, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
+            subdivide_pixel(data, tile_size-1, i, start_coord_x, start_coord_y, simcoord_per_tile, tile_size, max_recursion);
         }
+        subdivide_rect(data, 0, 0, tile_size-1, tile_size-1, start_coord_x, start_coord_y, simcoord_per_tile, min_size, tile_size, max_recursion);
+    }
+"""
+subdivide_cdef = """
+    void compute_tile_subdivide(depth_t *, double, double, double, int, int, int);
+"""
+
+# smooth (continuous) escape values, shared by all the variants below
+# an orbit that has escaped is iterated on to a much larger radius, where N + 1 - log2(log2|z_N|) no longer jumps from one
+# iteration count to the next, the whole part of it is stored as the depth value and the fraction (in 256ths) as a byte after the
+# tile's depth values (see new_depth()), so palettes can be blended between neighbouring entries instead of showing bands
+smooth_source = """
+    #include <math.h>
+    #include <string.h>
+
+    #define SMOOTH_BAILOUT 4294967296.0                          /* |z|^2, for a radius of 2^16 */
+
+    static int smooth_value(double x, double y, int count, int max_recursion, unsigned char* fraction) {
+        double value = count + 1.0 - log2(0.5*log2(x*x + y*y));
+        if( value < 1.0 ) value = 1.0;
+        if( value > max_recursion - 1 ) value = max_recursion - 1;  /* only the inside of the set is black */
+        *fraction = (unsigned char)((value - floor(value)) * 256.0);
+        return (int)value;
     }
 
-    int mandlebrot(double coord_x, double coord_y) {
+    int mandlebrot_smooth(double coord_x, double coord_y, double tolerance, int max_recursion, unsigned char* fraction) {
         double x2;
         double x = coord_x;
         double y = coord_y;
         int count = 1;
-        while( x*x + y*y <= 4.0 && count < MAX_RECURSION ){
+        double saved_x = coord_x;                                /* cycle detection, see PERIODICITY_TOLERANCE */
+        double saved_y = coord_y;
+        double tolerance2 = tolerance*tolerance;
+        int saved_limit = 2;
+        int saved_step = 0;
+        *fraction = 0;
+        if( known_interior(coord_x, coord_y) ) return max_recursion;
+        while( x*x + y*y <= 4.0 && count < max_recursion ){
+            x2 = x*x - y*y + coord_x;
+            y = 2.0*x*y + coord_y;
+            x = x2;
+            count += 1;
+            if( (x-saved_x)*(x-saved_x) + (y-saved_y)*(y-saved_y) < tolerance2 ){ iteration_counter += count; return max_recursion; }
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
+        }
+        if( count >= max_recursion ){ iteration_counter += count; return max_recursion; }
+        while( x*x + y*y <= SMOOTH_BAILOUT ){                    /* a few more, |z| is squared each time */
             x2 = x*x - y*y + coord_x;
             y = 2.0*x*y + coord_y;
             x = x2;
             count += 1;
         }
+        iteration_counter += count;
+        return smooth_value(x, y, count, max_recursion, fraction);
+    }
+
+    /* like mandlebrot_perturb(), once escaped the orbit is big enough to go on without the reference (c is Z_1 plus the offset) */
+    int mandlebrot_perturb_smooth(const double* ref, int ref_len, double dc_x, double dc_y, int max_recursion, unsigned char* fraction) {
+        double dz_x = 0.0;
+        double dz_y = 0.0;
+        double dz_x2;
+        double z_x = 0.0;
+        double z_y = 0.0;
+        double c_x = ref[2] + dc_x;
+        double c_y = ref[3] + dc_y;
+        int m = 0;
+        int count = 0;
+        *fraction = 0;
+        while( count < max_recursion ){
+            dz_x2 = 2.0*(ref[m*2]*dz_x - ref[m*2+1]*dz_y) + dz_x*dz_x - dz_y*dz_y + dc_x;
+            dz_y = 2.0*(ref[m*2]*dz_y + ref[m*2+1]*dz_x) + 2.0*dz_x*dz_y + dc_y;
+            dz_x = dz_x2;
+            m += 1;
+            count += 1;
+            z_x = ref[m*2] + dz_x;
+            z_y = ref[m*2+1] + dz_y;
+            if( z_x*z_x + z_y*z_y > 4.0 ) break;
+            if( z_x*z_x + z_y*z_y < dz_x*dz_x + dz_y*dz_y || m == ref_len-1 ){
+                dz_x = z_x;
+                dz_y = z_y;
+                m = 0;
+            }
+        }
+        if( count >= max_recursion ){ iteration_counter += count; return max_recursion; }
+        while( z_x*z_x + z_y*z_y <= SMOOTH_BAILOUT ){
+            dz_x2 = z_x*z_x - z_y*z_y + c_x;
+            z_y = 2.0*z_x*z_y + c_y;
+            z_x = dz_x2;
+            count += 1;
+        }
+        iteration_counter += count;
+        return smooth_value(z_x, z_y, count, max_recursion, fraction);
+    }
+"""
+smooth_cdef = """
+    int mandlebrot_smooth(double, double, double, int, unsigned char *);
+    int mandlebrot_perturb_smooth(const double *, int, double, double, int, unsigned char *);
+"""
+
+# progressive computation, shared by all the variants below as an alternative to their compute_tile
+# a tile is computed in passes of decreasing stride, each computing the pixels at multiples of its stride that the earlier passes
+# did not, then filling the blocks between them with copies so there is something sensible to show in the meantime
+# the first pass also computes the border of the tile, which is never filled over, and finishes the tile if it is all black
+# with smooth set, every pixel gets a smooth escape value, at the cost of computing them one at a time instead of in lanes
+progressive_source = """
+    typedef struct {
+        double start_coord_x;                                    /* a coordinate, or an offset from the reference orbit */
+        double start_coord_y;
+        double simcoord_per_tile;
+        double tolerance;
+        const double* ref;                                       /* the reference orbit for perturbation, NULL otherwise */
+        int ref_len;
+        int smooth;
+        int tile_size;
+        int max_recursion;
+    } pass_params;
+
+    /* compute the pixels of one row at the given x positions, and their fractions if smooth */
+    static void pass_row(const pass_params* p, const int* xs, int n, int y, int* counts, unsigned char* fractions) {
+        double simcoord_per_tile = p->simcoord_per_tile;
+        int tile_size = p->tile_size;
+        double coord_y = p->start_coord_y + y * simcoord_per_tile / tile_size;
+        if( p->smooth ){
+            for( int i=0; i<n; ++i ){
+                if( p->ref != NULL ){
+                    counts[i] = mandlebrot_perturb_smooth(p->ref, p->ref_len, p->start_coord_x + xs[i] * simcoord_per_tile / tile_size, coord_y, p->max_recursion, fractions+i);
+                }else{
+                    counts[i] = mandlebrot_smooth(p->start_coord_x + xs[i] * simcoord_per_tile / tile_size, coord_y, p->tolerance, p->max_recursion, fractions+i);
+                }
+            }
+            return;
+        }
+        if( p->ref != NULL ){
+            for( int i=0; i<n; ++i ){
+                counts[i] = mandlebrot_perturb(p->ref, p->ref_len, p->start_coord_x + xs[i] * simcoord_per_tile / tile_size, coord_y, p->max_recursion);
+            }
+            return;
+        }
+    #ifdef LANES
+        double coords_x[MAX_TILE_SIZE+2*LANES];
+        int lane_counts[2*LANES];
+        int group;
+        for( int i=0; i<n+2*LANES; ++i ){                        /* padded with copies of the last one */
+            coords_x[i] = p->start_coord_x + xs[i<n ? i : n-1] * simcoord_per_tile / tile_size;
+        }
+        for( int i=0; i<n; i+=group ){
+            group = mandlebrot_group(coords_x+i, coord_y, simcoord_per_tile / tile_size, p->tolerance, lane_counts, p->max_recursion);
+            for( int j=0; j<group && i+j<n; ++j ) counts[i+j] = lane_counts[j];
+        }
+    #else
+        for( int i=0; i<n; ++i ){
+            counts[i] = mandlebrot(p->start_coord_x + xs[i] * simcoord_per_tile / tile_size, coord_y, p->tolerance, p->max_recursion);
+        }
+    #endif
+    }
+
+    /* run one pass, prev_stride is the stride of the previous pass (0 for the first pass), returns 1 when the tile is complete */
+    static int tile_pass(depth_t* data, const pass_params* p, int pass_stride, int prev_stride) {
+        int tile_size = p->tile_size;
+        int max_recursion = p->max_recursion;
+        unsigned char* fraction = p->smooth ? (unsigned char*)(data + tile_size*tile_size) : NULL;
+        int xs[MAX_TILE_SIZE];
+        int counts[MAX_TILE_SIZE];
+        unsigned char fractions[MAX_TILE_SIZE];
+        int n;
+        int prelimit = 0;                                        /* track edge pixels that do not reach max_recursion */
+
+        #define PUT(i, k) { data[i] = counts[k]; if( fraction ) fraction[i] = fractions[k]; }
+        if( prev_stride == 0 ){                                  /* calculate the edges */
+            for( int x=0; x<MAX_TILE_SIZE; ++x ) xs[x] = x;
+            pass_row(p, xs, tile_size, 0, counts, fractions);
+            for( int x=0; x<tile_size; ++x ){
+                PUT(x, x);
+                if(counts[x] != max_recursion) prelimit = 1;
+            }
+            pass_row(p, xs, tile_size, tile_size-1, counts, fractions);
+            for( int x=0; x<tile_size; ++x ){
+                PUT(tile_size*(tile_size-1)+x, x);
+                if(counts[x] != max_recursion) prelimit = 1;
+            }
+            xs[1] = tile_size-1;
+            for( int y=1; y<tile_size-1; ++y ){
+                pass_row(p, xs, 2, y, counts, fractions);
+                PUT(y*tile_size, 0);
+                PUT(y*tile_size+tile_size-1, 1);
+                if(counts[0] != max_recursion || counts[1] != max_recursion) prelimit = 1;
+            }
+            if( prelimit == 0 ){                                 /* check for easy escape, big speedup inside the set */
+                for( int i=0; i<tile_size*tile_size; ++i ) data[i] = max_recursion;
+                if( fraction ) memset(fraction, 0, tile_size*tile_size);
+                return 1;
+            }
+        }
+
+        for( int y=pass_stride; y<tile_size-1; y+=pass_stride ){  /* the inside pixels on this pass's grid */
+            n = 0;
+            for( int x=pass_stride; x<tile_size-1; x+=pass_stride ){
+                if( prev_stride && x % prev_stride == 0 && y % prev_stride == 0 ) continue;    /* done in an earlier pass */
+                xs[n++] = x;
+            }
+            pass_row(p, xs, n, y, counts, fractions);
+            for( int i=0; i<n; ++i ) PUT(xs[i] + y*tile_size, i);
+        }
+        #undef PUT
+        if( pass_stride == 1 ) return 1;
+
+        for( int y=0; y<tile_size-1; y+=pass_stride ){           /* fill the blocks, leaving the border and the grid itself alone */
+            for( int x=0; x<tile_size-1; x+=pass_stride ){
+                int value = data[x + y*tile_size];
+                int value_fraction = fraction ? fraction[x + y*tile_size] : 0;
+                for( int by=(y ? y : 1); by<y+pass_stride && by<tile_size-1; ++by ){
+                    for( int bx=(x ? x : 1); bx<x+pass_stride && bx<tile_size-1; ++bx ){
+                        if( bx == x && by == y ) continue;
+                        data[bx + by*tile_size] = value;
+                        if( fraction ) fraction[bx + by*tile_size] = value_fraction;
+                    }
+                }
+            }
+        }
+        return 0;
+    }
+
+    int compute_tile_pass(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int pass_stride, int prev_stride, int smooth, int tile_size, int max_recursion) {
+        pass_params p = {start_coord_x, start_coord_y, simcoord_per_tile, PERIODICITY_TOLERANCE(simcoord_per_tile), NULL, 0, smooth, tile_size, max_recursion};
+        return tile_pass(data, &p, pass_stride, prev_stride);
+    }
+
+    int compute_tile_perturb_pass(depth_t* data, unsigned char* ref_data, int ref_len, double tile_dx, double tile_dy, double simcoord_per_tile, int pass_stride, int prev_stride, int smooth, int tile_size, int max_recursion) {
+        pass_params p = {tile_dx, tile_dy, simcoord_per_tile, 0.0, (const double*)ref_data, ref_len, smooth, tile_size, max_recursion};
+        return tile_pass(data, &p, pass_stride, prev_stride);
+    }
+
+    /* count the pixels of the given depth, such as how many of those computed (or filled) so far are black */
+    int count_depth(const depth_t* data, int n, int value) {
+        int count = 0;
+        for( int i=0; i<n; ++i ){
+            if( (int)data[i] == value ) ++count;
+        }
         return count;
     }
 
-    void compute_tile(unsigned char* data, long long row, long long col, double simcoord_per_tile) {
-        double start_coord_x = MIN_FRACTACLSPACE_X + col * simcoord_per_tile;
-        double start_coord_y = MIN_FRACTACLSPACE_Y + row * simcoord_per_tile;
-        double coord_x;
-        double coord_y;
-        int iterations;
-        for( int x=0; x<TILE_SIZE; ++x ){
-            coord_x = start_coord_x + x * simcoord_per_tile / TILE_SIZE;
-            for( int y=0; y<TILE_SIZE; ++y ){
-                coord_y = start_coord_y + y * simcoord_per_tile / TILE_SIZE;
-                iterations = mandlebrot(coord_x, coord_y);
-                store(data,(x + y*TILE_SIZE),iterations);  /* data[x + y*TILE_SIZE] = iterations */
+    /* the smallest and the largest depth among the pixels that escaped, or max_recursion and 0 if none did
+    used to judge whether max_recursion suits the view (see tilegrid.py) */
+    void depth_range(const depth_t* data, int n, int max_recursion, int* range) {
+        int lowest = max_recursion;
+        int highest = 0;
+        for( int i=0; i<n; ++i ){
+            int d = data[i];
+            if( d == max_recursion ) continue;
+            if( d < lowest ) lowest = d;
+            if( d > highest ) highest = d;
+        }
+        range[0] = lowest;
+        range[1] = highest;
+    }
+"""
+progressive_cdef = """
+    int compute_tile_pass(depth_t *, double, double, double, int, int, int, int, int);
+    int compute_tile_perturb_pass(depth_t *, unsigned char *, int, double, double, double, int, int, int, int, int);
+    int count_depth(const depth_t *, int, int);
+    void depth_range(const depth_t *, int, int, int *);
+"""
+
+# adaptive supersampling, for print-quality output: only the pixels that differ from a neighbour are sampled again, on a
+# grid of points spread over the pixel, and get the average colour of those samples (so the palette must be known)
+# the samples are computed by pass_row() on a finer grid, so they take the same path as the pixels (perturbation included)
+antialias_source = """
+    #include <stdlib.h>
+
+    #define MAX_ANTIALIAS_SAMPLES """+str(max_antialias_samples)+"""
+
+    /* add the colour of one sample to sum, as colorize_tiles() would draw it */
+    static void add_sample_color(int d, int f, int max_recursion, const unsigned char* palette_color, int palette_color_len, int* sum) {
+        if( d >= max_recursion ) return;                         /* black */
+        const unsigned char* color = palette_color + (d % palette_color_len)*3;
+        const unsigned char* next_color = palette_color + ((d+1) % palette_color_len)*3;
+        for( int c=0; c<3; ++c ) sum[c] += (color[c]*(256-f) + next_color[c]*f) >> 8;
+    }
+
+    /* colour the pixels x0 <= x < x1, y0 <= y < y1 of a computed tile into rgb (3 bytes per pixel, red first, tile_size pixels to a row),
+    sampling again on a grid of samples x samples points those whose depth differs by more than threshold from one of their neighbours
+    the pixels on the tile's border are compared with those of the neighbouring tiles (above has the smaller y, left the smaller x)
+    where they are given, NULL where there are none, so edges that run along the border are found too
+    returns the number of pixels sampled again */
+    static int antialias(const depth_t* data, const depth_t* above, const depth_t* below, const depth_t* left, const depth_t* right,
+                         const pass_params* p, int samples, int threshold, int x0, int y0, int x1, int y1,
+                         const unsigned char* palette_color, int palette_color_len, unsigned char* rgb) {
+        int tile_size = p->tile_size;
+        int max_recursion = p->max_recursion;
+        const unsigned char* fraction = p->smooth ? (const unsigned char*)(data + tile_size*tile_size) : NULL;
+        int xs[MAX_ANTIALIAS_SAMPLES];
+        int counts[MAX_ANTIALIAS_SAMPLES];
+        unsigned char fractions[MAX_ANTIALIAS_SAMPLES];
+        double pixel_size = p->simcoord_per_tile / tile_size;
+        pass_params sub = *p;                                    /* the samples, as pixels of a tile samples times larger */
+        int sampled = 0;
+
+        if( samples > MAX_ANTIALIAS_SAMPLES ) samples = MAX_ANTIALIAS_SAMPLES;
+        sub.tile_size = tile_size * samples;
+        sub.tolerance = p->tolerance / samples;
+        sub.start_coord_x = p->start_coord_x - (samples-1) * pixel_size / samples / 2;   /* centered on the pixel's own point */
+        sub.start_coord_y = p->start_coord_y - (samples-1) * pixel_size / samples / 2;
+        for( int y=y0; y<y1; ++y ){
+            for( int x=x0; x<x1; ++x ){
+                int i = x + y*tile_size;
+                int d = data[i];
+                int sum[3] = {0, 0, 0};
+                int n_left = x > 0 ? data[i-1] : left ? left[i+tile_size-1] : d;
+                int n_right = x < tile_size-1 ? data[i+1] : right ? right[i-tile_size+1] : d;
+                int n_above = y > 0 ? data[i-tile_size] : above ? above[i+tile_size*(tile_size-1)] : d;
+                int n_below = y < tile_size-1 ? data[i+tile_size] : below ? below[x] : d;
+                int edge = abs(d - n_left) > threshold || abs(d - n_right) > threshold || abs(d - n_above) > threshold || abs(d - n_below) > threshold;
+                if( samples < 2 || !edge ){
+                    add_sample_color(d, fraction ? fraction[i] : 0, max_recursion, palette_color, palette_color_len, sum);
+                }else{
+                    for( int sy=0; sy<samples; ++sy ){
+                        for( int sx=0; sx<samples; ++sx ) xs[sx] = x*samples + sx;
+                        pass_row(&sub, xs, samples, y*samples + sy, counts, fractions);
+                        for( int sx=0; sx<samples; ++sx ){
+                            add_sample_color(counts[sx], p->smooth ? fractions[sx] : 0, max_recursion, palette_color, palette_color_len, sum);
+                        }
+                    }
+                    for( int c=0; c<3; ++c ) sum[c] = (sum[c] + samples*samples/2) / (samples*samples);
+                    ++sampled;
+                }
+                for( int c=0; c<3; ++c ) rgb[i*3+c] = (unsigned char)sum[c];
+            }
+        }
+        return sampled;
+    }
+
+    int antialias_tile(const depth_t* data, const depth_t* above, const depth_t* below, const depth_t* left, const depth_t* right,
+                       double start_coord_x, double start_coord_y, double simcoord_per_tile, int smooth, int tile_size, int max_recursion,
+                       int samples, int threshold, int x0, int y0, int x1, int y1, const unsigned char* palette_color, int palette_color_len, unsigned char* rgb) {
+        pass_params p = {start_coord_x, start_coord_y, simcoord_per_tile, PERIODICITY_TOLERANCE(simcoord_per_tile), NULL, 0, smooth, tile_size, max_recursion};
+        return antialias(data, above, below, left, right, &p, samples, threshold, x0, y0, x1, y1, palette_color, palette_color_len, rgb);
+    }
+
+    int antialias_tile_perturb(const depth_t* data, const depth_t* above, const depth_t* below, const depth_t* left, const depth_t* right,
+                               unsigned char* ref_data, int ref_len, double tile_dx, double tile_dy, double simcoord_per_tile, int smooth, int tile_size, int max_recursion,
+                               int samples, int threshold, int x0, int y0, int x1, int y1, const unsigned char* palette_color, int palette_color_len, unsigned char* rgb) {
+        pass_params p = {tile_dx, tile_dy, simcoord_per_tile, 0.0, (const double*)ref_data, ref_len, smooth, tile_size, max_recursion};
+        return antialias(data, above, below, left, right, &p, samples, threshold, x0, y0, x1, y1, palette_color, palette_color_len, rgb);
+    }
+"""
+antialias_cdef = """
+    int antialias_tile(const depth_t *, const depth_t *, const depth_t *, const depth_t *, const depth_t *, double, double, double, int, int, int,
+                       int, int, int, int, int, int, const unsigned char *, int, unsigned char *);
+    int antialias_tile_perturb(const depth_t *, const depth_t *, const depth_t *, const depth_t *, const depth_t *, unsigned char *, int, double, double, double, int, int, int,
+                               int, int, int, int, int, int, const unsigned char *, int, unsigned char *);
+"""
+
+# colorization of many tiles at once, straight into the packed pixels of a whole frame (a pygame surface, or an RGB image)
+# this saves making a surface per tile and copying it again, palette switches recolor the whole screen in one call
+frame_source = """
+    #include <stdlib.h>
+    #include <string.h>
+
+    /* wide depth values are only ever up to max_recursion, but keep anything larger inside the table all the same
+    (16-bit ones always are, the compiler drops the test for them) */
+    #define PACKED_DEPTH(d) (sizeof(depth_t) == 2 || (int)(d) <= max_recursion ? (int)(d) : max_recursion)
+
+    /* store a pixel value of 3 or 4 bytes in native byte order */
+    static void put_pixel(unsigned char* pixel, unsigned int value, int bytes_per_pixel, int little_endian) {
+        if( bytes_per_pixel == 4 ){
+            memcpy(pixel, &value, 4);
+        }else if( little_endian ){
+            pixel[0] = value & 0xFF;
+            pixel[1] = (value >> 8) & 0xFF;
+            pixel[2] = (value >> 16) & 0xFF;
+        }else{
+            pixel[0] = (value >> 16) & 0xFF;
+            pixel[1] = (value >> 8) & 0xFF;
+            pixel[2] = value & 0xFF;
+        }
+    }
+
+    /* fill packed with the finished pixel (4 bytes apart, of which bytes_per_pixel are used) for each of packed_len depth values,
+    the table colorize_tiles() draws with, it only changes with the palette, the max recursion and the pixel format */
+    void pack_palette(int max_recursion, int packed_len, const unsigned char* palette_color, int palette_color_len,
+                      int bytes_per_pixel, int r_shift, int g_shift, int b_shift, unsigned int opaque, unsigned char* packed){
+        const uint16_t one = 1;
+        int little_endian = *(const unsigned char*)&one;
+        const unsigned char* color;
+        unsigned int value;
+        for( int i=0; i<packed_len; ++i ){
+            value = opaque;
+            if( i != max_recursion ){                            /* max_recursion is black */
+                color = palette_color + (i % palette_color_len)*3;
+                value |= ((unsigned int)color[0] << r_shift) | ((unsigned int)color[1] << g_shift) | ((unsigned int)color[2] << b_shift);
+            }
+            put_pixel(packed + i*4, value, bytes_per_pixel, little_endian);
+        }
+    }
+
+    /* pixels are 3 or 4 bytes, holding a value in native byte order with the given channel shifts (as pygame describes its surfaces)
+    opaque is or-ed into every pixel, for the alpha channel if there is one
+    packed is the table made by pack_palette() for the same palette, max recursion and pixel format
+    each tile (of sizes[t] pixels across) fills a rectangle (left, top, right, bottom) of the frame, scaled to it with the nearest pixel,
+    and is clipped to the frame
+    a tile with fractions (smooth escape values, NULL otherwise) is blended between the palette entries on either side of each value */
+    void colorize_tiles(depth_t** depths, unsigned char** fractions, const int* rects, const int* sizes, int num_tiles, int max_recursion,
+                        const unsigned char* packed, const unsigned char* palette_color, int palette_color_len,
+                        unsigned char* pixels, int width, int height, int pitch, int bytes_per_pixel,
+                        int r_shift, int g_shift, int b_shift, unsigned int opaque){
+        const uint16_t one = 1;
+        int little_endian = *(const unsigned char*)&one;
+        unsigned char* pixel;
+        const unsigned char* color;
+        const unsigned char* next_color;
+        unsigned int value;
+        int* columns;                                            /* the tile column for each frame column drawn */
+
+        columns = malloc((width > 0 ? width : 1) * sizeof(int));
+        if( columns == NULL ) return;
+
+        for( int t=0; t<num_tiles; ++t ){
+            int tile_size = sizes[t];
+            int left = rects[t*4];
+            int top = rects[t*4+1];
+            int w = rects[t*4+2] - left;
+            int h = rects[t*4+3] - top;
+            int x0 = left < 0 ? -left : 0;
+            int y0 = top < 0 ? -top : 0;
+            int x1 = left + w > width ? width - left : w;
+            int y1 = top + h > height ? height - top : h;
+            for( int x=x0; x<x1; ++x ) columns[x-x0] = (int)((long long)x * tile_size / w);
+            for( int y=y0; y<y1; ++y ){
+                int row = (int)((long long)y * tile_size / h) * tile_size;
+                const depth_t* depth = depths[t] + row;
+                pixel = pixels + (long long)(top+y)*pitch + (long long)(left+x0)*bytes_per_pixel;
+                if( fractions[t] != NULL ){
+                    const unsigned char* fraction = fractions[t] + row;
+                    for( int x=0; x<x1-x0; ++x, pixel+=bytes_per_pixel ){
+                        int d = PACKED_DEPTH(depth[columns[x]]);
+                        int f = fraction[columns[x]];
+                        if( d == max_recursion || f == 0 ){
+                            memcpy(pixel, packed + d*4, bytes_per_pixel);
+                            continue;
+                        }
+                        color = palette_color + (d % palette_color_len)*3;
+                        next_color = palette_color + ((d+1) % palette_color_len)*3;
+                        value = opaque
+                            | ((unsigned int)((color[0]*(256-f) + next_color[0]*f) >> 8) << r_shift)
+                            | ((unsigned int)((color[1]*(256-f) + next_color[1]*f) >> 8) << g_shift)
+                            | ((unsigned int)((color[2]*(256-f) + next_color[2]*f) >> 8) << b_shift);
+                        put_pixel(pixel, value, bytes_per_pixel, little_endian);
+                    }
+                }else if( bytes_per_pixel == 4 ){
+                    for( int x=0; x<x1-x0; ++x, pixel+=4 ) memcpy(pixel, packed + (size_t)PACKED_DEPTH(depth[columns[x]])*4, 4);
+                }else{
+                    for( int x=0; x<x1-x0; ++x, pixel+=3 ) memcpy(pixel, packed + (size_t)PACKED_DEPTH(depth[columns[x]])*4, 3);
+                }
             }
         }
+        free(columns);
     }
-    """)
-    ffi.cdef("""
-    void colorize_tile(unsigned char *, unsigned char *,  unsigned char *, int);
-    int mandlebrot(double, double);
-    void compute_tile(unsigned char *, long long, long long, double);
-    """)
-    logger.info("Compile...")
-    ffi.compile()
-    logger.info("Import...")
-    from inlinehack import lib     # import the compiled library
 
-    return lib
+    /* scale an RGB image (3 bytes per pixel, rows packed) onto another with bilinear filtering, so a frame can be made from tiles of
+    a somewhat different size without blocky pixels: pixel (x, y) of dst shows point (src_x + x*step, src_y + y*step) of src, blended
+    from the four pixels around it (points off src take its edge) */
+    void scale_rgb(const unsigned char* src, int src_width, int src_height, double src_x, double src_y, double step,
+                   unsigned char* dst, int dst_width, int dst_height) {
+        int* columns = malloc((dst_width > 0 ? dst_width : 1) * 2 * sizeof(int));   /* left source column and weight of the right one, per column */
+        if( columns == NULL ) return;
+        for( int x=0; x<dst_width; ++x ){
+            double sx = src_x + x*step;
+            if( sx < 0.0 ) sx = 0.0;
+            if( sx > src_width-1 ) sx = src_width-1;
+            columns[x*2] = (int)sx;
+            columns[x*2+1] = (int)((sx - (int)sx) * 256.0);
+        }
+        for( int y=0; y<dst_height; ++y ){
+            double sy = src_y + y*step;
+            if( sy < 0.0 ) sy = 0.0;
+            if( sy > src_height-1 ) sy = src_height-1;
+            int wy = (int)((sy - (int)sy) * 256.0);
+            const unsigned char* row0 = src + (long long)(int)sy * src_width * 3;
+            const unsigned char* row1 = (int)sy < src_height-1 ? row0 + src_width*3 : row0;
+            unsigned char* pixel = dst + (long long)y * dst_width * 3;
+            for( int x=0; x<dst_width; ++x, pixel+=3 ){
+                int c0 = columns[x*2] * 3;
+                int c1 = columns[x*2] < src_width-1 ? c0 + 3 : c0;
+                int wx = columns[x*2+1];
+                for( int c=0; c<3; ++c ){
+                    int top = row0[c0+c]*(256-wx) + row0[c1+c]*wx;
+                    int bottom = row1[c0+c]*(256-wx) + row1[c1+c]*wx;
+                    pixel[c] = (unsigned char)((top*(256-wy) + bottom*wy + 32768) >> 16);
+                }
+            }
+        }
+        free(columns);
+    }
+"""
+frame_cdef = """
+    void pack_palette(int, int, const unsigned char *, int, int, int, int, int, unsigned int, unsigned char *);
+    void colorize_tiles(depth_t **, unsigned char **, const int *, const int *, int, int, const unsigned char *, const unsigned char *, int, unsigned char *, int, int, int, int, int, int, int, unsigned int);
+    void scale_rgb(const unsigned char *, int, int, double, double, double, unsigned char *, int, int);
+"""
 
 
 
-def compile(tile_size, max_recursion, minimum_fractalspace_coord):
+def wide_depth(max_recursion):
     """
-    Compile the C code and return the handle needed to invoke it.
+    Tell whether depth values up to the given max recursion need 32-bit storage (and the wide builds of the kernels).
     """
+    return max_recursion > max_narrow_recursion
 
-    # do some hacky inline C
-    ffi = FFI()
-    ffi.set_source("inlinehack", """
-    #define TILE_SIZE """+str(tile_size)+"""
-    #define MAX_RECURSION """+str(max_recursion)+"""
-    #define MIN_FRACTACLSPACE_X """+str(minimum_fractalspace_coord[0])+"""
-    #define MIN_FRACTACLSPACE_Y """+str(minimum_fractalspace_coord[1])+"""
 
-    /* fun treacherous macros to write 16-bit values in a byte array, blame CFFI for not liking arrays of shorts */
-    #define STORE(dat, idx, val) dat[idx*2] = ((val & 0xFF00) >> 8); dat[idx*2+1] = (val & 0xFF)
-    #define LOAD(dat, idx) (dat[idx*2] << 8) + dat[idx*2+1]
 
-    /* slightly-hostile macro to cut code duplication */
-    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / TILE_SIZE
+def new_depth(tile_size, smooth=False, wide=False):
+    """
+    Allocate depth data for one tile, as a native array of 16-bit (32-bit with wide) iteration counts (zero filled).
+    With smooth, a byte per pixel follows the counts, holding the fraction (in 256ths) of its smooth escape value.
+    """
+    return ffi.new("uint32_t[]" if wide else "uint16_t[]", depth_nbytes(tile_size, smooth, wide) // (4 if wide else 2))
+
+
+
+def depth_nbytes(tile_size, smooth=False, wide=False):
+    """
+    Give the size in bytes of the depth data new_depth() allocates with the same arguments.
+    """
+    item = 4 if wide else 2
+    n = tile_size*tile_size
+    return (n + (n+item-1)//item if smooth else n) * item
+
+
+
+def depth_fractions(depth_data, tile_size):
+    """
+    Give a pointer to the fractions that follow the counts in depth data allocated with smooth, or NULL if there are none.
+    """
+    if ffi.sizeof(depth_data) > tile_size*tile_size*ffi.sizeof(ffi.typeof(depth_data).item):
+        return ffi.cast("unsigned char *", depth_data + tile_size*tile_size)
+    return ffi.NULL
+
+
+
+def depth_buffer(depth_data):
+    """
+    Give a view of depth data that supports the buffer protocol (memoryview, file writes, numpy.frombuffer) without copying it.
+    """
+    return ffi.buffer(depth_data)
+
+
+
+def colorize_tiles(computelib, depths, positions, tile_size, max_recursion, palette_data, pixels, width, height, pitch, bytes_per_pixel, shifts, opaque=0):
+    """
+    Colorize many tiles in one call, writing straight into a frame of packed 3 or 4 byte pixels.
+    pixels can be anything with a writable buffer, such as a bytearray or the buffer of a pygame surface.
+    positions are the upper left corners of the tiles within the frame, or (left, top, right, bottom) rectangles to draw them scaled.
+    tile_size is the size of every tile, or a list giving the size of each one.  Tiles with fractions (see new_depth()) are drawn smooth.
+    shifts are the (red, green, blue) bit positions.
+    The depth data must all be of the width computelib was built for.
+    """
+
+    if not depths:
+        return
+    sizes = [tile_size] * len(depths) if isinstance(tile_size, int) else tile_size
+    rects = []
+    for position, size in zip(positions, sizes):
+        rects.extend(position if len(position) == 4 else (position[0], position[1], position[0]+size, position[1]+size))
+    wide = ffi.sizeof(ffi.typeof(depths[0]).item) == 4
+    packed = packed_palette(computelib, palette_data, max_recursion, wide, bytes_per_pixel, tuple(shifts), opaque)
+    computelib.colorize_tiles(
+        ffi.new(ffi.getctype(ffi.typeof(depths[0]).item, "*[]"), depths), ffi.new("unsigned char *[]", [depth_fractions(depth, size) for depth, size in zip(depths, sizes)]), ffi.new("int[]", rects), ffi.new("int[]", sizes), len(depths),
+        max_recursion, packed, palette_data, len(palette_data)//3,
+        ffi.from_buffer(pixels, require_writable=True), width, height, pitch, bytes_per_pixel, *shifts, opaque)
+
+
+
+def packed_palette(computelib, palette_data, max_recursion, wide, bytes_per_pixel, shifts, opaque):
+    """
+    Give the table of finished pixels colorize_tiles() draws with (see pack_palette()), made once for each palette, max
+    recursion and pixel format and kept for the next calls.  palette_data must be bytes, which hash quickly after the first time.
+    """
+
+    key = (palette_data, max_recursion, wide, bytes_per_pixel, shifts, opaque)
+    with packed_palettes_lock:
+        packed = packed_palettes.get(key)
+        if packed is not None:
+            packed_palettes.move_to_end(key)
+            return packed
+    packed_len = max_recursion + 1 if wide else 65536
+    packed = ffi.new("unsigned char[]", packed_len * 4)
+    computelib.pack_palette(max_recursion, packed_len, palette_data, len(palette_data)//3, bytes_per_pixel, *shifts, opaque, packed)
+    with packed_palettes_lock:
+        packed_palettes[key] = packed
+        while len(packed_palettes) > max_packed_palettes:
+            packed_palettes.popitem(last=False)
+    return packed
+
+
+
+def build(variant, source, cdef, extra_compile_args=(), wide=False):
+    """
+    Compile the given C code into the kernel cache, unless an identical build is there already, and return the handle needed to invoke it.
+    The code gets depth_t defined as a 16-bit type, or a 32-bit one with wide.
+    """
+
+    depth_type = "typedef %s depth_t;\n" % ("uint32_t" if wide else "uint16_t")
+    source = "#include <stdint.h>\n" + depth_type + source
+    cdef = depth_type + cdef
+    if wide:
+        variant += "_wide"
+
+    # the module name carries a hash of everything that affects the binary, so a changed kernel never picks up a stale build
+    # builds for the local CPU (-march=native) are also tied to this machine, in case the cache directory is shared
+    key = hashlib.sha256()
+    for part in (source, cdef, " ".join(extra_compile_args), cffi.__version__, sys.version, sysconfig.get_platform()):
+        key.update(part.encode() + b"\0")
+    if '-march=native' in extra_compile_args:
+        key.update(platform.node().encode())
+    module_name = "_mandelbrot_%s_%s" % (variant, key.hexdigest()[:16])
+
+    module_path = None
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        if os.path.exists(os.path.join(kernel_cache_dir, module_name + suffix)):
+            module_path = os.path.join(kernel_cache_dir, module_name + suffix)
+            break
+
+    if module_path is None:
+        # compile in a private directory and move the result into place, so that concurrent starts cannot see half a file
+        os.makedirs(kernel_cache_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix="build-", dir=kernel_cache_dir)
+        try:
+            ffi = FFI()
+            ffi.set_source(module_name, source, extra_compile_args=list(extra_compile_args))
+            ffi.cdef(cdef)
+            logger.info("Compile %s kernel..." % variant)
+            built_path = ffi.compile(tmpdir=build_dir)
+            module_path = os.path.join(kernel_cache_dir, os.path.basename(built_path))
+            os.replace(built_path, module_path)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    logger.info("Import %s..." % os.path.basename(module_path))
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module.lib
+
+
+
+def compile_simple(wide=False):
+    """
+    Compile the C code (or reuse an earlier build of it) and return the handle needed to invoke it.
+    """
+
+    # do some hacky inline C
+    source = interior_source + """
+
+    int mandlebrot(double coord_x, double coord_y, double tolerance, int max_recursion) {
+        double x2;
+        double x = coord_x;
+        double y = coord_y;
+        int count = 1;
+        double saved_x = coord_x;                                /* cycle detection, see PERIODICITY_TOLERANCE */
+        double saved_y = coord_y;
+        double tolerance2 = tolerance*tolerance;
+        int saved_limit = 2;
+        int saved_step = 0;
+        if( known_interior(coord_x, coord_y) ) return max_recursion;
+        while( x*x + y*y <= 4.0 && count < max_recursion ){
+            x2 = x*x - y*y + coord_x;
+            y = 2.0*x*y + coord_y;
+            x = x2;
+            count += 1;
+            if( (x-saved_x)*(x-saved_x) + (y-saved_y)*(y-saved_y) < tolerance2 ){ iteration_counter += count; return max_recursion; }
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
+        }
+        iteration_counter += count;
+        return count;
+    }
 
-    void colorize_tile(unsigned char* pixel_depth, unsigned char* pixel_color,  unsigned char* palette_color, int palette_color_len){
-        int pixel_depth_idx;
-        int pixel_color_idx;
-        int palette_color_idx;
+    void compute_tile(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int tile_size, int max_recursion) {
+        double tolerance = PERIODICITY_TOLERANCE(simcoord_per_tile);
+        double coord_x;
+        double coord_y;
         int iterations;
-        for( int x=0; x<TILE_SIZE; ++x ){
-            for( int y=0; y<TILE_SIZE; ++y ){
-                pixel_depth_idx = x + y*TILE_SIZE;
-                pixel_color_idx = pixel_depth_idx*3;
-                iterations = LOAD(pixel_depth,pixel_depth_idx);       /* pixel_depth[pixel_depth_idx] */
-                if( iterations == MAX_RECURSION ){
-                    pixel_color[pixel_color_idx]   = 0;
-                    pixel_color[pixel_color_idx+1] = 0;
-                    pixel_color[pixel_color_idx+2] = 0;
-                }else{
-                    palette_color_idx = (iterations % palette_color_len) * 3;
-                    pixel_color[pixel_color_idx]   = palette_color[palette_color_idx];
-                    pixel_color[pixel_color_idx+1] = palette_color[palette_color_idx+1];
-                    pixel_color[pixel_color_idx+2] = palette_color[palette_color_idx+2];
-                }
+        for( int x=0; x<tile_size; ++x ){
+            coord_x = start_coord_x + x * simcoord_per_tile / tile_size;
+            for( int y=0; y<tile_size; ++y ){
+                coord_y = start_coord_y + y * simcoord_per_tile / tile_size;
+                iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+                data[x + y*tile_size] = iterations;
             }
         }
     }
+    """ + perturbation_source + smooth_source + subdivide_source + progressive_source + antialias_source + frame_source
+    cdef = """
+    int mandlebrot(double, double, double, int);
+    void compute_tile(depth_t *, double, double, double, int, int);
+    """ + interior_cdef + perturbation_cdef + smooth_cdef + subdivide_cdef + progressive_cdef + antialias_cdef + frame_cdef
 
-    int mandlebrot(double coord_x, double coord_y) {
+    return build("simple", source, cdef, wide=wide)
+
+
+
+def compile(wide=False):
+    """
+    Compile the C code (or reuse an earlier build of it) and return the handle needed to invoke it.
+    """
+
+    # do some hacky inline C
+    source = interior_source + """
+
+    /* slightly-hostile macro to cut code duplication */
+    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / tile_size
+
+    int mandlebrot(double coord_x, double coord_y, double tolerance, int max_recursion) {
         double x2;
         double x = coord_x;
         double y = coord_y;
         int count = 1;
-        while( x*x + y*y <= 4.0 && count < MAX_RECURSION ){
+        double saved_x = coord_x;                                /* cycle detection, see PERIODICITY_TOLERANCE */
+        double saved_y = coord_y;
+        double tolerance2 = tolerance*tolerance;
+        int saved_limit = 2;
+        int saved_step = 0;
+        if( known_interior(coord_x, coord_y) ) return max_recursion;
+        while( x*x + y*y <= 4.0 && count < max_recursion ){
             x2 = x*x - y*y + coord_x;
             y = 2.0*x*y + coord_y;
             x = x2;
             count += 1;
+            if( (x-saved_x)*(x-saved_x) + (y-saved_y)*(y-saved_y) < tolerance2 ){ iteration_counter += count; return max_recursion; }
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
             //printf("step to %d (%f,%f)=%f\\n",count,x,y,x*x + y*y);
         }
+        iteration_counter += count;
         return count;
     }
 
-    void compute_tile(unsigned char* data, long long row, long long col, double simcoord_per_tile) {
-        double start_coord_x = MIN_FRACTACLSPACE_X + col * simcoord_per_tile;
-        double start_coord_y = MIN_FRACTACLSPACE_Y + row * simcoord_per_tile;
+    void compute_tile(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int tile_size, int max_recursion) {
+        double tolerance = PERIODICITY_TOLERANCE(simcoord_per_tile);
         double coord_x;
         double coord_y;
         double alt_coord;
         int iterations;
-        int prelimit = 0;                                        /* track edge pixels that do not reach MAX_RECURSION */
+        int prelimit = 0;                                        /* track edge pixels that do not reach max_recursion */
 
         coord_x = start_coord_x;
-        alt_coord = SIMCOORD(start_coord_x,TILE_SIZE-1);
-        for( int y=0; y<TILE_SIZE; ++y ){                        /* calculate left & right edges */
+        alt_coord = SIMCOORD(start_coord_x,tile_size-1);
+        for( int y=0; y<tile_size; ++y ){                        /* calculate left & right edges */
             coord_y = SIMCOORD(start_coord_y,y);
-            iterations = mandlebrot(coord_x, coord_y);
-            STORE(data,(y*TILE_SIZE),iterations);                /* data[y*TILE_SIZE] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
-            iterations = mandlebrot(alt_coord, coord_y);
-            STORE(data,(y*TILE_SIZE+TILE_SIZE-1),iterations);    /* data[y*TILE_SIZE+TILE_SIZE-1] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
+            iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+            data[y*tile_size] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot(alt_coord, coord_y, tolerance, max_recursion);
+            data[y*tile_size+tile_size-1] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
         }
         coord_y = start_coord_y;
-        alt_coord = SIMCOORD(start_coord_y,TILE_SIZE-1);
-        for( int x=1; x<TILE_SIZE-1; ++x ){                      /* calculate top & bottom edges */
+        alt_coord = SIMCOORD(start_coord_y,tile_size-1);
+        for( int x=1; x<tile_size-1; ++x ){                      /* calculate top & bottom edges */
             coord_x = SIMCOORD(start_coord_x,x);
-            iterations = mandlebrot(coord_x, coord_y);
-            STORE(data,x,iterations);                            /* data[x] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
-            iterations = mandlebrot(coord_x, alt_coord);
-            STORE(data,(TILE_SIZE*(TILE_SIZE-1)+x),iterations);  /* data[TILE_SIZE*(TILE_SIZE-1)+x] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
+            iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+            data[x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot(coord_x, alt_coord, tolerance, max_recursion);
+            data[tile_size*(tile_size-1)+x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
         }
         if( prelimit == 0 ){                                     /* check for easy escape, big speedup inside the set */
-            for( int i=0; i<TILE_SIZE*TILE_SIZE; ++i ){
-                STORE(data,i,MAX_RECURSION);                     /* return all max-iteration "black" pixels */
+            for( int i=0; i<tile_size*tile_size; ++i ){
+                data[i] = max_recursion;                     /* return all max-iteration "black" pixels */
             }
             return;
         }
-        for( int x=1; x<TILE_SIZE-1; ++x ){                      /* fill in the middle */
+        for( int x=1; x<tile_size-1; ++x ){                      /* fill in the middle */
             coord_x = SIMCOORD(start_coord_x,x);
-            for( int y=1; y<TILE_SIZE-1; ++y ){
+            for( int y=1; y<tile_size-1; ++y ){
                 coord_y = SIMCOORD(start_coord_y,y);
-                iterations = mandlebrot(coord_x, coord_y);
-                STORE(data,(x + y*TILE_SIZE),iterations);        /* data[x + y*TILE_SIZE] = iterations */
+                iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+                data[x + y*tile_size] = iterations;
             }
         }
     }
-    """)
-    ffi.cdef("""
-    void colorize_tile(unsigned char *, unsigned char *,  unsigned char *, int);
-    int mandlebrot(double, double);
-    void compute_tile(unsigned char *, long long, long long, double);
-    """)
-    logger.info("Compile...")
-    ffi.compile()
-    logger.info("Import...")
-    from inlinehack import lib     # import the compiled library
+    """ + perturbation_source + smooth_source + subdivide_source + progressive_source + antialias_source + frame_source
+    cdef = """
+    int mandlebrot(double, double, double, int);
+    void compute_tile(depth_t *, double, double, double, int, int);
+    """ + interior_cdef + perturbation_cdef + smooth_cdef + subdivide_cdef + progressive_cdef + antialias_cdef + frame_cdef
 
-    return lib
+    return build("edge", source, cdef, wide=wide)
 
 
 
-def compile_unrolled(tile_size, max_recursion, minimum_fractalspace_coord):
+def compile_unrolled(wide=False):
     """
-    Compile the C code and return the handle needed to invoke it.
+    Compile the C code (or reuse an earlier build of it) and return the handle needed to invoke it.
     """
 
     # do some hacky inline C
-    ffi = FFI()
-    ffi.set_source("inlinehack", """
-    #define TILE_SIZE """+str(tile_size)+"""
-    #define MAX_RECURSION """+str(max_recursion)+"""
-    #define MIN_FRACTACLSPACE_X """+str(minimum_fractalspace_coord[0])+"""
-    #define MIN_FRACTACLSPACE_Y """+str(minimum_fractalspace_coord[1])+"""
-
-    /* fun treacherous macros to write 16-bit values in a byte array, blame CFFI for not liking arrays of shorts */
-    #define STORE(dat, idx, val) dat[idx*2] = ((val & 0xFF00) >> 8); dat[idx*2+1] = (val & 0xFF)
-    #define LOAD(dat, idx) (dat[idx*2] << 8) + dat[idx*2+1]
+    source = interior_source + """
 
     /* slightly-hostile macro to cut code duplication */
-    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / TILE_SIZE
-
-    void colorize_tile(unsigned char* pixel_depth, unsigned char* pixel_color,  unsigned char* palette_color, int palette_color_len){
-        int pixel_depth_idx;
-        int pixel_color_idx;
-        int palette_color_idx;
-        int iterations;
-        for( int x=0; x<TILE_SIZE; ++x ){
-            for( int y=0; y<TILE_SIZE; ++y ){
-                pixel_depth_idx = x + y*TILE_SIZE;
-                pixel_color_idx = pixel_depth_idx*3;
-                iterations = LOAD(pixel_depth,pixel_depth_idx);       /* pixel_depth[pixel_depth_idx] */
-                if( iterations == MAX_RECURSION ){
-                    pixel_color[pixel_color_idx]   = 0;
-                    pixel_color[pixel_color_idx+1] = 0;
-                    pixel_color[pixel_color_idx+2] = 0;
-                }else{
-                    palette_color_idx = (iterations % palette_color_len) * 3;
-                    pixel_color[pixel_color_idx]   = palette_color[palette_color_idx];
-                    pixel_color[pixel_color_idx+1] = palette_color[palette_color_idx+1];
-                    pixel_color[pixel_color_idx+2] = palette_color[palette_color_idx+2];
-                }
-            }
-        }
-    }
+    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / tile_size
 
-    int mandlebrot(double coord_x, double coord_y) {
+    int mandlebrot(double coord_x, double coord_y, double tolerance, int max_recursion) {
         int count = 1;
         double x2;
         double x = coord_x;
         double y = coord_y;
         double x_temp = coord_x;
         double y_temp = coord_y;
+        double saved_x = coord_x;                                /* cycle detection, see PERIODICITY_TOLERANCE */
+        double saved_y = coord_y;
+        double tolerance2 = tolerance*tolerance;
+        int saved_limit = 2;
+        int saved_step = 0;                                      /* counted in batches of 4 */
+
+        if( known_interior(coord_x, coord_y) ) return max_recursion;
 
         /* go ahead with reduced bounds checking to avoid both branches and preparation of values for comparison
         probably we are going many rounds anyway, so we can save some cycles */
-        while( x*x + y*y <= 4.0 && count < MAX_RECURSION-4 ){
+        while( x*x + y*y <= 4.0 && count < max_recursion-4 ){
             x_temp = x;
             y_temp = y;
 
@@ -298,6 +1079,13 @@ def compile_unrolled(tile_size, max_recursion, minimum_fractalspace_coord):
 
             count += 4;
             //printf("fast to %d\\n",count);
+            if( (x-saved_x)*(x-saved_x) + (y-saved_y)*(y-saved_y) < tolerance2 ){ iteration_counter += count; return max_recursion; }
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
         }
 
         /* undo the previous batch if we have gone past the escape limit
@@ -310,7 +1098,7 @@ def compile_unrolled(tile_size, max_recursion, minimum_fractalspace_coord):
         }
 
         /* fill in whatever we are missing */
-        while( x*x + y*y <= 4.0 && count < MAX_RECURSION ){
+        while( x*x + y*y <= 4.0 && count < max_recursion ){
             x2 = x*x - y*y + coord_x;
             y = 2.0*x*y + coord_y;
             x = x2;
@@ -319,67 +1107,376 @@ def compile_unrolled(tile_size, max_recursion, minimum_fractalspace_coord):
         }
 
         //printf("count %d\\n",count);
+        iteration_counter += count;
         return count;
     }
 
-    void compute_tile(unsigned char* data, long long row, long long col, double simcoord_per_tile) {
-        double start_coord_x = MIN_FRACTACLSPACE_X + col * simcoord_per_tile;
-        double start_coord_y = MIN_FRACTACLSPACE_Y + row * simcoord_per_tile;
+    void compute_tile(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int tile_size, int max_recursion) {
+        double tolerance = PERIODICITY_TOLERANCE(simcoord_per_tile);
         double coord_x;
         double coord_y;
         double alt_coord;
         int iterations;
-        int prelimit = 0;                                        /* track edge pixels that do not reach MAX_RECURSION */
+        int prelimit = 0;                                        /* track edge pixels that do not reach max_recursion */
 
         coord_x = start_coord_x;
-        alt_coord = SIMCOORD(start_coord_x,TILE_SIZE-1);
-        for( int y=0; y<TILE_SIZE; ++y ){                        /* calculate left & right edges */
+        alt_coord = SIMCOORD(start_coord_x,tile_size-1);
+        for( int y=0; y<tile_size; ++y ){                        /* calculate left & right edges */
             coord_y = SIMCOORD(start_coord_y,y);
-            iterations = mandlebrot(coord_x, coord_y);
-            STORE(data,(y*TILE_SIZE),iterations);                /* data[y*TILE_SIZE] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
-            iterations = mandlebrot(alt_coord, coord_y);
-            STORE(data,(y*TILE_SIZE+TILE_SIZE-1),iterations);    /* data[y*TILE_SIZE+TILE_SIZE-1] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
+            iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+            data[y*tile_size] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot(alt_coord, coord_y, tolerance, max_recursion);
+            data[y*tile_size+tile_size-1] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
         }
         coord_y = start_coord_y;
-        alt_coord = SIMCOORD(start_coord_y,TILE_SIZE-1);
-        for( int x=1; x<TILE_SIZE-1; ++x ){                      /* calculate top & bottom edges */
+        alt_coord = SIMCOORD(start_coord_y,tile_size-1);
+        for( int x=1; x<tile_size-1; ++x ){                      /* calculate top & bottom edges */
             coord_x = SIMCOORD(start_coord_x,x);
-            iterations = mandlebrot(coord_x, coord_y);
-            STORE(data,x,iterations);                            /* data[x] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
-            iterations = mandlebrot(coord_x, alt_coord);
-            STORE(data,(TILE_SIZE*(TILE_SIZE-1)+x),iterations);  /* data[TILE_SIZE*(TILE_SIZE-1)+x] = iterations */
-            if(iterations != MAX_RECURSION) prelimit = 1;
+            iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+            data[x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot(coord_x, alt_coord, tolerance, max_recursion);
+            data[tile_size*(tile_size-1)+x] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
         }
         if( prelimit == 0 ){                                     /* check for easy escape, big speedup inside the set */
-            for( int i=0; i<TILE_SIZE*TILE_SIZE; ++i ){
-                STORE(data,i,MAX_RECURSION);                     /* return all max-iteration "black" pixels */
+            for( int i=0; i<tile_size*tile_size; ++i ){
+                data[i] = max_recursion;                     /* return all max-iteration "black" pixels */
             }
             return;
         }
-        for( int x=1; x<TILE_SIZE-1; ++x ){                      /* fill in the middle */
+        for( int x=1; x<tile_size-1; ++x ){                      /* fill in the middle */
             coord_x = SIMCOORD(start_coord_x,x);
-            for( int y=1; y<TILE_SIZE-1; ++y ){
+            for( int y=1; y<tile_size-1; ++y ){
                 coord_y = SIMCOORD(start_coord_y,y);
-                iterations = mandlebrot(coord_x, coord_y);
-                STORE(data,(x + y*TILE_SIZE),iterations);        /* data[x + y*TILE_SIZE] = iterations */
+                iterations = mandlebrot(coord_x, coord_y, tolerance, max_recursion);
+                data[x + y*tile_size] = iterations;
             }
         }
     }
-    """)
-    ffi.cdef("""
-    void colorize_tile(unsigned char *, unsigned char *,  unsigned char *, int);
-    int mandlebrot(double, double);
-    void compute_tile(unsigned char *, long long, long long, double);
-    """)
-    logger.info("Compile...")
-    ffi.compile()
-    logger.info("Import...")
-    from inlinehack import lib     # import the compiled library
+    """ + perturbation_source + smooth_source + subdivide_source + progressive_source + antialias_source + frame_source
+    cdef = """
+    int mandlebrot(double, double, double, int);
+    void compute_tile(depth_t *, double, double, double, int, int);
+    """ + interior_cdef + perturbation_cdef + smooth_cdef + subdivide_cdef + progressive_cdef + antialias_cdef + frame_cdef
+
+    return build("unrolled", source, cdef, wide=wide)
+
+
+
+def compile_vector(lanes=4, wide=False):
+    """
+    Compile the C code (or reuse an earlier build of it) and return the handle needed to invoke it.
+    This variant iterates several pixels of a row in lockstep using compiler vector extensions (GCC, clang), so
+    that each instruction works on all of them.  Other compilers get a scalar loop over the lanes instead.
+    """
+
+    # do some hacky inline C
+    source = interior_source + """
+    #define LANES """+str(lanes)+"""
+    #define FLOAT_PIXEL_SCALE """+repr(float_pixel_scale)+"""
+    /* slightly-hostile macro to cut code duplication */
+    #define SIMCOORD(start, i) start + (i) * simcoord_per_tile / tile_size
+
+    int mandlebrot(double coord_x, double coord_y, double tolerance, int max_recursion) {
+        double x2;
+        double x = coord_x;
+        double y = coord_y;
+        int count = 1;
+        double saved_x = coord_x;                                /* cycle detection, see PERIODICITY_TOLERANCE */
+        double saved_y = coord_y;
+        double tolerance2 = tolerance*tolerance;
+        int saved_limit = 2;
+        int saved_step = 0;
+        if( known_interior(coord_x, coord_y) ) return max_recursion;
+        while( x*x + y*y <= 4.0 && count < max_recursion ){
+            x2 = x*x - y*y + coord_x;
+            y = 2.0*x*y + coord_y;
+            x = x2;
+            count += 1;
+            if( (x-saved_x)*(x-saved_x) + (y-saved_y)*(y-saved_y) < tolerance2 ){ iteration_counter += count; return max_recursion; }
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
+        }
+        iteration_counter += count;
+        return count;
+    }
+
+    #if defined(__GNUC__) || defined(__clang__)
+    typedef double vdouble __attribute__ ((vector_size (LANES*sizeof(double))));
+    typedef long long vlong __attribute__ ((vector_size (LANES*sizeof(long long))));
+
+    /* iterate LANES pixels of one row at once, lanes that have escaped keep iterating (harmlessly) but stop counting */
+    void mandlebrot_lanes(const double* coord_x, double coord_y, double tolerance, int* counts, int max_recursion) {
+        vdouble cx;
+        vdouble cy;
+        vdouble x;
+        vdouble y;
+        vdouble x2;
+        vdouble y2;
+        vdouble limit;
+        vdouble saved_x;                                         /* cycle detection, see PERIODICITY_TOLERANCE */
+        vdouble saved_y;
+        vdouble tolerance2;
+        vdouble dx;
+        vdouble dy;
+        vlong count;
+        vlong iterations;                                        /* like count, but periodic lanes keep what they really did */
+        vlong active;
+        vlong periodic;
+        vlong max_count;
+        long long any;
+        int saved_limit = 2;
+        int saved_step = 0;
+        for( int i=0; i<LANES; ++i ){
+            cx[i] = coord_x[i];
+            cy[i] = coord_y;
+            limit[i] = 4.0;
+            tolerance2[i] = tolerance*tolerance;
+            max_count[i] = max_recursion;
+            count[i] = 1;
+            iterations[i] = 1;
+            active[i] = -1;
+            if( known_interior(coord_x[i], coord_y) ){         /* never escapes, the lane starts out finished */
+                count[i] = max_recursion;
+                iterations[i] = 0;
+                active[i] = 0;
+            }
+        }
+        x = cx;
+        y = cy;
+        saved_x = cx;
+        saved_y = cy;
+        for( int n=1; n<max_recursion; ++n ){
+            x2 = x*x;
+            y2 = y*y;
+            active &= (x2 + y2 <= limit);                        /* comparisons give -1 for true, 0 for false */
+            any = 0;
+            for( int i=0; i<LANES; ++i ) any |= active[i];
+            if( !any ) break;                                    /* every lane has escaped */
+            count -= active;
+            iterations -= active;
+            y = 2.0*x*y + cy;
+            x = x2 - y2 + cx;
+            dx = x - saved_x;
+            dy = y - saved_y;
+            periodic = active & (dx*dx + dy*dy < tolerance2);   /* lanes that are periodic are finished, and inside */
+            count = (count & ~periodic) | (max_count & periodic);
+            active &= ~periodic;
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
+        }
+        for( int i=0; i<LANES; ++i ){
+            counts[i] = (int)count[i];
+            iteration_counter += iterations[i];
+        }
+    }
+
+    typedef float vfloat __attribute__ ((vector_size (2*LANES*sizeof(float))));
+    typedef int vint __attribute__ ((vector_size (2*LANES*sizeof(int))));
+
+    /* like mandlebrot_lanes(), for twice as many pixels in single precision, which is only good enough for large pixels
+    the coordinates are rounded to floats a small fraction of a pixel apart, and the orbits lose precision as they go, but
+    only where the boundary of the set is finer than the pixels anyway */
+    void mandlebrot_lanes_float(const double* coord_x, double coord_y, double tolerance, int* counts, int max_recursion) {
+        vfloat cx;
+        vfloat cy;
+        vfloat x;
+        vfloat y;
+        vfloat x2;
+        vfloat y2;
+        vfloat limit;
+        vfloat saved_x;                                          /* cycle detection, see PERIODICITY_TOLERANCE */
+        vfloat saved_y;
+        vfloat tolerance2;
+        vfloat dx;
+        vfloat dy;
+        vint count;
+        vint iterations;
+        vint active;
+        vint periodic;
+        vint max_count;
+        int any;
+        int saved_limit = 2;
+        int saved_step = 0;
+        for( int i=0; i<2*LANES; ++i ){
+            cx[i] = (float)coord_x[i];
+            cy[i] = (float)coord_y;
+            limit[i] = 4.0f;
+            tolerance2[i] = (float)(tolerance*tolerance);
+            max_count[i] = max_recursion;
+            count[i] = 1;
+            iterations[i] = 1;
+            active[i] = -1;
+            if( known_interior(coord_x[i], coord_y) ){
+                count[i] = max_recursion;
+                iterations[i] = 0;
+                active[i] = 0;
+            }
+        }
+        x = cx;
+        y = cy;
+        saved_x = cx;
+        saved_y = cy;
+        for( int n=1; n<max_recursion; ++n ){
+            x2 = x*x;
+            y2 = y*y;
+            active &= (x2 + y2 <= limit);
+            any = 0;
+            for( int i=0; i<2*LANES; ++i ) any |= active[i];
+            if( !any ) break;
+            count -= active;
+            iterations -= active;
+            y = 2.0f*x*y + cy;
+            x = x2 - y2 + cx;
+            dx = x - saved_x;
+            dy = y - saved_y;
+            periodic = active & (dx*dx + dy*dy < tolerance2);
+            count = (count & ~periodic) | (max_count & periodic);
+            active &= ~periodic;
+            if( ++saved_step == saved_limit ){
+                saved_x = x;
+                saved_y = y;
+                saved_step = 0;
+                saved_limit *= 2;
+            }
+        }
+        for( int i=0; i<2*LANES; ++i ){
+            counts[i] = count[i];
+            iteration_counter += iterations[i];
+        }
+    }
+    #else
+    void mandlebrot_lanes(const double* coord_x, double coord_y, double tolerance, int* counts, int max_recursion) {
+        for( int i=0; i<LANES; ++i ) counts[i] = mandlebrot(coord_x[i], coord_y, tolerance, max_recursion);
+    }
+
+    void mandlebrot_lanes_float(const double* coord_x, double coord_y, double tolerance, int* counts, int max_recursion) {
+        for( int i=0; i<2*LANES; ++i ) counts[i] = mandlebrot(coord_x[i], coord_y, tolerance, max_recursion);
+    }
+    #endif
+
+    /* iterate a group of pixels of one row, in the cheapest precision that suits the size of the pixels, and give the number done
+    coord_x must have room for 2*LANES coordinates, counts for as many results
+    a float orbit drifts by some 1e-7 per iteration, so floats are only used where that stays a small fraction of a pixel all the way
+    to max_recursion, the pixels then differ from double precision about as much as they would if the tile moved by 1e-4 of a pixel */
+    static int mandlebrot_group(const double* coord_x, double coord_y, double pixel_size, double tolerance, int* counts, int max_recursion) {
+        if( pixel_size >= FLOAT_PIXEL_SCALE * max_recursion ){
+            mandlebrot_lanes_float(coord_x, coord_y, tolerance, counts, max_recursion);
+            return 2*LANES;
+        }
+        mandlebrot_lanes(coord_x, coord_y, tolerance, counts, max_recursion);
+        return LANES;
+    }
+
+    void compute_tile(depth_t* data, double start_coord_x, double start_coord_y, double simcoord_per_tile, int tile_size, int max_recursion) {
+        double tolerance = PERIODICITY_TOLERANCE(simcoord_per_tile);
+        double pixel_size = simcoord_per_tile / tile_size;
+        double coords_x[MAX_TILE_SIZE+2*LANES];                  /* padded so the last group of a row can run past the edge */
+        double coord_y;
+        double alt_coord;
+        int counts[2*LANES];
+        int group;
+        int iterations;
+        int prelimit = 0;                                        /* track edge pixels that do not reach max_recursion */
+
+        for( int x=0; x<tile_size+2*LANES; ++x ){
+            coords_x[x] = SIMCOORD(start_coord_x,x);
+        }
+
+        coord_y = start_coord_y;
+        alt_coord = SIMCOORD(start_coord_y,tile_size-1);
+        for( int x=0; x<tile_size; x+=group ){                  /* calculate top & bottom edges */
+            group = mandlebrot_group(coords_x+x, coord_y, pixel_size, tolerance, counts, max_recursion);
+            for( int i=0; i<group && x+i<tile_size; ++i ){
+                data[x+i] = counts[i];
+                if(counts[i] != max_recursion) prelimit = 1;
+            }
+            mandlebrot_group(coords_x+x, alt_coord, pixel_size, tolerance, counts, max_recursion);
+            for( int i=0; i<group && x+i<tile_size; ++i ){
+                data[tile_size*(tile_size-1)+x+i] = counts[i];
+                if(counts[i] != max_recursion) prelimit = 1;
+            }
+        }
+        for( int y=1; y<tile_size-1; ++y ){                      /* calculate left & right edges */
+            coord_y = SIMCOORD(start_coord_y,y);
+            iterations = mandlebrot(coords_x[0], coord_y, tolerance, max_recursion);
+            data[y*tile_size] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+            iterations = mandlebrot(coords_x[tile_size-1], coord_y, tolerance, max_recursion);
+            data[y*tile_size+tile_size-1] = iterations;
+            if(iterations != max_recursion) prelimit = 1;
+        }
+        if( prelimit == 0 ){                                     /* check for easy escape, big speedup inside the set */
+            for( int i=0; i<tile_size*tile_size; ++i ){
+                data[i] = max_recursion;                     /* return all max-iteration "black" pixels */
+            }
+            return;
+        }
+        for( int y=1; y<tile_size-1; ++y ){                      /* fill in the middle, one row segment at a time */
+            coord_y = SIMCOORD(start_coord_y,y);
+            for( int x=1; x<tile_size-1; x+=group ){
+                group = mandlebrot_group(coords_x+x, coord_y, pixel_size, tolerance, counts, max_recursion);
+                for( int i=0; i<group && x+i<tile_size-1; ++i ){
+                    data[x+i + y*tile_size] = counts[i];
+                }
+            }
+        }
+    }
+    """ + perturbation_source + smooth_source + subdivide_source + progressive_source + antialias_source + frame_source
+    cdef = """
+    int mandlebrot(double, double, double, int);
+    void compute_tile(depth_t *, double, double, double, int, int);
+    """ + interior_cdef + perturbation_cdef + smooth_cdef + subdivide_cdef + progressive_cdef + antialias_cdef + frame_cdef
+
+    # contraction into fused multiply-add would make results differ from the other variants
+    extra_compile_args = [] if sys.platform == 'win32' else ['-O3', '-march=native', '-ffp-contract=off']
+    return build("vector%d" % lanes, source, cdef, extra_compile_args, wide)
+
+
+
+class Kernels():
+    """
+    One variant of the kernels in both depth widths, each loaded (and compiled, if need be) the first time a max recursion needs it.
+    Calling it with a max recursion gives the build to use, any thread may do so, waiting while the build is loaded.
+    """
+
+    def __init__(self, compile_variant=compile_vector, **kwargs):
+        self.compile_variant = compile_variant
+        self.kwargs = kwargs
+        self.builds = {}             # the builds loaded so far, indexed by wide
+        self.lock = threading.Lock()
+
+    def __call__(self, max_recursion):
+        wide = wide_depth(max_recursion)
+        build = self.builds.get(wide)
+        if build is None:
+            with self.lock:
+                if wide not in self.builds:
+                    self.builds[wide] = self.compile_variant(wide=wide, **self.kwargs)
+                build = self.builds[wide]
+        return build
+
+    def preload(self, loaded=None):
+        """
+        Load the 16-bit build on a thread of its own, so that starting up need not wait for it.  loaded() is called once it is there.
+        """
 
-    return lib
+        def load():
+            self(1)
+            if loaded is not None:
+                loaded()
+        threading.Thread(target=load, daemon=True).start()
 
 
 
@@ -0,0 +1,184 @@
+"""
+This file is a library that provides a persistent on-disk tier for the tile cache.
+
+Depth data is kept in a pack file of fixed-size records (the native arrays, as they are in memory), read back through
+a memory map.  A record holds a 16-bit tile of the smallest size, larger tiles and those with 32-bit depth values take
+several records in a row.  An append-only index file maps cache keys (which include the max recursion) to their first
+record number.  When the pack reaches its size limit it is rewritten with only the most recently used tiles (see compact()).
+One pack/index pair exists per set of kernel parameters (smallest tile size, tile mode and whether
+there are smooth escape values) and byte order, since depth data computed with different parameters is not interchangeable.
+"""
+
+import os, sys, mmap, struct
+from collections import OrderedDict
+import logging
+
+from cffi_compute import new_depth, depth_buffer, depth_nbytes, wide_depth
+
+
+
+logger = logging.getLogger('diskcache')
+
+pack_format = 3                           # part of the file names, changes whenever the index entries do
+index_entry = struct.Struct('<qqqdqqq')   # level, row, col, simcoord_per_tile, size, max recursion, record number
+compact_fraction = 0.5                    # share of the size limit the most recently used tiles may take when the pack is rewritten
+
+
+
+class TilePack():
+    """
+    Store and retrieve tile depth data on disk, indexed by cache keys (level,row,col,simcoord_per_tile,size,max_recursion).
+    Tile sizes must be multiples of the given tile_size.  The pack stays below max_bytes, the least recently used tiles
+    are dropped to make room.
+    """
+
+    def __init__(self, directory, tile_size, tile_mode='edge', smooth=False, max_bytes=2**30):
+        self.tile_size = tile_size
+        self.smooth = smooth
+        self.record_size = depth_nbytes(tile_size, smooth)
+        self.max_records = max_bytes // self.record_size
+        self.index = OrderedDict()   # record numbers indexed by cache keys, least recently used first
+        self.mmap = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.basename = basename = os.path.join(directory, "tiles%d-%d-%s-%s" % (pack_format, tile_size, tile_mode + ('-smooth' if smooth else ''), 'le' if sys.byteorder == 'little' else 'be'))
+        self.pack_file = open(basename + ".pack", 'a+b')
+        self.index_file = open(basename + ".idx", 'a+b')
+
+        # load the index, ignoring anything that does not have matching data (probably from an unclean exit)
+        self.num_records = os.fstat(self.pack_file.fileno()).st_size // self.record_size
+        self.pack_file.truncate(self.num_records * self.record_size)
+        self.index_file.seek(0)
+        data = self.index_file.read()
+        self.index_file.truncate(len(data) - len(data) % index_entry.size)
+        for offset in range(0, len(data) - index_entry.size + 1, index_entry.size):
+            level, row, col, simcoord_per_tile, size, max_recursion, record = index_entry.unpack_from(data, offset)
+            cache_key = (level,row,col,simcoord_per_tile,size,max_recursion)
+            if record + self.records(cache_key) <= self.num_records:
+                self.index[cache_key] = record
+        logger.info("Opened tile pack %s with %d tiles." % (basename, len(self.index)))
+
+    def __contains__(self, cache_key):
+        return cache_key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def nbytes(self, cache_key):
+        """
+        Give the size of the depth data of the tile with the given cache key.
+        """
+        return depth_nbytes(cache_key[4], self.smooth, wide_depth(cache_key[5]))
+
+    def records(self, cache_key):
+        """
+        Give the number of records the tile with the given cache key takes.
+        """
+        return -(-self.nbytes(cache_key) // self.record_size)
+
+    def load(self, workunit):
+        """
+        Fill in the depth data of the given WorkUnit from disk.  Return True if that worked, False if the tile is not on disk.
+        """
+
+        record = self.index.get(workunit.cache_key)
+        if record is None:
+            return False
+        self.index.move_to_end(workunit.cache_key)
+
+        cache_key = workunit.cache_key
+        offset = record * self.record_size
+        length = self.nbytes(cache_key)
+        self.map(offset + length)
+        depth_data = new_depth(cache_key[4], self.smooth, wide_depth(cache_key[5]))
+        depth_buffer(depth_data)[:] = self.mmap[offset:offset+length]
+        workunit.depth_data = depth_data
+        return True
+
+    def map(self, length):
+        """
+        Make sure the memory map covers the first length bytes of the pack file, which grows as we go.
+        """
+
+        if self.mmap is None or length > len(self.mmap):
+            if self.mmap is not None:
+                self.mmap.close()
+            self.pack_file.flush()
+            self.mmap = mmap.mmap(self.pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def store(self, workunit):
+        """
+        Write the depth data of the given WorkUnit to disk, unless it is there already.
+        """
+
+        cache_key = workunit.cache_key
+        if cache_key in self.index:
+            self.index.move_to_end(cache_key)
+            return
+        if not all(-2**63 <= x < 2**63 for x in cache_key[:3]):
+            return                               # deep zoom row/col numbers can be too large for the index
+        records = self.records(cache_key)
+        if self.num_records + records > self.max_records:
+            self.compact(int(self.max_records * compact_fraction) - records)
+            if self.num_records + records > self.max_records:
+                return                           # larger than the pack may be
+        data = depth_buffer(workunit.depth_data)
+        assert len(data) == self.nbytes(cache_key), "Depth data does not match the tile pack record size."
+
+        # data first (padded to whole records), then the index entry, so a partial write is never indexed
+        self.pack_file.write(data)
+        self.pack_file.write(bytes(records * self.record_size - len(data)))
+        self.pack_file.flush()
+        self.index_file.write(index_entry.pack(*cache_key, self.num_records))
+        self.index[cache_key] = self.num_records
+        self.num_records += records
+
+    def compact(self, max_records):
+        """
+        Rewrite the pack with only the most recently used tiles that fit in max_records records, forgetting the others.
+        The index is emptied before the new files take the place of the old ones, so an interrupted rewrite loses the
+        tiles rather than mixing up the two packs.
+        """
+
+        keep = []
+        kept_records = 0
+        for cache_key in reversed(self.index):
+            records = self.records(cache_key)
+            if kept_records + records > max_records:
+                break
+            keep.append(cache_key)
+            kept_records += records
+        keep.reverse()
+
+        self.map(self.num_records * self.record_size)
+        index = OrderedDict()
+        with open(self.basename + ".pack.new", 'wb') as pack_file, open(self.basename + ".idx.new", 'wb') as index_file:
+            for cache_key in keep:
+                offset = self.index[cache_key] * self.record_size
+                records = self.records(cache_key)
+                index[cache_key] = pack_file.tell() // self.record_size
+                pack_file.write(self.mmap[offset:offset + records * self.record_size])
+                index_file.write(index_entry.pack(*cache_key, index[cache_key]))
+
+        self.index_file.truncate(0)
+        self.index_file.flush()
+        self.close()
+        os.replace(self.basename + ".pack.new", self.basename + ".pack")
+        os.replace(self.basename + ".idx.new", self.basename + ".idx")
+        self.pack_file = open(self.basename + ".pack", 'a+b')
+        self.index_file = open(self.basename + ".idx", 'a+b')
+        logger.info("Tile pack is full, kept the %d most recently used of %d tiles." % (len(index), len(self.index)))
+        self.index = index
+        self.num_records = kept_records
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.pack_file.close()
+        self.index_file.close()
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
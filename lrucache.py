@@ -0,0 +1,116 @@
+"""
+This file is a library that provides the in-memory tile cache, which forgets the least recently used tiles first.
+
+Entries are kept in an OrderedDict in order of use, so looking up, touching and evicting an entry are all O(1).
+The cache is sized by a memory budget in bytes rather than by a number of tiles, since tiles need not all be
+the same size.
+"""
+
+from collections import OrderedDict
+import logging
+
+
+
+logger = logging.getLogger('lrucache')
+
+
+
+class TileCache():
+    """
+    Hold values (WorkUnit objects) indexed by cache keys, up to a budget of bytes.
+
+    sizeof gives the number of bytes a value accounts for, and on_evict (if given) is called with every value that
+    is evicted, so it can be kept elsewhere (a TilePack).  Counters for hits, misses and evictions are kept for sizing the budget.
+    """
+
+    def __init__(self, max_bytes, sizeof, on_evict=None):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.entries = OrderedDict()     # least recently used first
+        self.sizes = {}                  # bytes accounted for each entry, in case a value changes size while cached
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, cache_key):
+        return cache_key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, cache_key):
+        return self.entries[cache_key]
+
+    def __setitem__(self, cache_key, value):
+        if cache_key in self.entries:
+            del self[cache_key]
+        self.entries[cache_key] = value
+        self.sizes[cache_key] = self.sizeof(value)
+        self.bytes += self.sizes[cache_key]
+
+    def __delitem__(self, cache_key):
+        del self.entries[cache_key]
+        self.bytes -= self.sizes.pop(cache_key)
+
+    def values(self):
+        return self.entries.values()
+
+    def peek(self, cache_key):
+        """
+        Return the value for the cache key without marking it as used, or None if it is not cached.  Safe to call from other threads.
+        """
+        return self.entries.get(cache_key)
+
+    def get(self, cache_key, count=True):
+        """
+        Return the value for the cache key and mark it as the most recently used, or return None if it is not cached.
+        Only counts towards the hit and miss counters if count is True.
+        """
+
+        value = self.entries.get(cache_key)
+        if value is None:
+            if count:
+                self.misses += 1
+            return None
+        self.entries.move_to_end(cache_key)
+        if count:
+            self.hits += 1
+        return value
+
+    def trim(self, keep=0):
+        """
+        Evict the least recently used entries until the cache is within its budget, but never down to fewer than keep entries.
+        """
+
+        evicted = 0
+        while self.bytes > self.max_bytes and len(self.entries) > keep:
+            cache_key, value = self.entries.popitem(last=False)
+            self.bytes -= self.sizes.pop(cache_key)
+            if self.on_evict is not None:
+                self.on_evict(value)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        """
+        Give the counters and the current size, as a dict.
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
@@ -1,12 +1,21 @@
-from time import time, sleep
-from math import log, floor
-from random import shuffle
+from time import time, sleep, perf_counter
+started = perf_counter()     # for the startup report (see note_startup()), taken before the other imports since some take a while
 from queue import SimpleQueue, Empty
 from multiprocessing import cpu_count
+from decimal import Decimal
+from math import floor
 import pygame, threading
 import logging
 
 import cffi_compute
+from diskcache import TilePack
+from lrucache import TileCache
+from scheduler import TileScheduler
+from networker import RemoteWorker, MODE_EDGE, MODE_SUBDIVIDE, MODE_PERTURB, MODE_SMOOTH
+from metrics import Metrics, MetricsExporter
+from tilegrid import tile_size, large_tile_size, minimum_fractalspace_coord, minimum_pixel_size, zoom_level_to_screen_w, screen_w_to_zoom_level, tile_rc_range, pyramid_level, pyramid_simcoord_per_tile, top_tiles, tile_children, tile_screen_position, tile_origin, needs_perturbation, recursion_for_level, recursion_adjustment, recursion_boost_range, max_recursion_limit
+from perturbation import ReferenceOrbit
+from palettes import build_palettes
 
 
 
@@ -33,15 +42,24 @@ if __name__ == '__main__':
 else:
     logger = logging.getLogger('mandelbrot')
 
-max_recursion = 4096         # maybe 2**16-1 eventually?
-tile_size = 32               # smaller tiles mean more thread and cache overhead, but are more efficient in black areas
-todo_queue = SimpleQueue()   # WorkUnit objects to process
+scheduler = TileScheduler()  # WorkUnit objects to process, most important first
 done_queue = SimpleQueue()   # WorkUnit objects that are done
-zoom_step = 0.9
-zoom_step_inv = 1 / zoom_step
-minimum_fractalspace_coord = (-2, -2)
-
-tile_cache = {}              # WorkUnit objects indexed by tuples (zoom,row,col,simcoord_per_tile)
+reference_queue = SimpleQueue()    # DrawingParams waiting for a reference orbit, see reference_orbit_thread()
+memory_cache_bytes = 256 * 2**20   # memory budget of tile_cache, least recently used tiles beyond it are evicted (to disk if enabled)
+tile_cache = TileCache(memory_cache_bytes, lambda workunit: workunit.nbytes())   # WorkUnit objects indexed by tuples (level,row,col,simcoord_per_tile,size,max_recursion)
+disk_cache_dir = 'tilecache' # where tiles evicted from tile_cache are kept between runs, None to disable
+tile_pack = None             # the TilePack for disk_cache_dir, opened by main()
+tile_mode = 'edge'           # 'edge' (skip tiles with an all-black border) or 'subdivide' (Mariani-Silver, fill any uniform rectangle)
+subdivide_min_size = 4       # in 'subdivide' mode, rectangles smaller than this are computed pixel by pixel
+remote_workers = []          # 'host:port' of networker.py daemons to share tiles with (computed whole, not progressively), e.g. ['localhost:7433']
+remote_batch_size = 16       # tiles sent to a remote worker at once
+remote_connections = []      # the RemoteWorker objects, started by start_worker_render_threads()
+metrics = Metrics()          # runtime metrics, shown by the overlay (key m) and exported if either of these is set
+metrics_file = None          # write the metrics here every metrics_interval seconds, as JSON if it ends in .json, Prometheus text otherwise
+metrics_port = None          # serve the metrics on this port of localhost, /metrics (Prometheus text) and /metrics.json
+metrics_interval = 5.0
+progressive_strides = (8, 4, 2, 1)   # in 'edge' mode, compute tiles in passes over every 8th, 4th, ... pixel, () to compute them in one go
+smooth_coloring = False      # keep a fraction with each escape value, so palettes are blended instead of banded (slower, pixels are not computed in lanes)
 
 # a global, containing properties which can be edited and shared between threads
 # would be a bit cleaner to make it an object
@@ -55,36 +73,41 @@ clickables = {
     'autozoom_pause_start': None,
     'maxzoomed': False,
     'redraw': True,
+    'scroll': (0,0),             # pixels the screen contents are to move by, after dragging (see ScreenStuff.scroll())
+    'damage': [],                # screen rectangles whose tiles are to be drawn again, after scrolling
     'mousedown': None,
     'rightmousedown': None,
     'dragto': None,
     'dragstartime': 0,
     'text_hieght': 0,
-    'queue_debug': {'in': 0, 'out': 0}
+    'metrics_overlay': False,
+    'metrics_last': None,
+    'view': None,
+    'view_center': (0,0),
+    'recursion_boost': 0         # doublings of the max recursion suggested by the views so far, new views start with it (see judge_max_recursion())
 }
 
-computelib = cffi_compute.compile_unrolled(tile_size, max_recursion, minimum_fractalspace_coord)
+startup_seconds = {}         # seconds from the start to each step of starting up, see note_startup()
 
 
 
-def zoom_level_to_screen_w(l):
+def note_startup(step):
     """
-    Given a human-friendly zoom level, determine the calculation/simulation/fractalspace coordinate range (as one number) of the screen width.
-    This deals with how much of the fractal is displayable (in the X/col direction).
-    Zoom level 0 is a calculation/simulation/fractalspace X-coordinate width of 2.47.
+    Record how long it took from the start to the given step of starting up ('window', 'kernels', 'first_tile'), as a
+    gauge and in startup_seconds.  They are all logged together once the first tile is drawn.
     """
-    return 2.47 / zoom_step_inv ** l
 
+    if step in startup_seconds:
+        return
+    startup_seconds[step] = perf_counter() - started
+    metrics.set('startup_%s_seconds' % step, startup_seconds[step])
+    if step == 'first_tile':
+        logger.info("Startup: %s." % ", ".join("%s in %.03fs" % (name.replace('_', ' '), seconds) for name, seconds in startup_seconds.items()))
 
 
-def screen_w_to_zoom_level(w):
-    """
-    Given the calculation/simulation/fractalspace coordinate range (as one number) of the screen width, return a human-friendly zoom level.
-    This deals with how much of the fractal is displayable (in the X/col direction).
-    Zoom level 0 is a calculation/simulation/fractalspace X-coordinate width of 2.47.
-    """
-    ratio = 2.47 / w
-    return int(log(ratio,zoom_step_inv) + 0.5)
+
+kernels = cffi_compute.Kernels()   # kernels(max_recursion) gives the build for that max recursion, loaded while the window opens
+palette_cache = {}           # the palettes for each max recursion in use, see palettes_for()
 
 
 
@@ -98,8 +121,8 @@ def screencoord_to_simcoord(coord, clickboxes=None):
             if box(coord):
                 return None
     drpa = drawing_params.last()
-    simx = drpa.coordmin_x + drpa.coordrange_x * coord[0]/screenstuff.window_x
-    simy = drpa.coordmin_y() + drpa.coordrange_y() * coord[1]/screenstuff.window_y
+    simx = drpa.coordmin_x + Decimal(drpa.coordrange_x * coord[0]/screenstuff.window_x)
+    simy = drpa.coordmin_y() + Decimal(drpa.coordrange_y() * coord[1]/screenstuff.window_y)
     return simx,simy
     
 
@@ -188,14 +211,37 @@ class DrawingParams():
         self.coordrange_x = zoom_level_to_screen_w(zoomlevel)
         self.set_coord(coord_x,coord_y)
         self.forgotten    = False                        # when we go back in history, we forget items, but leave them in place (could leave a None or something to save RAM)
+        self.reference    = None                         # a ReferenceOrbit, only used when zoomed in beyond what a double can resolve
+        self.reference_wanted = None                     # (coord_x, coord_y, max_recursion, pixel_size) of the one being computed, see reference_orbit()
+        self.anchor       = None                         # screen position of one tile, see display_tiles()
+        self.recursion_boost = clickables['recursion_boost']   # see max_recursion()
+        self.recursion_judged = None                     # the view and max recursion judge_max_recursion() last looked at
 
     def set_coord(self,coord_x,coord_y):
-        logger.debug("Center simcoord: %s, %s" % (coord_x,coord_y))
-        self.coord_x      = coord_x     # center coord
-        self.coord_y      = coord_y     # center coord
-        self.coordmin_x   = self.coord_x - self.coordrange_x/2
-        self.coordmax_x   = self.coord_x + self.coordrange_x/2
+        logger.debug("Center simcoord: %s, %s", coord_x, coord_y)
+        self.coord_x      = Decimal(coord_x)     # center coord, Decimal so it can be more precise than a pixel
+        self.coord_y      = Decimal(coord_y)     # center coord
+        self.coordmin_x   = self.coord_x - Decimal(self.coordrange_x)/2
+        self.coordmax_x   = self.coord_x + Decimal(self.coordrange_x)/2
     
+    def scroll(self, dx, dy):
+        """
+        Move the view by whole screen pixels, as dragging does: the contents move dx to the right and dy down.
+        The anchor moves along with them, so tiles drawn from now on line up exactly with those already on the screen once
+        it has scrolled (see ScreenStuff.scroll()).  Returns False if nothing has been drawn yet, so there is nothing to scroll.
+        """
+
+        window_x, window_y = screenstuff.window_dims()
+        self.set_coord(
+            coord_x = self.coord_x - Decimal(self.coordrange_x * dx / window_x),
+            coord_y = self.coord_y - Decimal(self.coordrange_y() * dy / window_y)
+        )
+        if self.anchor is None:
+            return False
+        view, row, col, draw_x, draw_y, tile_pixels = self.anchor
+        self.anchor = ((self.coordmin_x, self.coordmin_y(), view[2], view[3]), row, col, draw_x + dx, draw_y + dy, tile_pixels)
+        return True
+
     def zoom_factor(self):
         """
         Return how far we have zoomed in as a multiple.
@@ -215,7 +261,7 @@ class DrawingParams():
         """
         if not self.zoomlevel:
             return False
-        return bool(self.pixel_size() < 6.0e-17)    # approximate limit, visual errors apparent starting around here
+        return bool(self.pixel_size() < minimum_pixel_size)
         
     def y_axis_properties(self):
         """
@@ -223,8 +269,8 @@ class DrawingParams():
         """
         window_x, window_y = screenstuff.window_dims()
         coordrange_y = self.coordrange_x * window_y / window_x
-        coordmin_y = self.coord_y - coordrange_y/2
-        coordmax_y = self.coord_y + coordrange_y/2
+        coordmin_y = self.coord_y - Decimal(coordrange_y)/2
+        coordmax_y = self.coord_y + Decimal(coordrange_y)/2
 
         return coordrange_y, coordmin_y, coordmax_y
 
@@ -240,96 +286,225 @@ class DrawingParams():
         """
         return self.y_axis_properties()[1]
 
+    def pyramid_level(self):
+        """
+        Give the level of the tile pyramid that is shown (scaled) for this step in history (depends on current screen res).
+        """
+        window_x, _ = screenstuff.window_dims()
+        return pyramid_level(self.zoomlevel, window_x)
+
+    def max_recursion(self):
+        """
+        Give the max recursion of the tiles for this step in history (depends on current screen res), see recursion_for_level().
+        """
+        return recursion_for_level(self.pyramid_level(), self.recursion_boost)
+
     def get_rc_range(self):
         """
         Get the simcoord_per_tile, min_row, max_row, min_col, max_col for this step in history (depends on current screen res).
         The row/col values indicate the calculation/simulation/fractalspace tiles which are displayable.
         """
 
-        # this function defines the tiles which can be seen, which differ by zoom level and by window x dimention
-        # the tiles are defined on a coordinate system that extends from (-2,-2) to approximately (2,2) (note: 'minimum_fractalspace_coord')
-        # the tile coordinates that are valid should not be confused with the tile coordinates which can be seen
-        # for most zoom levels, the valid tiles extend beyond interesting fractal features, but it costs nothing for the coordinates to be valid
-
-        window_x, _ = screenstuff.window_dims()
         _, coordmin_y, coordmax_y = self.y_axis_properties()
-        #logger.info("coordmax_x=%f, coordmin_x=%f, coordmax_y=%f, coordmin_y=%f" % (self.coordmax_x, self.coordmin_x, coordmax_y, coordmin_y))
+        return tile_rc_range(pyramid_simcoord_per_tile(self.pyramid_level()), self.coordmin_x, self.coordmax_x, coordmin_y, coordmax_y)
 
-        # how much wider the calculation/simulation/fractalspace is than the screen can show (zoomlevel=0 -> wider_than_screen=1)
-        wider_than_screen = zoom_step_inv ** self.zoomlevel
+    def reference_orbit(self):
+        """
+        Get the ReferenceOrbit to compute tiles against, or None if plain doubles are precise enough at this zoom level.
+        The reference is kept while dragging around, until the center has moved more than a screen width away from it
+        (or the max recursion goes beyond it).  A new one is computed by reference_orbit_thread(), which takes a while
+        deep down, so this gives False until it is there.
+        """
 
-        tiles_per = wider_than_screen * window_x / tile_size
-        #logger.info("wider_than_screen=%f, tiles_per=%f" % (wider_than_screen, tiles_per))
-        simcoord_per_tile = 2.47 / tiles_per
-        min_row = int(floor((coordmin_y - minimum_fractalspace_coord[1]) / simcoord_per_tile))
-        max_row = int(floor((coordmax_y - minimum_fractalspace_coord[1]) / simcoord_per_tile))
-        min_col = int(floor((self.coordmin_x - minimum_fractalspace_coord[0]) / simcoord_per_tile))
-        max_col = int(floor((self.coordmax_x - minimum_fractalspace_coord[0]) / simcoord_per_tile))
-        #logger.info("simcoord_per_tile=%s, min_row=%d, max_row=%d, min_col=%d, max_col=%d" % (simcoord_per_tile, min_row, max_row, min_col, max_col))
-        return simcoord_per_tile, min_row, max_row, min_col, max_col
+        if not needs_perturbation(self.get_rc_range()[0]):
+            return None
+        max_recursion = self.max_recursion()
+        if self.reference is not None and self.reference_suits(self.reference.coord_x, self.reference.coord_y, self.reference.max_recursion):
+            return self.reference
+        if self.reference_wanted is None or not self.reference_suits(*self.reference_wanted[:3]):
+            self.reference_wanted = (self.coord_x, self.coord_y, max_recursion, self.pixel_size())
+            reference_queue.put(self)
+        return False
+
+    def reference_suits(self, coord_x, coord_y, max_recursion):
+        """
+        Return True if a reference orbit at the given point, with the given max recursion, will do for this step in history.
+        """
+        return max_recursion >= self.max_recursion() and \
+            abs(coord_x - self.coord_x) + abs(coord_y - self.coord_y) <= Decimal(self.coordrange_x)
 
     def get_cache_keys(self):
         """
         Get the cache keys which are displayable in this step in history (depends on current screen res).
+        The keys start with the pyramid level rather than the zoom level, so neighbouring zoom levels share their tiles, and end with the max recursion.
+        Tiles start out large (see top_tiles()), a tile that has been split is followed by its visible children, which are drawn over it.
         """
 
-        simcoord_per_tile, min_row, max_row, min_col, max_col = self.get_rc_range()
-        for r in range(min_row,max_row+1):
-            for c in range(min_col,max_col+1):
-                yield((self.zoomlevel,r,c,simcoord_per_tile))
-
-    def display_tile(self, workunit):
+        _, coordmin_y, coordmax_y = self.y_axis_properties()
+        ranges = {}
+        def visible(level):
+            if level not in ranges:
+                ranges[level] = tile_rc_range(pyramid_simcoord_per_tile(level), self.coordmin_x, self.coordmax_x, coordmin_y, coordmax_y)
+            return ranges[level]
+
+        level, size = top_tiles(self.pyramid_level())
+        max_recursion = self.max_recursion()
+        simcoord_per_tile, min_row, max_row, min_col, max_col = visible(level)
+        todo = [(level,r,c,simcoord_per_tile,size,max_recursion) for r in range(max_row,min_row-1,-1) for c in range(max_col,min_col-1,-1)]
+        while todo:
+            cache_key = todo.pop()
+            yield cache_key
+            if cache_key in tile_cache and tile_cache[cache_key].split:
+                _, min_row, max_row, min_col, max_col = visible(cache_key[0]+1)
+                todo.extend(reversed([child for child in tile_children(cache_key) if min_row <= child[1] <= max_row and min_col <= child[2] <= max_col]))
+
+    def display_tiles(self, workunits, within=None):
         """
-        Show the given tile on the screen.  The upper left is (0,0).
+        Show the given tiles on the screen, colorized with the current palette.  The upper left is (0,0).
+        Tiles come from the nearest level of the tile pyramid, so they are scaled to the screen's pixel size.
+        within, if given, is a list of (left, top, right, bottom) screen rectangles, and only the tiles touching one of them are shown.
         """
 
-        zoom_level, row, col, simcoord_per_tile = workunit.cache_key
-        assert zoom_level == self.zoomlevel, "Somehow got the wrong zoom level."
-        # NOTE: we theoretically are getting only tiles with the correct simcoord_per_tile, so we skip recalculating it
-
-        tile_simx = minimum_fractalspace_coord[0] + col * simcoord_per_tile
-        tile_simy = minimum_fractalspace_coord[1] + row * simcoord_per_tile
-        simcoord_per_pixel = simcoord_per_tile / tile_size
-        draw_x = (tile_simx - self.coordmin_x) / simcoord_per_pixel
-        draw_y = (tile_simy - self.coordmin_y()) / simcoord_per_pixel
-
-        if workunit.palette_idx != clickables['palette_idx']:
-            workunit.recolor(clickables['palette_idx'])
-        screenstuff.screen.blit(workunit.color_data, (draw_x,draw_y))
+        if not workunits:
+            return
+
+        # positions are counted in the smallest tiles of the shown level, every larger tile is a whole number of them across
+        # one tile is placed with the (slow, Decimal) calculation, the others are a whole number of tiles away from it
+        # the anchor is kept until the view changes, so tiles that arrive later line up exactly with the ones already shown
+        shown_level = self.pyramid_level()
+        simcoord_per_tile = pyramid_simcoord_per_tile(shown_level)
+        simcoord_per_pixel = self.pixel_size()
+        _, row, col, _, size, max_recursion = workunits[0].cache_key
+        view = (self.coordmin_x, self.coordmin_y(), simcoord_per_tile, simcoord_per_pixel)
+        if self.anchor is None or self.anchor[0] != view:
+            span = size // tile_size
+            draw_x, draw_y = tile_screen_position(row*span, col*span, simcoord_per_tile, self.coordmin_x, view[1], simcoord_per_pixel)
+            self.anchor = (view, row*span, col*span, draw_x, draw_y, simcoord_per_tile / simcoord_per_pixel)
+        _, anchor_row, anchor_col, anchor_x, anchor_y, tile_pixels = self.anchor
+
+        # the rows and columns of smallest tiles each rectangle touches, with one to spare on every side for the rounding of the edges
+        if within is not None:
+            ranges = [(int(floor((top-anchor_y)/tile_pixels)) + anchor_row - 1, int(floor((bottom-anchor_y)/tile_pixels)) + anchor_row + 1,
+                       int(floor((left-anchor_x)/tile_pixels)) + anchor_col - 1, int(floor((right-anchor_x)/tile_pixels)) + anchor_col + 1)
+                      for left, top, right, bottom in within]
+            def touches(cache_key):
+                _, row, col, _, size, _ = cache_key
+                span = size // tile_size
+                return any(min_row < (row+1)*span and row*span <= max_row and min_col < (col+1)*span and col*span <= max_col
+                           for min_row, max_row, min_col, max_col in ranges)
+            # the children of a split tile are drawn over it, so those of a tile that is drawn again must be as well
+            drawn = set()
+            for workunit in workunits:
+                key_level, key_row, key_col, key_simcoord_per_tile, key_size, key_max_recursion = workunit.cache_key
+                parent = (key_level-1, key_row//2, key_col//2, key_simcoord_per_tile*2, key_size*2, key_max_recursion)
+                if touches(workunit.cache_key) or parent in drawn:
+                    drawn.add(workunit.cache_key)
+            workunits = [workunit for workunit in workunits if workunit.cache_key in drawn]
+
+        # each edge is computed the same way for both tiles sharing it, so the scaled tiles neither overlap nor leave gaps
+        rects = []
+        for workunit in workunits:
+            level, row, col, _, size, _ = workunit.cache_key
+            span = size // tile_size
+            assert level + span.bit_length() - 1 == shown_level, "Somehow got the wrong pyramid level."
+            assert workunit.cache_key[5] == max_recursion, "Tiles with different max recursions in one draw."
+            rects.append((
+                int(floor(anchor_x + (col*span-anchor_col)*tile_pixels)), int(floor(anchor_y + (row*span-anchor_row)*tile_pixels)),
+                int(floor(anchor_x + ((col+1)*span-anchor_col)*tile_pixels)), int(floor(anchor_y + ((row+1)*span-anchor_row)*tile_pixels))))
+        screenstuff.draw_tiles([workunit.depth_data for workunit in workunits], rects, [workunit.cache_key[4] for workunit in workunits], max_recursion)
 
         
 
 class WorkUnit():
-    def __init__(self, cache_key):
-        self.cache_key = cache_key                   # tuple (zoom,row,col,simcoord_per_tile)
-        self.depth_data = b"0" * (tile_size*tile_size*2)   # store depth data of result here
-        self.color_data = None
-        self.palette_idx = None
-        self.used = time()
+    def __init__(self, cache_key, reference=None):
+        self.cache_key = cache_key                   # tuple (level,row,col,simcoord_per_tile,size,max_recursion)
+        self.reference = reference                   # ReferenceOrbit for deep zoom, or None
+        self.depth_data = cffi_compute.new_depth(cache_key[4], smooth_coloring, cffi_compute.wide_depth(cache_key[5]))   # store depth data of result here
+        self.generation = None  # the scheduler generation it was last queued in
+        self.taken = False      # becomes True when a worker thread has taken it from the scheduler
+        self.distance = 0       # squared (doubled) distance from the center of the screen when it was last queued
+        self.passes_done = 0    # progressive passes computed so far, the data is a preview until it is processed
         self.processed = False  # becomes True when data is processed
+        self.split = False      # becomes True (along with processed) when a large tile shows detail, its children are computed instead
         self.resolved = False   # becomes True when data has reached main thread
+        self.compute_seconds = 0.0   # time spent computing it so far (over all passes)
+        self.iterations = 0          # iterations the kernel did for it so far
+        self.depth_range = None      # the smallest and largest depth of its pixels that escaped, set when it is resolved (see judge_max_recursion())
+        self.failed = False          # becomes True if computing it raised an exception, it is then left as it is
 
     def compute(self):
         """
-        Compute the recursion level data for the given tile.
+        Compute the recursion level data for the given tile, or just its next pass when computing progressively.
+        A tile larger than tile_size is split instead when its first pass finds some (but not all) of its pixels black.
+        Smooth escape values are only computed by the pass kernels, so smooth_coloring uses them in 'subdivide' mode too.
+        Returns the seconds and kernel iterations this took, which are also added up on the WorkUnit.
         """
 
-        _, row, col, coord_per = self.cache_key
-        computelib.compute_tile(self.depth_data, row, col, coord_per)
-        self.recolor(clickables['palette_idx'])
+        start = perf_counter()
+        complete = True
+        _, row, col, coord_per, size, max_recursion = self.cache_key
+        computelib = kernels(max_recursion)
+        if smooth_coloring or (tile_mode != 'subdivide' and (progressive_strides or size > tile_size)):
+            strides = progressive_strides or (size, 1)          # without progressive passes, a large tile's border is still checked first
+            while True:
+                pass_stride = strides[self.passes_done]
+                prev_stride = strides[self.passes_done-1] if self.passes_done else 0
+                if self.reference is not None:
+                    dx, dy = self.reference.tile_delta(row, col, coord_per)
+                    complete = computelib.compute_tile_perturb_pass(self.depth_data, self.reference.orbit, self.reference.length, dx, dy, coord_per, pass_stride, prev_stride, smooth_coloring, size, max_recursion)
+                else:
+                    start_x, start_y = tile_origin(row, col, coord_per)
+                    complete = computelib.compute_tile_pass(self.depth_data, start_x, start_y, coord_per, pass_stride, prev_stride, smooth_coloring, size, max_recursion)
+                self.passes_done += 1
+                if not complete and self.passes_done == 1 and size > tile_size and computelib.count_depth(self.depth_data, size*size, max_recursion):
+                    self.split = complete = True                # the boundary of the set runs through it, its children may find black areas
+                if complete or progressive_strides:
+                    break
+        elif self.reference is not None:
+            dx, dy = self.reference.tile_delta(row, col, coord_per)
+            computelib.compute_tile_perturb(self.depth_data, self.reference.orbit, self.reference.length, dx, dy, coord_per, size, max_recursion)
+        elif tile_mode == 'subdivide':
+            start_x, start_y = tile_origin(row, col, coord_per)
+            computelib.compute_tile_subdivide(self.depth_data, start_x, start_y, coord_per, subdivide_min_size, size, max_recursion)
+        else:
+            start_x, start_y = tile_origin(row, col, coord_per)
+            computelib.compute_tile(self.depth_data, start_x, start_y, coord_per, size, max_recursion)
+        seconds = perf_counter() - start
+        iterations = computelib.take_iterations()
+        self.compute_seconds += seconds
+        self.iterations += iterations
+        self.processed = bool(complete)
+        return seconds, iterations
+
+    def job(self):
+        """
+        Describe the computation for a remote worker (see networker.py): mode, x, y, simcoord_per_tile, size, subdivide_min_size, max_recursion, reference.
+        x and y are the tile's smallest corner, or its offset from the ReferenceOrbit.  Remote workers compute large tiles whole, without splitting them.
+        """
+
+        _, row, col, coord_per, size, max_recursion = self.cache_key
+        smooth = MODE_SMOOTH if smooth_coloring else 0
+        if self.reference is not None:
+            dx, dy = self.reference.tile_delta(row, col, coord_per)
+            return MODE_PERTURB | smooth, dx, dy, coord_per, size, subdivide_min_size, max_recursion, self.reference
+        start_x, start_y = tile_origin(row, col, coord_per)
+        return (MODE_SUBDIVIDE if tile_mode == 'subdivide' else MODE_EDGE) | smooth, start_x, start_y, coord_per, size, subdivide_min_size, max_recursion, None
 
-    def recolor(self, palette_idx):
+    def drawable(self):
         """
-        Convert the pixel depth data into a pygame surface.  Not useful to call before compute() has run.
+        Whether there is anything to show yet: the finished tile, or a preview from the progressive passes so far.
+        A split tile is a preview of its children, unless it was not computed progressively (then it is little more than its border).
         """
 
-        self.palette_idx = palette_idx
-        palette_data = palettes[self.palette_idx]
-        palette_data_len = len(palette_data)//3
-        self.color_data = b"0" * (tile_size*tile_size*3)   # store binary pixel data, replaced by a pygame surface
-        computelib.colorize_tile(self.depth_data, self.color_data, palette_data, palette_data_len)
-        self.color_data = pygame.image.fromstring(self.color_data, (tile_size,tile_size), "RGB")
-        self.processed = True
+        if self.split:
+            return bool(progressive_strides)
+        return self.processed or self.passes_done > 0
+
+    def nbytes(self):
+        """
+        Roughly how much memory this takes, for the tile cache budget.  The fixed part is an estimate of the Python objects.
+        """
+        return cffi_compute.ffi.sizeof(self.depth_data) + 512
 
     def coord(self):
         """
@@ -348,6 +523,22 @@ class WorkUnit():
             
 
 
+def background_pattern(width, height):
+    """
+    Make a surface with faint diagonal lines, to show where tiles are still to come.
+    The pattern repeats every 8 pixels, so a band of 8 rows is made as bytes and repeated down the surface, rather than setting pixels one at a time.
+    """
+
+    rows = []
+    for y in range(8):
+        period = b"".join(b"\x18\x18\x18" if (x + y) % 8 == 0 or (x - y) % 8 == 0 else b"\x00\x00\x00" for x in range(8))
+        rows.append((period * (width // 8 + 1))[:width*3])
+    band = b"".join(rows)
+    pattern = (band * (height // 8 + 1))[:width*height*3]
+    return pygame.image.frombuffer(pattern, (width, height), 'RGB').convert()
+
+
+
 class ScreenStuff():
     """
     Handle setup of screen, and switching between windowed and fullscreen.
@@ -365,17 +556,15 @@ class ScreenStuff():
         self.window_x, self.window_y = pygame.display.get_surface().get_size()
 
         # provide a background pattern so we can see tiles fill in
-        self.blank_surface = pygame.surface.Surface(self.screen.get_size())
-        self.blank_surface.fill((0,0,0))
-        for x in range(self.window_x):
-            for y in range(self.window_y):
-                if (x + y) % 8 == 0 or (x - y) % 8 == 0:
-                    self.blank_surface.set_at((x, y), (24,24,24))
+        self.blank_surface = background_pattern(self.window_x, self.window_y)
+        self.overlays = []           # rectangles drawn over the tiles (the buttons), which scroll() must not leave behind
         self.clear()
 
-        # a larger cache size makes trimming it more time-consuming
-        self.cache_size = (self.window_x // tile_size + 1) * (self.window_y // tile_size + 1) * 8
-        logger.info("Set cache size: %d." % self.cache_size)
+        # tiles are colorized straight into the screen, which works for 3 and 4 byte pixels, anything else needs a go-between
+        if self.screen.get_bytesize() in (3,4):
+            self.frame_surface = None
+        else:
+            self.frame_surface = pygame.surface.Surface(self.screen.get_size(), 0, 32)
 
         # ensure we are not over-zoomed (probably by entering fullscreen when near or at the zoom limit)
         if drawing_params.last().max_zoomed():
@@ -405,6 +594,29 @@ class ScreenStuff():
 
     def window_dims(self):
         return self.window_x, self.window_y
+
+    def draw_tiles(self, depths, rects, sizes, max_recursion):
+        """
+        Colorize tiles (given as depth data, (left, top, right, bottom) screen rectangles and sizes) straight into the screen's pixels, all in one call.
+        The tiles must all have the given max recursion.
+        """
+
+        if not depths:
+            return
+
+        start = perf_counter()
+        target = self.frame_surface or self.screen
+        pixels = target.get_buffer()             # the surface is locked until this is released
+        cffi_compute.colorize_tiles(
+            kernels(max_recursion), depths, rects, sizes, max_recursion, palettes_for(max_recursion)[clickables['palette_idx']],
+            pixels, target.get_width(), target.get_height(), target.get_pitch(), target.get_bytesize(),
+            target.get_shifts()[:3], target.get_masks()[3])
+        del pixels
+        if self.frame_surface is not None:
+            self.screen.blits([(target, rect[:2], pygame.Rect(rect[0], rect[1], rect[2]-rect[0], rect[3]-rect[1])) for rect in rects], False)
+        metrics.time('draw_tiles', perf_counter() - start)
+        metrics.count('tiles_drawn', len(depths))
+        note_startup('first_tile')
     
     def clear(self):
         """
@@ -412,38 +624,59 @@ class ScreenStuff():
         """
         self.screen.blit(self.blank_surface, dest=(0,0))
 
+    def scroll(self, dx, dy):
+        """
+        Move the screen contents dx pixels to the right and dy down, filling the strips that come into view with our 'blank' image.
+        Returns the (left, top, right, bottom) rectangles whose tiles must be drawn again: those strips, and wherever the
+        overlays (drawn over the tiles) were moved to.
+        """
 
+        self.screen.scroll(dx, dy)
+        screen_rect = self.screen.get_rect()
+        damage = [
+            pygame.Rect(0 if dx > 0 else self.window_x + dx, 0, abs(dx), self.window_y),
+            pygame.Rect(0, 0 if dy > 0 else self.window_y + dy, self.window_x, abs(dy))
+        ]
+        damage.extend(overlay.move(dx, dy).clip(screen_rect) for overlay in self.overlays)
+        damage = [rect for rect in damage if rect.width and rect.height]
+        for rect in damage:
+            self.screen.blit(self.blank_surface, rect.topleft, rect)
+        self.overlays = []
+        metrics.count('screen_scrolls')
+        return [(rect.left, rect.top, rect.right, rect.bottom) for rect in damage]
 
-# start up the user interface
+
+
+# start up the user interface, while the kernels are loaded (or compiled, the first time) in the background
+kernels.preload(lambda: note_startup('kernels'))
 pygame.init()
 drawing_params = DrawingParamsHistory()
 screenstuff = ScreenStuff()
+note_startup('window')
 pygame.display.set_caption('Mandelbrot')
 font = pygame.font.Font(pygame.font.get_default_font(), 14)
 textcache = dict()
 
-def zap(x):
-    return ((x//4)%256,x//2%128,x%256)
 
-def edge(x):
-    if x < max_recursion-255: return (0,0,0)
-    return (x-(max_recursion-255),x-(max_recursion-255),x-(max_recursion-255))
 
-def tobytes(x):
-    data = bytearray(len(x)*3)
-    for idx,t in enumerate(x):
-        data[idx*3]   = t[0]
-        data[idx*3+1] = t[1]
-        data[idx*3+2] = t[2]
-    return bytes(data)
 
-palettes = [
-    [zap(x) for x in range(max_recursion)],
-    [(255,0,125),(255,0,255),(125,0,255),(0,0,255),(0,125,255),(0,255,255),(0,255,125),(0,255,0),(125,255,0),(255,255,0),(255,125,0),(255,0,0)],
-    [(255,0,0),(0,255,0),(0,0,255),(255,255,255)],
-    [edge(x) for x in range(max_recursion)]           # mostly to identify cases where we run out of recursion
-]
-palettes = [tobytes(x) for x in palettes]             # this results in one long byte string
+def palettes_for(max_recursion):
+    """
+    Give the palettes for tiles of the given max recursion, building them the first time.
+    """
+    if max_recursion not in palette_cache:
+        palette_cache[max_recursion] = build_palettes(max_recursion)
+    return palette_cache[max_recursion]
+
+
+
+def requeue(workunit):
+    """
+    Queue a WorkUnit that a worker has taken again, for its next pass (or another worker), unless it has been evicted from
+    the tile cache meanwhile: nobody would see it, and a new WorkUnit may have been queued for its cache key.
+    """
+    if tile_cache.peek(workunit.cache_key) is workunit:
+        scheduler.requeue(workunit, (workunit.passes_done, workunit.distance))
 
 
 
@@ -461,13 +694,27 @@ def start_worker_render_threads():
 
         try:
             while clickables['run']:
-                try:
-                    workunit = todo_queue.get(timeout=1.0)      # obtain a WorkUnit or get an exception
-                    workunit.compute()                          # generate pixel data
-                    done_queue.put(workunit)                    # let the main thread know data is available
-                except Empty:
+                workunit = scheduler.get(timeout=1.0)           # obtain a WorkUnit or None
+                if workunit is None:
                     logger.debug("Todo queue was empty.")
-                    sleep(0.1)
+                    continue
+                try:
+                    seconds, iterations = workunit.compute()    # generate pixel data
+                except Exception:
+                    workunit.failed = True                      # so the view does not wait for it, see handle_tiles()
+                    metrics.count('tiles_failed')
+                    logger.error("Computing tile %s failed." % (workunit.cache_key,))
+                    raise
+                metrics.count('worker_busy_seconds', seconds)
+                metrics.count('iterations', iterations)
+                if workunit.split:
+                    metrics.count('tiles_split')
+                elif workunit.processed:
+                    metrics.time('tile_compute', workunit.compute_seconds)
+                    metrics.count('tiles_computed')
+                done_queue.put(workunit)                        # let the main thread know data is available
+                if not workunit.processed:                      # a preview, queue it for the next pass behind the other previews
+                    requeue(workunit)
         except Exception as err:
             logger.error("Exception in worker thread.")
             logger.error(err,exc_info=True)
@@ -477,10 +724,54 @@ def start_worker_render_threads():
     # spawn threads according to how many CPUs (or SMT threads) are available
     # threading with not scale forever, but larger tiles will have lower overhead
     c = int(round(cpu_count() * 0.875))
+    metrics.set('worker_threads', min(32,c))
     for _ in range(min(32,c)):            # limit max threads to 32
         t = threading.Thread(target=worker_render_thread)
         t.daemon = True
         t.start()
+
+    def reference_orbit_thread():
+        """
+        Compute the reference orbits asked for by DrawingParams.reference_orbit(), one at a time.  Those asked for by views
+        that are no longer shown are skipped, the views ask again if they are shown again.
+        """
+
+        while clickables['run']:
+            try:
+                dpl = reference_queue.get(timeout=1.0)
+            except Empty:
+                continue
+            wanted = dpl.reference_wanted
+            if wanted is None:
+                continue
+            if dpl is not drawing_params.last():
+                dpl.reference_wanted = None
+                continue
+            start = perf_counter()
+            reference = ReferenceOrbit(*wanted)
+            metrics.time('reference_orbit', perf_counter() - start)
+            if dpl.reference_wanted is wanted:
+                dpl.reference = reference
+                dpl.reference_wanted = None
+
+    t = threading.Thread(target=reference_orbit_thread)
+    t.daemon = True
+    t.start()
+
+    # remote workers take WorkUnits from the same scheduler, in batches, and give them back if their connection is lost
+    def remote_finished(workunit):
+        workunit.processed = True
+        metrics.count('remote_tiles')
+        done_queue.put(workunit)
+
+    for address in remote_workers:
+        worker = RemoteWorker(
+            address, lambda timeout: scheduler.get(timeout=timeout), requeue,
+            remote_finished, large_tile_size, max_recursion_limit, remote_batch_size)
+        remote_connections.append(worker)
+        t = threading.Thread(target=worker.run, args=(lambda: clickables['run'],))
+        t.daemon = True
+        t.start()
     
 
 
@@ -596,7 +887,7 @@ def draw_text_labels():
         if not switch_colors_rect.collidepoint(coord): return False
         clickables['redraw'] = True
         clickables['palette_idx'] += 1
-        if clickables['palette_idx'] >= len(palettes): clickables['palette_idx'] = 0
+        if clickables['palette_idx'] >= len(palettes_for(drpa.max_recursion())): clickables['palette_idx'] = 0
         return True
     clickboxes.append(switch_colors)
     draw_button_box(mouse_coord, switch_colors_rect)
@@ -611,16 +902,15 @@ def draw_text_labels():
 
 def update_after_mouse_drag(mousecoord):
     clickables['dragstarttime'] = time()
-    clickables['redraw'] = True
     clickables['dragto'] = mousecoord
-    window_x, window_y = screenstuff.window_dims()
     drag_px = mousecoord[0] - clickables['mousedown'][0]   # positive means dragging right
     drag_py = mousecoord[1] - clickables['mousedown'][1]   # positive means dragging down
-    drpa = drawing_params.last()
-    drpa.set_coord(
-        coord_x = drpa.coord_x - drpa.coordrange_x * drag_px / window_x,
-        coord_y = drpa.coord_y - drpa.coordrange_y() * drag_py / window_y
-    )
+    if drawing_params.last().scroll(drag_px, drag_py):
+        # the screen is scrolled rather than redrawn, see handle_input()
+        scroll_x, scroll_y = clickables['scroll']
+        clickables['scroll'] = (scroll_x + drag_px, scroll_y + drag_py)
+    else:
+        clickables['redraw'] = True
     clickables['mousedown'] = mousecoord
 
 
@@ -691,7 +981,7 @@ def handle_right_mouse_button_up():
     drawing_params.add(
         coord_x      = (simx1 + simx2) / 2,
         coord_y      = (simy1 + simy2) / 2,
-        zoomlevel    = screen_w_to_zoom_level(abs(simx1 - simx2))
+        zoomlevel    = screen_w_to_zoom_level(float(abs(simx1 - simx2)))
     )
 
 
@@ -702,7 +992,13 @@ def handle_input():
     """
 
     clickboxes = draw_text_labels()            # show the buttons and status fields
+    window_x, _ = screenstuff.window_dims()
+    screenstuff.overlays = [pygame.Rect(0, 0, window_x, clickables['text_hieght'])]
+    if clickables['metrics_overlay']:
+        screenstuff.overlays.append(draw_metrics_overlay())
+    start = perf_counter()
     pygame.display.flip()                      # display all the stuff to the user
+    flip_seconds = perf_counter() - start
 
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
@@ -721,6 +1017,10 @@ def handle_input():
             elif event.key == pygame.K_f:                                                   # F for fullscreen toggle
                 clickables['fullscreen'] = not clickables['fullscreen']
                 screenstuff.setup_screen(clickables['fullscreen'])
+            elif event.key == pygame.K_m:                                                   # M for the metrics overlay
+                clickables['metrics_overlay'] = not clickables['metrics_overlay']
+                if not clickables['metrics_overlay']:
+                    clickables['redraw'] = True                                 # paint the tiles back over it
             elif event.key in (pygame.K_MINUS,pygame.K_KP_MINUS):
                 keys = pygame.key.get_pressed()
                 amount = 5 if keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT] else 1
@@ -733,16 +1033,16 @@ def handle_input():
                 logger.info("Zoom in.")
             elif event.key == pygame.K_UP:
                 logger.info("Pan up.")
-                drawing_params.add(coord_y = (drpa.coord_y - drpa.coordrange_y() / 8))
+                drawing_params.add(coord_y = (drpa.coord_y - Decimal(drpa.coordrange_y() / 8)))
             elif event.key == pygame.K_DOWN:
                 logger.info("Pan down.")
-                drawing_params.add(coord_y = (drpa.coord_y + drpa.coordrange_y() / 8))
+                drawing_params.add(coord_y = (drpa.coord_y + Decimal(drpa.coordrange_y() / 8)))
             elif event.key == pygame.K_LEFT:
                 logger.info("Pan left.")
-                drawing_params.add(coord_x = (drpa.coord_x - drpa.coordrange_x / 8))
+                drawing_params.add(coord_x = (drpa.coord_x - Decimal(drpa.coordrange_x / 8)))
             elif event.key == pygame.K_RIGHT:
                 logger.info("Pan right.")
-                drawing_params.add(coord_x = (drpa.coord_x + drpa.coordrange_x / 8))
+                drawing_params.add(coord_x = (drpa.coord_x + Decimal(drpa.coordrange_x / 8)))
         elif event.type == pygame.MOUSEBUTTONDOWN:
             posnow = pygame.mouse.get_pos()
             if event.button == pygame.BUTTON_LEFT:
@@ -768,9 +1068,86 @@ def handle_input():
             logger.info("Autozoom.")
             drawing_params.add(zoomlevel = drawing_params.last().zoomlevel + 1)
 
+    # dragging scrolls what is on the screen, so only the tiles coming into view need drawing (see handle_tiles())
+    # a scroll as large as the window leaves nothing to keep, so it is a full redraw
+    scroll_x, scroll_y = clickables['scroll']
+    clickables['scroll'] = (0,0)
+    window_x, window_y = screenstuff.window_dims()
+    if abs(scroll_x) >= window_x or abs(scroll_y) >= window_y:
+        clickables['redraw'] = True
     if clickables['redraw']:
         screenstuff.clear()
-        
+        clickables['damage'] = []
+    elif scroll_x or scroll_y:
+        clickables['damage'].extend(screenstuff.scroll(scroll_x, scroll_y))
+
+    return flip_seconds
+
+
+
+def draw_metrics_overlay():
+    """
+    Draw the most interesting metrics in the lower left corner of the screen, and return the rectangle it takes.
+    The text changes every frame, so it is not kept in the text box cache.
+    """
+
+    snapshot = metrics.snapshot()
+    gauges, timings = snapshot['gauges'], snapshot['timings']
+    def mean_ms(name):
+        return timings[name]['mean'] * 1000 if name in timings else 0.0
+    def last_ms(name):
+        return timings[name]['last'] * 1000 if name in timings else 0.0
+    lines = [
+        'frame %.01f ms: tiles %.01f, input %.01f, flip %.01f' % (last_ms('frame'), last_ms('frame_tiles'), last_ms('frame_input'), last_ms('frame_flip')),
+        'tile compute %.02f ms mean, %.0f tiles/s, %.01f Miterations/s' % (mean_ms('tile_compute'), gauges.get('tiles_per_second', 0), gauges.get('iterations_per_second', 0)/1e6),
+        'workers %d, %.0f%% busy' % (gauges.get('worker_threads', 0), gauges.get('worker_utilisation', 0)*100),
+        'queued %d, done %d, dropped %d' % (gauges.get('scheduler_depth', 0), gauges.get('done_queue_depth', 0), gauges.get('scheduler_dropped', 0)),
+        'cache %d tiles, %.01f MiB, %.01f%% hits' % (gauges.get('cache_entries', 0), gauges.get('cache_bytes', 0)/2**20, gauges.get('cache_hit_rate', 0)*100),
+    ]
+    spacing = 4
+    surfaces = [font.render(line, True, (255,255,255), (0,0,0)) for line in lines]
+    width = max(surface.get_width() for surface in surfaces) + spacing*2
+    height = sum(surface.get_height() for surface in surfaces) + spacing*2
+    _, window_y = screenstuff.window_dims()
+    top = window_y - height - 10
+    rect = pygame.Rect(10, top, width, height)
+    screenstuff.screen.fill((0,0,0), rect)
+    for surface in surfaces:
+        screenstuff.screen.blit(surface, dest=(10+spacing, top+spacing))
+        top += surface.get_height()
+    return rect
+
+
+
+def update_metrics():
+    """
+    Set the gauges that are sampled rather than counted: queue depths, cache use and rates since the last update.
+    """
+
+    now = perf_counter()
+    busy, tiles, iterations = metrics.counter('worker_busy_seconds'), metrics.counter('tiles_computed'), metrics.counter('iterations')
+    last = clickables['metrics_last']
+    clickables['metrics_last'] = (now, busy, tiles, iterations)
+    if last is None:
+        return
+    if now - last[0] < 1.0:
+        clickables['metrics_last'] = last    # rates over at least a second, or they are mostly noise
+        return
+
+    seconds = now - last[0]
+    threads = metrics.gauge('worker_threads', 1)
+    stats = tile_cache.stats()
+    metrics.set('scheduler_depth', len(scheduler))
+    metrics.set('scheduler_dropped', scheduler.dropped)
+    metrics.set('done_queue_depth', done_queue.qsize())
+    metrics.set('visible_tiles', clickables['num_visible_tiles'])
+    metrics.set('work_remains', clickables['work_remains'])
+    metrics.set('cache_entries', stats['entries'])
+    metrics.set('cache_bytes', stats['bytes'])
+    metrics.set('cache_hit_rate', stats['hit_rate'])
+    metrics.set('worker_utilisation', (busy - last[1]) / (seconds * max(1, threads)))
+    metrics.set('tiles_per_second', (tiles - last[2]) / seconds)
+    metrics.set('iterations_per_second', (iterations - last[3]) / seconds)
 
 
 def handle_tiles():
@@ -781,32 +1158,66 @@ def handle_tiles():
     timeout = time() + 1/30
 
     dpl = drawing_params.last()
+    reference = dpl.reference_orbit()
     drawworthy_cache_keys = list(dpl.get_cache_keys())
-    shuffle(drawworthy_cache_keys)
+    drawworthy = set(drawworthy_cache_keys)
     clickables['num_visible_tiles'] = len(drawworthy_cache_keys)
-    logger.debug("There are %d visible tiles." % clickables['num_visible_tiles'])
-
-    # identify tiles that should be processed, send them into the machinery
+    logger.debug("There are %d visible tiles.", clickables['num_visible_tiles'])
+
+    # a new view puts everything queued so far behind the tiles that are visible now
+    # lookups also only count towards the cache hit/miss counters when the view has changed, not on every frame
+    # the view is told by the smallest tiles it would take, the visible tiles change by themselves as large ones are split
+    _, min_row, max_row, min_col, max_col = dpl.get_rc_range()
+    view = (dpl.zoomlevel, min_row, max_row, min_col, max_col)
+    view_changed = view != clickables['view']
+    clickables['view'] = view
+    if view_changed:
+        scheduler.new_generation()
+        clickables['view_center'] = (min_row+max_row, min_col+max_col)   # doubled, to stay in (exact) integers, counted in the smallest tiles
+
+    # identify tiles that should be processed, send them into the machinery, closest to the center of the screen first
+    # tiles computed progressively are queued by pass first, so the whole screen gets a preview before any of it is refined
+    center_row2, center_col2 = clickables['view_center']
     clickables['work_remains'] = 0
     for cache_key in drawworthy_cache_keys:
-        if cache_key in tile_cache:
-            if not (tile_cache[cache_key].processed and tile_cache[cache_key].resolved):
+        workunit = tile_cache.get(cache_key, view_changed)    # also marks it as recently used
+        if workunit is None:
+            if reference is False:             # still being computed, the tiles are made once it is there
                 clickables['work_remains'] += 1
-        else:
-            wu = WorkUnit(cache_key)
-            tile_cache[cache_key] = wu   # created with processed=False
-            todo_queue.put(wu)
+                continue
+            workunit = WorkUnit(cache_key, reference)
+            tile_cache[cache_key] = workunit   # created with processed=False
+            if tile_pack is not None and tile_pack.load(workunit):
+                workunit.processed = True
+                metrics.count('disk_tiles')
+                done_queue.put(workunit)       # found on disk, skip the workers
+            metrics.count('tiles_queued')
+        if workunit.failed:
+            continue
+        if not workunit.processed and workunit.generation != scheduler.generation:
+            span = cache_key[4] // tile_size
+            workunit.distance = ((2*cache_key[1]+1)*span - 1 - center_row2)**2 + ((2*cache_key[2]+1)*span - 1 - center_col2)**2
+            scheduler.submit(workunit, (workunit.passes_done, workunit.distance))
+        if not (workunit.processed and workunit.resolved):
             clickables['work_remains'] += 1
-            clickables['queue_debug']['in'] += 1
-    logger.debug("There are %d tiles to work on." % clickables['work_remains'])
+    logger.debug("There are %d tiles to work on.", clickables['work_remains'])
 
-    # support full redraws in case the need arises
+    # once the view is complete, see whether its max recursion suits it
+    if not clickables['work_remains'] and dpl.recursion_judged != (view, dpl.max_recursion()):
+        judge_max_recursion(dpl, view, drawworthy_cache_keys)
+
+    # after a scroll only the tiles in the strips that came into view (and where the buttons were moved to) are drawn again
+    if clickables['damage']:
+        dpl.display_tiles([tile_cache[cache_key] for cache_key in drawworthy_cache_keys if cache_key in tile_cache and tile_cache[cache_key].drawable()], clickables['damage'])
+        clickables['damage'] = []
+
+    # support full redraws in case the need arises (this is also how palette switches are shown)
     if clickables['redraw']:
+        workunits = []
         for cache_key in drawworthy_cache_keys:
-            if cache_key in tile_cache and tile_cache[cache_key].processed:
-                workunit = tile_cache[cache_key]
-                workunit.used = time()
-                dpl.display_tile(workunit)
+            if cache_key in tile_cache and tile_cache[cache_key].drawable():
+                workunits.append(tile_cache[cache_key])
+        dpl.display_tiles(workunits)
         clickables['redraw'] = False
         clickables['autozoom_pause_start'] = None
     elif not clickables['work_remains']:
@@ -814,57 +1225,138 @@ def handle_tiles():
     else:
         clickables['autozoom_pause_start'] = None
 
-    # clean up excessive cached images
-    if time() < timeout and len(tile_cache) > screenstuff.cache_size:
-        how_many = max(1,(len(tile_cache) - screenstuff.cache_size)//8)
-        logger.debug("Trim %d items from cache." % how_many)
-        workunits = sorted(tile_cache.values(), key=lambda x: x.used)
-        while how_many:
-            how_many -= 1
-            del tile_cache[workunits[how_many].cache_key]
-    logger.debug("There are %d items defined in cache." % len(tile_cache))
+    # forget the least recently used tiles beyond the memory budget, but never the visible ones (they were just used)
+    evicted = tile_cache.trim(keep=len(drawworthy_cache_keys))
+    if evicted:
+        logger.debug("Trimmed %d items from cache.", evicted)
+        metrics.count('cache_evictions', evicted)
     
-    # see if there are any tiles to show
+    # see if there are any tiles to show, they are drawn together once the done queue is empty or time runs out
+    # a tile computed progressively comes through once per pass, and is resolved once it comes through processed
     if clickables['work_remains']:
+        workunits = []
         try:
             while True:
                 workunit = done_queue.get_nowait()
-                assert workunit.processed, "Work unit should be marked as processed."
-                assert not workunit.resolved, "Work unit should not be marked as resolved."
-                workunit.resolved = True
-                clickables['queue_debug']['out'] += 1
+                assert workunit.processed or workunit.passes_done, "Work unit should have some data."
+                if workunit.processed and not workunit.resolved:
+                    workunit.resolved = True
+                    workunit.depth_range = tile_depth_range(workunit)
+                    metrics.count('tiles_resolved')
 
                 if workunit.cache_key not in tile_cache:
                     logger.warning("Got a work unit that wasn't in the cache.")
                     continue
-                if workunit.cache_key in drawworthy_cache_keys:
-                    workunit.used = time()
-                    dpl.display_tile(workunit)
+                if workunit.cache_key in drawworthy and workunit.drawable():
+                    workunits.append(workunit)
                 if time() >= timeout:
                     break
         except Empty:
             logger.debug("Empty done queue.")
             sleep(1/64)
+        dpl.display_tiles(workunits)
     else:
         logger.debug("Avoid using CPU.")
         sleep(1/64)    # avoid using CPU for nothing
 
-    logger.debug("Into the queue: %d, out of the queue: %d" % (clickables['queue_debug']['in'],clickables['queue_debug']['out']))
+
+
+def tile_depth_range(workunit):
+    """
+    Give the smallest and largest depth of the pixels of a tile that escaped, or (max_recursion, 0) if none did.
+    """
+    _, _, _, _, size, max_recursion = workunit.cache_key
+    depth_range = cffi_compute.ffi.new("int[2]")
+    kernels(max_recursion).depth_range(workunit.depth_data, size*size, max_recursion, depth_range)
+    return tuple(depth_range)
+
+
+
+def judge_max_recursion(dpl, view, cache_keys):
+    """
+    Look at the depths of a complete view's tiles and move the max recursion if they say so (see recursion_adjustment()).
+    A view that needs more is shown again with twice as much, the tiles it has stay on the screen until they are replaced.
+    One that could do with less keeps what it has, but the views that follow start lower.
+    """
+
+    max_recursion = dpl.max_recursion()
+    dpl.recursion_judged = (view, max_recursion)
+    lowest, highest = max_recursion, 0
+    for cache_key in cache_keys:
+        workunit = tile_cache.get(cache_key, False)
+        if workunit is None or workunit.split or workunit.depth_range is None:
+            continue
+        lowest = min(lowest, workunit.depth_range[0])
+        highest = max(highest, workunit.depth_range[1])
+
+    step = recursion_adjustment(max_recursion, lowest, highest)
+    boost = min(recursion_boost_range[1], max(recursion_boost_range[0], dpl.recursion_boost + step))
+    if boost == dpl.recursion_boost:
+        return
+    clickables['recursion_boost'] = boost
+    if step > 0:
+        dpl.recursion_boost = boost
+        metrics.count('recursion_raised')
+    logger.info("Max recursion %d, escaped depths %d to %d, views now start at %d." % (max_recursion, lowest, highest, recursion_for_level(dpl.pyramid_level(), boost)))
+
+
+
+def spill_to_disk(workunit):
+    """
+    Keep a tile that is evicted from the tile cache in the tile pack, so it need not be computed again.
+    A split tile is not kept, it is little use without its children and quick to split again.
+    """
+    if workunit.processed and not workunit.split:
+        tile_pack.store(workunit)
 
 
 
 def main():
+    global tile_pack
+    assert not progressive_strides or (progressive_strides[-1] == 1 and all(a % b == 0 for a, b in zip(progressive_strides, progressive_strides[1:]))), \
+        "Progressive strides should each divide the one before and end with 1."
+    if disk_cache_dir:
+        tile_pack = TilePack(disk_cache_dir, tile_size, tile_mode, smooth_coloring)
+        tile_cache.on_evict = spill_to_disk
+    tile_cache.max_bytes = memory_cache_bytes
+
     start_worker_render_threads()
+    exporter = None
+    if metrics_file or metrics_port:
+        exporter = MetricsExporter(metrics, metrics_file, metrics_port, metrics_interval)
+        exporter.start()
 
     # run until the user asks to quit
     while clickables['run']:
-        t1 = time()
+        t1 = perf_counter()
         handle_tiles()
-        t2 = time()
-        handle_input()
-        t3 = time()
-        logger.debug("Spent %.02fs handling tiles, %.02fs handling input, %.02fs on both." % (t2-t1,t3-t2,t3-t1))
-    
+        t2 = perf_counter()
+        flip_seconds = handle_input()
+        t3 = perf_counter()
+        metrics.time('frame_tiles', t2-t1)
+        metrics.time('frame_input', t3-t2-flip_seconds)
+        metrics.time('frame_flip', flip_seconds)
+        metrics.time('frame', t3-t1)
+        update_metrics()
+
+    if exporter is not None:
+        exporter.stop()
+
+    stats = tile_cache.stats()
+    logger.info("Tile cache: %d tiles in %.01f of %.01f MiB, %d hits, %d misses (%.01f%% hit rate), %d evictions." % (
+        stats['entries'], stats['bytes']/2**20, stats['max_bytes']/2**20, stats['hits'], stats['misses'], stats['hit_rate']*100, stats['evictions']))
+    for worker in remote_connections:
+        stats = worker.stats()
+        logger.info("Remote worker %s: %d tiles in %.01fs connected (%.01f tiles/s), %d connects, %d failures." % (
+            stats['worker'], stats['tiles'], stats['connected_seconds'], stats['tiles_per_second'], stats['connects'], stats['failures']))
+
+    # keep what we have for next time
+    if tile_pack is not None:
+        for workunit in list(tile_cache.values()):
+            spill_to_disk(workunit)
+        logger.info("There are %d tiles stored on disk." % len(tile_pack))
+        tile_pack.close()
+
     pygame.quit()
 
 
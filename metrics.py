@@ -0,0 +1,166 @@
+"""
+This file is a library that collects runtime metrics (counters, gauges and timings) and makes them available as JSON or
+Prometheus-style text, written to a file every few seconds and/or served over HTTP on a local port.
+
+Counters only go up (tiles computed, iterations), gauges are a current value (queue depths, hit rates) and timings keep the
+count, sum and last value of some duration (tile compute time, frame time).  Everything may be updated from any thread.
+"""
+
+from time import time, sleep
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading, json, os
+import logging
+
+
+
+logger = logging.getLogger('metrics')
+
+
+
+class Metrics():
+    """
+    A set of named metrics, shared between threads.
+    """
+
+    def __init__(self, prefix='mandelbrot_'):
+        self.prefix = prefix             # for Prometheus names
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}                # name -> [count, sum, last]
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def time(self, name, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = seconds
+
+    def counter(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def gauge(self, name, default=0):
+        with self.lock:
+            return self.gauges.get(name, default)
+
+    def snapshot(self):
+        """
+        Give a copy of everything, as a dict of dicts.
+        """
+
+        with self.lock:
+            return {
+                'time': time(),
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {name: {'count': count, 'sum': total, 'last': last, 'mean': total / count if count else 0.0}
+                            for name, (count, total, last) in self.timings.items()}
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Give the metrics in the Prometheus text exposition format (timings are in seconds).
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("# TYPE %s%s_total counter" % (self.prefix, name))
+            lines.append("%s%s_total %r" % (self.prefix, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append("# TYPE %s%s gauge" % (self.prefix, name))
+            lines.append("%s%s %r" % (self.prefix, name, value))
+        for name, timing in sorted(snapshot['timings'].items()):
+            lines.append("# TYPE %s%s_seconds summary" % (self.prefix, name))
+            lines.append("%s%s_seconds_count %d" % (self.prefix, name, timing['count']))
+            lines.append("%s%s_seconds_sum %r" % (self.prefix, name, timing['sum']))
+        return "\n".join(lines) + "\n"
+
+
+
+class MetricsExporter():
+    """
+    Make metrics available outside the program: written to a file every interval seconds (as JSON if the name ends
+    in .json, Prometheus text otherwise) and/or served over HTTP on a port of localhost (/metrics as Prometheus text,
+    /metrics.json as JSON).
+    """
+
+    def __init__(self, metrics, path=None, port=None, interval=5.0):
+        self.metrics = metrics
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.server = None
+
+    def start(self):
+        if self.path:
+            t = threading.Thread(target=self.write_periodically)
+            t.daemon = True
+            t.start()
+            logger.info("Writing metrics to %s every %.01fs." % (self.path, self.interval))
+        if self.port:
+            metrics = self.metrics
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path == '/metrics':
+                        body, kind = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+                    elif self.path == '/metrics.json':
+                        body, kind = metrics.to_json(), 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    body = body.encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', kind)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args):
+                    pass                     # not every scrape in the log
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self.server.daemon_threads = True
+            t = threading.Thread(target=self.server.serve_forever)
+            t.daemon = True
+            t.start()
+            logger.info("Serving metrics on http://127.0.0.1:%d/metrics" % self.server.server_address[1])
+
+    def write(self):
+        """
+        Write the metrics file now, replacing the old one in one step so readers never see half of it.
+        """
+
+        text = self.metrics.to_json() if self.path.endswith('.json') else self.metrics.to_prometheus()
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(self.path + '.tmp', self.path)
+
+    def write_periodically(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.write()
+            except OSError as err:
+                logger.warning("Could not write metrics: %s" % err)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+        if self.path:
+            self.write()
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
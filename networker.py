@@ -0,0 +1,487 @@
+"""
+Compute tiles for other machines over TCP.  Run this on each render node, then list the nodes in remote_workers in mandelbrot.py.
+
+Example: python3 networker.py --host 0.0.0.0 --port 7433
+
+It listens on 127.0.0.1 unless told otherwise, there is no authentication, so only open it to a network you trust.
+
+This file is also the library for the other end, RemoteWorker feeds one of these daemons with WorkUnits from the scheduler.
+
+Every message is a header (kind, payload length) and a payload, all little-endian.  The client says hello (protocol version,
+largest tile size, largest max recursion) and the worker answers with its number of threads.  Jobs are then sent in batches,
+each giving the tile's corner coordinate (or its offset from a reference orbit, which is sent once beforehand), extent, size
+in pixels and max recursion, and results come back in batches too, as the job id followed by the tile's depth data (16-bit
+values, 32-bit beyond a max recursion of 65535, then a byte per pixel for the fractions when the job asks for smooth escape values).
+"""
+
+from time import time, sleep
+from queue import SimpleQueue, Empty
+from multiprocessing import cpu_count
+from collections import OrderedDict
+from array import array
+import argparse, threading, socket, struct, sys
+import logging
+
+import cffi_compute
+from cffi_compute import new_depth, depth_buffer
+
+
+
+logger = logging.getLogger('networker')
+
+default_port = 7433
+protocol_version = 3
+max_references = 16          # reference orbits a worker keeps per connection, the client sends a new one once it has sent this many
+max_message_size = 64 << 20  # bytes, a longer message ends the connection (see recv_message()), results are split to stay below it
+
+MSG_HELLO, MSG_REFERENCE, MSG_JOBS, MSG_RESULTS = 1, 2, 3, 4
+MODE_EDGE, MODE_SUBDIVIDE, MODE_PERTURB = 0, 1, 2
+MODE_SMOOTH = 4                          # or-ed into the mode for smooth escape values, see cffi_compute.new_depth()
+
+header = struct.Struct("<BI")            # kind, payload length
+hello = struct.Struct("<III")            # protocol version, largest tile size, largest max recursion
+hello_reply = struct.Struct("<II")       # protocol version, threads
+reference_header = struct.Struct("<II")  # reference id, orbit length (points), followed by the orbit
+job = struct.Struct("<QBdddHHII")        # job id, mode, x, y, simcoord_per_tile, tile size, subdivide min size, max recursion, reference id
+result_header = struct.Struct("<Q")      # job id, followed by the depth data
+
+
+
+def recv_exact(sock, n):
+    """
+    Read exactly n bytes from the socket, raising ConnectionError if it closes first.
+    """
+
+    data = bytearray(n)
+    view = memoryview(data)
+    got = 0
+    while got < n:
+        count = sock.recv_into(view[got:])
+        if not count:
+            raise ConnectionError("Connection closed.")
+        got += count
+    return data
+
+
+
+def recv_message(sock, max_size=max_message_size):
+    """
+    Read one message, returning (kind, payload).  Raises ConnectionError if the header claims more than max_size bytes.
+    """
+    kind, length = header.unpack(recv_exact(sock, header.size))
+    if length > max_size:
+        raise ConnectionError("Message %d is %d bytes long, more than the %d allowed." % (kind, length, max_size))
+    return kind, recv_exact(sock, length)
+
+
+
+def send_message(sock, kind, payload):
+    sock.sendall(header.pack(kind, len(payload)) + payload)
+
+
+
+def max_reference_length(max_recursion):
+    """
+    Give the most points a reference orbit for the given max recursion can have, Z_0 included.
+    """
+    return max_recursion + 1
+
+
+
+def depth_typecode(depth_data):
+    """
+    Give the array module's type code for the values of the given depth data.
+    """
+    return 'I' if cffi_compute.ffi.sizeof(cffi_compute.ffi.typeof(depth_data).item) == 4 else 'H'
+
+
+
+def depth_to_wire(depth_data):
+    """
+    Give depth data as little-endian bytes.
+    """
+    if sys.byteorder == 'little':
+        return bytes(depth_buffer(depth_data))
+    values = array(depth_typecode(depth_data), bytes(depth_buffer(depth_data)))
+    values.byteswap()
+    return values.tobytes()
+
+
+
+def depth_from_wire(depth_data, data):
+    """
+    Fill depth data from little-endian bytes.
+    """
+    if sys.byteorder == 'little':
+        depth_buffer(depth_data)[:] = data
+    else:
+        values = array(depth_typecode(depth_data), bytes(data))
+        values.byteswap()
+        depth_buffer(depth_data)[:] = values.tobytes()
+
+
+
+class WorkerConnection():
+    """
+    The worker's side of one client connection.  Jobs go into the shared job queue, results are sent back in batches by a thread of their own.
+    """
+
+    def __init__(self, sock, address, jobs, threads):
+        self.sock = sock
+        self.address = address
+        self.jobs = jobs                 # shared by all connections, holds (connection, job tuple, (orbit, length) or None)
+        self.threads = threads
+        self.outbox = SimpleQueue()      # (job id, depth bytes), or None to stop the sender
+        self.references = OrderedDict()  # reference id -> (orbit, length)
+        self.closed = False
+        self.tile_size = None
+        self.max_recursion = None
+
+    def serve(self):
+        """
+        Handle the connection until it closes.
+        """
+
+        sender = threading.Thread(target=self.send_results, daemon=True)
+        try:
+            kind, payload = recv_message(self.sock, hello.size)
+            version, self.tile_size, self.max_recursion = hello.unpack(payload)
+            if (kind != MSG_HELLO or version != protocol_version or not 0 < self.tile_size <= cffi_compute.max_tile_size
+                    or reference_header.size + max_reference_length(self.max_recursion) * 16 > max_message_size):
+                logger.warning("Refusing %s: version %d, tile size %d, max recursion %d." % (self.address, version, self.tile_size, self.max_recursion))
+                return
+            send_message(self.sock, MSG_HELLO, hello_reply.pack(protocol_version, self.threads))
+            logger.info("Serving %s (tiles up to %d, max recursion up to %d)." % (self.address, self.tile_size, self.max_recursion))
+            sender.start()
+
+            while True:
+                kind, payload = recv_message(self.sock)
+                if kind == MSG_REFERENCE:
+                    ref_id, length = reference_header.unpack_from(payload)
+                    if not 2 <= length <= max_reference_length(self.max_recursion) or len(payload) != reference_header.size + length * 16:
+                        logger.warning("Reference %d from %s has %d points in %d bytes, dropping the connection." % (ref_id, self.address, length, len(payload)))
+                        return
+                    self.references[ref_id] = (bytes(payload[reference_header.size:]), length)
+                    while len(self.references) > max_references:
+                        self.references.popitem(last=False)
+                elif kind == MSG_JOBS:
+                    if len(payload) % job.size:
+                        logger.warning("Job batch from %s is %d bytes, dropping the connection." % (self.address, len(payload)))
+                        return
+                    for offset in range(0, len(payload), job.size):
+                        jobtuple = job.unpack_from(payload, offset)
+                        reference = None
+                        if (jobtuple[1] & ~MODE_SMOOTH) == MODE_PERTURB:
+                            # looked up now, so the job keeps its orbit even if later references push it out
+                            reference = self.references.get(jobtuple[8])
+                            if reference is None:
+                                logger.warning("Job %d from %s uses unknown reference %d, dropping the connection." % (jobtuple[0], self.address, jobtuple[8]))
+                                return
+                        self.jobs.put((self, jobtuple, reference))
+                else:
+                    logger.warning("Unexpected message %d from %s." % (kind, self.address))
+                    return
+        except (ConnectionError, OSError, struct.error) as err:
+            logger.info("Connection from %s ended: %s" % (self.address, err))
+        finally:
+            self.closed = True
+            self.outbox.put(None)
+            self.sock.close()
+
+    def send_results(self):
+        """
+        Send whatever results are ready as one message, so a busy worker does not send a message per tile.
+        """
+
+        try:
+            while True:
+                item = self.outbox.get()
+                if item is None:
+                    return
+                parts = []
+                size = 0
+                while item is not None:
+                    if parts and size + result_header.size + len(item[1]) > max_message_size:
+                        send_message(self.sock, MSG_RESULTS, b"".join(parts))
+                        parts = []
+                        size = 0
+                    parts.append(result_header.pack(item[0]))
+                    parts.append(item[1])
+                    size += result_header.size + len(item[1])
+                    try:
+                        item = self.outbox.get_nowait()
+                    except Empty:
+                        item = None
+                send_message(self.sock, MSG_RESULTS, b"".join(parts))
+        except OSError as err:
+            logger.info("Sending to %s failed: %s" % (self.address, err))
+
+
+
+def worker_compute_thread(kernels, jobs):
+    """
+    Compute jobs from any connection, and hand the results to that connection.
+    """
+
+    depths = {}                      # a depth buffer per tile size, smoothness and width
+    while True:
+        connection, (job_id, mode, x, y, simcoord_per_tile, tile_size, subdivide_min_size, max_recursion, ref_id), reference = jobs.get()
+        if connection.closed:
+            continue
+        if not (0 < tile_size <= connection.tile_size and 0 < max_recursion <= connection.max_recursion):
+            logger.error("Job %d from %s has tile size %d and max recursion %d, dropping the connection." % (job_id, connection.address, tile_size, max_recursion))
+            connection.sock.close()
+            continue
+        smooth = bool(mode & MODE_SMOOTH)
+        mode &= ~MODE_SMOOTH
+        wide = cffi_compute.wide_depth(max_recursion)
+        depth_data = depths.get((tile_size, smooth, wide))
+        if depth_data is None:
+            depth_data = depths[(tile_size, smooth, wide)] = new_depth(tile_size, smooth, wide)
+        try:
+            computelib = kernels(max_recursion)
+            if smooth and mode == MODE_PERTURB:
+                # smooth escape values only come from the pass kernels, a border pass (finished if it is all black) and then the rest
+                orbit, length = reference
+                if not computelib.compute_tile_perturb_pass(depth_data, orbit, length, x, y, simcoord_per_tile, tile_size, 0, 1, tile_size, max_recursion):
+                    computelib.compute_tile_perturb_pass(depth_data, orbit, length, x, y, simcoord_per_tile, 1, tile_size, 1, tile_size, max_recursion)
+            elif smooth:
+                if not computelib.compute_tile_pass(depth_data, x, y, simcoord_per_tile, tile_size, 0, 1, tile_size, max_recursion):
+                    computelib.compute_tile_pass(depth_data, x, y, simcoord_per_tile, 1, tile_size, 1, tile_size, max_recursion)
+            elif mode == MODE_PERTURB:
+                orbit, length = reference
+                computelib.compute_tile_perturb(depth_data, orbit, length, x, y, simcoord_per_tile, tile_size, max_recursion)
+            elif mode == MODE_SUBDIVIDE:
+                computelib.compute_tile_subdivide(depth_data, x, y, simcoord_per_tile, subdivide_min_size, tile_size, max_recursion)
+            else:
+                computelib.compute_tile(depth_data, x, y, simcoord_per_tile, tile_size, max_recursion)
+        except Exception as err:
+            logger.error("Job %d from %s failed, dropping the connection." % (job_id, connection.address))
+            logger.error(err,exc_info=True)
+            connection.sock.close()      # the client gives its jobs back and reconnects
+            continue
+        connection.outbox.put((job_id, depth_to_wire(depth_data)))
+
+
+
+def serve(host, port, threads):
+    """
+    Run a worker daemon until interrupted.
+    """
+
+    kernels = cffi_compute.Kernels()
+    kernels(1)                   # load the 16-bit build before taking connections, the wide one waits until a job needs it
+    jobs = SimpleQueue()
+    for _ in range(threads):
+        threading.Thread(target=worker_compute_thread, args=(kernels, jobs), daemon=True).start()
+
+    listener = socket.create_server((host, port))
+    logger.info("Listening on %s:%d with %d threads." % (host, port, threads))
+    while True:
+        sock, address = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        address = "%s:%d" % address[:2]
+        threading.Thread(target=WorkerConnection(sock, address, jobs, threads).serve, daemon=True).start()
+
+
+
+class RemoteWorker():
+    """
+    The client's side of one worker daemon, run by a thread of its own (see run()).
+
+    take(timeout) gives a WorkUnit or None, give_back(workunit) returns one that could not be computed (the connection
+    failed), and finished(workunit) is called once its depth data has arrived.  The WorkUnit's job() gives what to compute.
+    A lost connection is retried with a growing delay, and counters are kept for the throughput of each worker.
+    """
+
+    def __init__(self, address, take, give_back, finished, tile_size, max_recursion, batch_size=16):
+        host, _, port = address.rpartition(':')
+        self.address = (host or address, int(port) if host else default_port)
+        self.take = take
+        self.give_back = give_back
+        self.finished = finished
+        self.tile_size = tile_size       # the largest tile size it will be sent
+        self.max_recursion = max_recursion   # the largest max recursion it will be sent
+        self.batch_size = batch_size
+        self.condition = threading.Condition()
+        self.in_flight = {}              # job id -> WorkUnit
+        self.next_job_id = 0
+        self.threads = 0                 # reported by the worker
+        self.tiles = 0
+        self.bytes_received = 0
+        self.connected_seconds = 0.0     # over earlier connections
+        self.connected_since = None
+        self.connects = 0
+        self.failures = 0
+
+    def name(self):
+        return "%s:%d" % self.address
+
+    def run(self, running):
+        """
+        Connect and keep the worker busy while running() is True, reconnecting as needed.
+        """
+
+        delay = 1
+        while running():
+            try:
+                sock = socket.create_connection(self.address, timeout=10)
+            except OSError as err:
+                logger.debug("Could not connect to %s: %s" % (self.name(), err))
+                self.failures += 1
+                sleep(delay)
+                delay = min(delay*2, 30)
+                continue
+            delay = 1
+            self.connects += 1
+            self.connected_since = time()
+            try:
+                self.session(sock, running)
+            except (ConnectionError, OSError, struct.error) as err:
+                logger.warning("Lost worker %s: %s" % (self.name(), err))
+                self.failures += 1
+            finally:
+                sock.close()
+                self.connected_seconds += time() - self.connected_since
+                self.connected_since = None
+                with self.condition:
+                    lost = list(self.in_flight.values())
+                    self.in_flight.clear()
+                    self.condition.notify_all()
+                for workunit in lost:
+                    self.give_back(workunit)
+
+    def session(self, sock, running):
+        """
+        Use one connection: say hello, then send batches of jobs while a thread receives the results.
+        Up to two batches per worker thread are kept in flight, so the worker is not left idle waiting for the network.
+        """
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_message(sock, MSG_HELLO, hello.pack(protocol_version, self.tile_size, self.max_recursion))
+        kind, payload = recv_message(sock)
+        version, self.threads = hello_reply.unpack(payload)
+        if kind != MSG_HELLO or version != protocol_version:
+            raise ConnectionError("Worker speaks protocol version %d." % version)
+        sock.settimeout(None)
+        logger.info("Connected to worker %s with %d threads." % (self.name(), self.threads))
+        window = max(self.batch_size, 2 * self.threads)
+
+        failed = []
+        stopping = threading.Event()     # set before the socket is shut down on purpose, the receiver's error then is no failure
+        def receive():
+            try:
+                while True:
+                    kind, payload = recv_message(sock)
+                    if kind != MSG_RESULTS:
+                        raise ConnectionError("Unexpected message %d." % kind)
+                    self.bytes_received += len(payload)
+                    offset = 0
+                    while offset < len(payload):
+                        job_id, = result_header.unpack_from(payload, offset)
+                        with self.condition:
+                            workunit = self.in_flight.pop(job_id)
+                            self.condition.notify_all()
+                        tile_bytes = len(depth_buffer(workunit.depth_data))       # tiles differ in size, each is as large as its job asked for
+                        if offset + result_header.size + tile_bytes > len(payload):
+                            raise ConnectionError("Result for job %d is cut short." % job_id)
+                        depth_from_wire(workunit.depth_data, payload[offset+result_header.size:offset+result_header.size+tile_bytes])
+                        offset += result_header.size + tile_bytes
+                        self.tiles += 1
+                        self.finished(workunit)
+            except (ConnectionError, OSError, struct.error, KeyError) as err:
+                if not stopping.is_set():
+                    failed.append(err)
+                with self.condition:
+                    self.condition.notify_all()
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+
+        references = OrderedDict()       # id(ReferenceOrbit) -> (reference id, ReferenceOrbit), those the worker has
+        next_ref_id = 0
+        try:
+            while running() and not failed:
+                with self.condition:
+                    while len(self.in_flight) + self.batch_size > window and not failed:
+                        self.condition.wait(1.0)
+                if failed:
+                    break
+
+                # gather a batch, waiting only for the first WorkUnit
+                batch = []
+                workunit = self.take(1.0)
+                while workunit is not None:
+                    batch.append(workunit)
+                    if len(batch) >= self.batch_size:
+                        break
+                    workunit = self.take(0)
+                if not batch:
+                    continue
+
+                parts = []
+                with self.condition:
+                    for workunit in batch:
+                        mode, x, y, simcoord_per_tile, tile_size, subdivide_min_size, max_recursion, reference = workunit.job()
+                        ref_id = 0
+                        if reference is not None:
+                            if id(reference) not in references:
+                                references[id(reference)] = (next_ref_id, reference)
+                                while len(references) > max_references // 2:    # well within what the worker keeps
+                                    references.popitem(last=False)
+                                send_message(sock, MSG_REFERENCE, reference_header.pack(next_ref_id, reference.length) + reference.orbit)
+                                next_ref_id += 1
+                            ref_id = references[id(reference)][0]
+                        self.in_flight[self.next_job_id] = workunit
+                        parts.append(job.pack(self.next_job_id, mode, x, y, simcoord_per_tile, tile_size, subdivide_min_size, max_recursion, ref_id))
+                        self.next_job_id += 1
+                send_message(sock, MSG_JOBS, b"".join(parts))
+        finally:
+            if not failed:
+                stopping.set()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)      # also stops the receiver
+            except OSError:
+                pass
+            receiver.join()
+        if failed:
+            raise failed[0]
+
+    def stats(self):
+        """
+        Give the counters, as a dict.
+        """
+
+        connected_seconds = self.connected_seconds
+        if self.connected_since is not None:
+            connected_seconds += time() - self.connected_since
+        return {
+            'worker': self.name(),
+            'threads': self.threads,
+            'tiles': self.tiles,
+            'bytes_received': self.bytes_received,
+            'connected_seconds': connected_seconds,
+            'tiles_per_second': self.tiles / connected_seconds if connected_seconds else 0.0,
+            'connects': self.connects,
+            'failures': self.failures
+        }
+
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Compute mandelbrot tiles for mandelbrot.py running on other machines.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on, 0.0.0.0 for every interface")
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--threads', type=int, default=cpu_count(), help="compute threads, defaults to one per CPU")
+    args = parser.parse_args()
+
+    try:
+        serve(args.host, args.port, max(1,args.threads))
+    except KeyboardInterrupt:
+        logger.info("Stopping.")
+
+
+
+if __name__ == '__main__':
+    main()
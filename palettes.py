@@ -0,0 +1,49 @@
+"""
+This file is a library that provides the color palettes, as byte strings ready for the C components.
+"""
+
+
+
+zap_period = 1024             # zap() repeats after this many depths, so its palette need not be any longer
+
+
+
+def zap(x):
+    return ((x//4)%256,x//2%128,x%256)
+
+def edge(x, max_recursion):
+    if x < max_recursion-255: return (0,0,0)
+    return (x-(max_recursion-255),x-(max_recursion-255),x-(max_recursion-255))
+
+def tobytes(x):
+    data = bytearray(len(x)*3)
+    for idx,t in enumerate(x):
+        data[idx*3]   = t[0]
+        data[idx*3+1] = t[1]
+        data[idx*3+2] = t[2]
+    return bytes(data)
+
+
+
+def build_palettes(max_recursion):
+    """
+    Build the list of palettes, each of which is one long byte string of RGB triplets.
+    The palettes are used modulo their length, so they only cover every depth below max_recursion where they must.
+    """
+
+    # the edge palette is black up to its last 255 entries, which is most of it for a large max recursion
+    ramp = max(0, max_recursion-255)
+    palettes = [
+        [zap(x) for x in range(min(max_recursion, zap_period))],
+        [(255,0,125),(255,0,255),(125,0,255),(0,0,255),(0,125,255),(0,255,255),(0,255,125),(0,255,0),(125,255,0),(255,255,0),(255,125,0),(255,0,0)],
+        [(255,0,0),(0,255,0),(0,0,255),(255,255,255)],
+        [edge(x, max_recursion) for x in range(ramp, max_recursion)]     # mostly to identify cases where we run out of recursion
+    ]
+    palettes = [tobytes(x) for x in palettes]                            # this results in one long byte string
+    palettes[3] = bytes(ramp*3) + palettes[3]
+    return palettes
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
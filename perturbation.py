@@ -0,0 +1,62 @@
+"""
+This file is a library that supports zooming deeper than a double can resolve, using perturbation theory.
+
+A reference orbit is computed once per view in arbitrary precision (Decimal), then the C kernel iterates
+the (small) difference between each pixel and that reference using plain doubles.
+"""
+
+from decimal import Decimal, localcontext
+from array import array
+from math import log10
+import logging
+
+from tilegrid import minimum_fractalspace_coord
+
+
+
+logger = logging.getLogger('perturbation')
+
+
+
+class ReferenceOrbit():
+    """
+    A high-precision orbit for one point, stored as doubles in the form the C kernel expects.
+    """
+
+    def __init__(self, coord_x, coord_y, max_recursion, pixel_size):
+        self.coord_x = Decimal(coord_x)
+        self.coord_y = Decimal(coord_y)
+        self.max_recursion = max_recursion         # it serves any max recursion up to this one
+
+        # we need enough digits to tell pixels apart, plus some to spare for rounding
+        with localcontext() as ctx:
+            ctx.prec = max(30, int(-log10(pixel_size)) + 20)
+            cx = +self.coord_x                     # unary plus rounds to the context precision
+            cy = +self.coord_y
+            x = Decimal(0)
+            y = Decimal(0)
+            orbit = array('d', [0.0, 0.0])         # Z_0 = 0
+            for _ in range(max_recursion):
+                x, y = x*x - y*y + cx, 2*x*y + cy
+                fx, fy = float(x), float(y)
+                orbit.append(fx)
+                orbit.append(fy)
+                if fx*fx + fy*fy > 4.0:
+                    break
+
+        self.length = len(orbit) // 2              # number of points in the orbit, including Z_0
+        self.orbit = orbit.tobytes()
+        logger.debug("Reference orbit at %s, %s has %d points." % (self.coord_x, self.coord_y, self.length))
+
+    def tile_delta(self, row, col, simcoord_per_tile):
+        """
+        Give the offset of a tile's smallest corner from the reference point, which is small enough to be a double.
+        """
+        tile_simx = minimum_fractalspace_coord[0] + col * Decimal(simcoord_per_tile)
+        tile_simy = minimum_fractalspace_coord[1] + row * Decimal(simcoord_per_tile)
+        return float(tile_simx - self.coord_x), float(tile_simy - self.coord_y)
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
@@ -0,0 +1,227 @@
+"""
+Render a single view to an image file, without any user interface.  Useful on machines that have no display.
+
+Example: python3 render.py -x -0.765 -y 0 -z 20 --width 1920 --height 1080 -o out.png
+"""
+
+from time import time
+from math import floor
+from queue import SimpleQueue, Empty
+from multiprocessing import cpu_count
+from decimal import Decimal
+import argparse, threading, struct, zlib, sys
+import logging
+
+import cffi_compute
+import tilegrid
+from tilegrid import minimum_pixel_size, zoom_level_to_screen_w, get_rc_range, tile_screen_position, tile_origin, needs_perturbation, pyramid_level, recursion_for_level
+from palettes import build_palettes
+from perturbation import ReferenceOrbit
+
+
+
+logger = logging.getLogger('render')
+
+
+
+def write_ppm(filename, width, height, rgb):
+    """
+    Write RGB pixel data as a binary PPM file.
+    """
+    with open(filename, 'wb') as f:
+        f.write(b"P6\n%d %d\n255\n" % (width, height))
+        f.write(rgb)
+
+
+
+def write_png(filename, width, height, rgb):
+    """
+    Write RGB pixel data as a PNG file (8 bits per channel, no filtering).
+    """
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    stride = width * 3
+    raw = b"".join(b"\x00" + rgb[y*stride:(y+1)*stride] for y in range(height))   # filter type 0 on every scanline
+    with open(filename, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+
+def compute_tile_depth(computelib, depth_data, row, col, simcoord_per_tile, reference, max_recursion, tile_mode='edge', subdivide_min_size=4, smooth=False):
+    """
+    Compute one tile of tile_size pixels into depth_data, with the kernel that suits the options (see render()).
+    reference is the ReferenceOrbit to compute against, or None if plain doubles are precise enough.
+    """
+
+    tile_size = tilegrid.tile_size
+    if smooth and reference is not None:
+        # a border pass (finished if it is all black) and then the rest
+        dx, dy = reference.tile_delta(row, col, simcoord_per_tile)
+        if not computelib.compute_tile_perturb_pass(depth_data, reference.orbit, reference.length, dx, dy, simcoord_per_tile, tile_size, 0, 1, tile_size, max_recursion):
+            computelib.compute_tile_perturb_pass(depth_data, reference.orbit, reference.length, dx, dy, simcoord_per_tile, 1, tile_size, 1, tile_size, max_recursion)
+    elif smooth:
+        start_x, start_y = tile_origin(row, col, simcoord_per_tile)
+        if not computelib.compute_tile_pass(depth_data, start_x, start_y, simcoord_per_tile, tile_size, 0, 1, tile_size, max_recursion):
+            computelib.compute_tile_pass(depth_data, start_x, start_y, simcoord_per_tile, 1, tile_size, 1, tile_size, max_recursion)
+    elif reference is not None:
+        dx, dy = reference.tile_delta(row, col, simcoord_per_tile)
+        computelib.compute_tile_perturb(depth_data, reference.orbit, reference.length, dx, dy, simcoord_per_tile, tile_size, max_recursion)
+    elif tile_mode == 'subdivide':
+        start_x, start_y = tile_origin(row, col, simcoord_per_tile)
+        computelib.compute_tile_subdivide(depth_data, start_x, start_y, simcoord_per_tile, subdivide_min_size, tile_size, max_recursion)
+    else:
+        start_x, start_y = tile_origin(row, col, simcoord_per_tile)
+        computelib.compute_tile(depth_data, start_x, start_y, simcoord_per_tile, tile_size, max_recursion)
+
+
+
+def render(computelib, palette_data, max_recursion, coord_x, coord_y, zoomlevel, width, height, threads, tile_mode='edge', subdivide_min_size=4, smooth=False, antialias=0, antialias_threshold=2):
+    """
+    Compute every tile that touches the requested view and assemble the visible part of them into one RGB image.
+    With smooth, the tiles are computed with smooth escape values (by the pass kernels, whatever the tile mode) and colored with blended palettes.
+    With antialias, the pixels whose depth differs by more than antialias_threshold from a neighbour (in the same tile or the
+    next one) are sampled again on a grid of antialias x antialias points, and get the average colour (see antialias_tile() in
+    cffi_compute.py).  The tiles are then all computed before any is colored, so each can be compared with its neighbours.
+    computelib must be the wide build if max_recursion needs one (see cffi_compute.wide_depth()).
+    Returns the image (as bytes), the number of tiles computed and the number of pixels of the image sampled again.
+    """
+
+    tile_size = tilegrid.tile_size
+    coordrange_x = zoom_level_to_screen_w(zoomlevel)
+    coordrange_y = coordrange_x * height / width
+    coordmin_x = coord_x - Decimal(coordrange_x)/2
+    coordmin_y = coord_y - Decimal(coordrange_y)/2
+    simcoord_per_tile, min_row, max_row, min_col, max_col = get_rc_range(
+        zoomlevel, coordmin_x, coord_x + Decimal(coordrange_x)/2, coordmin_y, coord_y + Decimal(coordrange_y)/2, width)
+    reference = None
+    if needs_perturbation(simcoord_per_tile):
+        reference = ReferenceOrbit(coord_x, coord_y, max_recursion, coordrange_x / width)
+
+    tiles = [(r,c) for r in range(min_row,max_row+1) for c in range(min_col,max_col+1)]
+    num_tiles = len(tiles)
+
+    image = bytearray(width * height * 3)
+    shifts = (0,8,16) if sys.byteorder == 'little' else (16,8,0)     # RGB byte order, for 3 byte pixels in native order
+    depths = {}                  # (row, col) -> depth data, kept for antialiasing
+    sampled = []
+
+    def tile_position(row, col):
+        draw_x, draw_y = tile_screen_position(row, col, simcoord_per_tile, coordmin_x, coordmin_y)
+        return int(floor(draw_x)), int(floor(draw_y))
+
+    def compute_thread(todo):
+        depth_data = None
+        while True:
+            try:
+                row, col = todo.get_nowait()
+            except Empty:
+                return
+            if antialias or depth_data is None:
+                depth_data = cffi_compute.new_depth(tile_size, smooth, cffi_compute.wide_depth(max_recursion))
+            compute_tile_depth(computelib, depth_data, row, col, simcoord_per_tile, reference, max_recursion, tile_mode, subdivide_min_size, smooth)
+            if antialias:
+                depths[(row, col)] = depth_data
+            else:
+                # colorize the visible part of the tile into the image, each tile owns its own pixels so no locking is needed
+                cffi_compute.colorize_tiles(computelib, [depth_data], [tile_position(row, col)], tile_size, max_recursion, palette_data, image, width, height, width*3, 3, shifts)
+
+    def antialias_thread(todo):
+        rgb = bytearray(tile_size * tile_size * 3)
+        rgb_data = cffi_compute.ffi.from_buffer(rgb, require_writable=True)
+        null = cffi_compute.ffi.NULL
+        while True:
+            try:
+                row, col = todo.get_nowait()
+            except Empty:
+                return
+            depth_data = depths[(row, col)]
+            around = [depths.get(neighbour, null) for neighbour in ((row-1, col), (row+1, col), (row, col-1), (row, col+1))]
+            left, top = tile_position(row, col)
+            x0, x1 = max(0, -left), min(tile_size, width - left)
+            y0, y1 = max(0, -top), min(tile_size, height - top)
+            if reference is not None:
+                dx, dy = reference.tile_delta(row, col, simcoord_per_tile)
+                sampled.append(computelib.antialias_tile_perturb(depth_data, *around, reference.orbit, reference.length, dx, dy, simcoord_per_tile, smooth, tile_size, max_recursion,
+                                                                 antialias, antialias_threshold, x0, y0, x1, y1, palette_data, len(palette_data)//3, rgb_data))
+            else:
+                start_x, start_y = tile_origin(row, col, simcoord_per_tile)
+                sampled.append(computelib.antialias_tile(depth_data, *around, start_x, start_y, simcoord_per_tile, smooth, tile_size, max_recursion,
+                                                         antialias, antialias_threshold, x0, y0, x1, y1, palette_data, len(palette_data)//3, rgb_data))
+            for y in range(y0, y1):
+                image[((top+y)*width + left+x0)*3 : ((top+y)*width + left+x1)*3] = rgb[(y*tile_size + x0)*3 : (y*tile_size + x1)*3]
+
+    for target in (compute_thread, antialias_thread) if antialias else (compute_thread,):
+        todo = SimpleQueue()
+        for tile in tiles:
+            todo.put(tile)
+        workers = [threading.Thread(target=target, args=(todo,)) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+
+    return bytes(image), num_tiles, sum(sampled)
+
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Render a view of the mandelbrot set to a PNG or PPM file, without a display.")
+    parser.add_argument('-x', type=Decimal, default=Decimal(0.47 - 2.00)/2, help="center X coordinate (fractalspace), as many digits as the zoom level needs")
+    parser.add_argument('-y', type=Decimal, default=Decimal(0), help="center Y coordinate (fractalspace)")
+    parser.add_argument('-z', '--zoomlevel', type=int, default=0, help="zoom level, as shown in the interactive program")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--palette', type=int, default=0, help="palette index")
+    parser.add_argument('--max-recursion', type=int, help="defaults to one that suits the zoom level, as the interactive program starts out with")
+    parser.add_argument('--tile-mode', choices=('edge','subdivide'), default='edge', help="skip tiles with an all-black border, or subdivide tiles and fill any uniform rectangle (Mariani-Silver)")
+    parser.add_argument('--subdivide-min-size', type=int, default=4, help="in subdivide mode, rectangles smaller than this are computed pixel by pixel")
+    parser.add_argument('--smooth', action='store_true', help="smooth escape values, blending the palette instead of showing bands (looks good with a lower max recursion)")
+    parser.add_argument('--antialias', type=int, default=0, metavar='N', help="sample the pixels on edges again on an NxN grid and average their colours (2 to %d, 0 for none)" % cffi_compute.max_antialias_samples)
+    parser.add_argument('--antialias-threshold', type=int, default=2, help="how far the depth of a pixel must be from a neighbour's to sample it again")
+    parser.add_argument('--threads', type=int, default=cpu_count(), help="worker threads, defaults to one per CPU")
+    parser.add_argument('-o', '--output', default='mandelbrot.png', help="output file, .png or .ppm")
+    args = parser.parse_args()
+
+    if not args.output.lower().endswith(('.png','.ppm')):
+        parser.error("Output file must end in .png or .ppm.")
+    if zoom_level_to_screen_w(args.zoomlevel) / args.width < minimum_pixel_size:
+        parser.error("Zoom level is too deep for this resolution.")
+    if args.max_recursion is None:
+        args.max_recursion = recursion_for_level(pyramid_level(args.zoomlevel, args.width))
+    if not 0 < args.max_recursion <= tilegrid.max_recursion_limit:
+        parser.error("Max recursion must be between 1 and %d." % tilegrid.max_recursion_limit)
+    if args.antialias != 0 and not 2 <= args.antialias <= cffi_compute.max_antialias_samples:
+        parser.error("Antialias samples must be between 2 and %d." % cffi_compute.max_antialias_samples)
+    palettes = build_palettes(args.max_recursion)
+    if not 0 <= args.palette < len(palettes):
+        parser.error("Palette index must be in the range 0 to %d." % (len(palettes)-1))
+
+    t1 = time()
+    computelib = cffi_compute.compile_vector(wide=cffi_compute.wide_depth(args.max_recursion))
+    t2 = time()
+    image, num_tiles, num_sampled = render(computelib, palettes[args.palette], args.max_recursion, args.x, args.y, args.zoomlevel, args.width, args.height, max(1,args.threads),
+                                           args.tile_mode, args.subdivide_min_size, args.smooth, args.antialias, args.antialias_threshold)
+    t3 = time()
+    if args.output.lower().endswith('.png'):
+        write_png(args.output, args.width, args.height, image)
+    else:
+        write_ppm(args.output, args.width, args.height, image)
+    t4 = time()
+
+    megapixels = num_tiles * tilegrid.tile_size * tilegrid.tile_size / 1e6
+    logger.info("Loaded kernel in %.02fs, wrote %s in %.02fs (max recursion %d)." % (t2-t1, args.output, t4-t3, args.max_recursion))
+    logger.info("Rendered %d tiles in %.02fs with %d threads: %.01f tiles/s, %.02f megapixels/s." % (num_tiles, t3-t2, args.threads, num_tiles/(t3-t2), megapixels/(t3-t2)))
+    if args.antialias:
+        logger.info("Sampled %d pixels again (%.01f%% of the image) with %d samples each." % (num_sampled, 100*num_sampled/(args.width*args.height), args.antialias**2))
+
+
+
+if __name__ == '__main__':
+    main()
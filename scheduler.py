@@ -0,0 +1,107 @@
+"""
+This file is a library that provides the queue of tiles waiting for the worker threads, in priority order.
+
+Every view (zoom level and position) gets a generation number.  Tiles queued for the current view come first,
+those closest to the center of the screen before the others.  Tiles queued for earlier views fall behind all of
+them, and are dropped altogether once they are a few views old, so that panning and zooming quickly does not
+leave the workers busy with tiles nobody can see anymore.
+"""
+
+import heapq, threading
+from itertools import count
+import logging
+
+
+
+logger = logging.getLogger('scheduler')
+
+
+
+class TileScheduler():
+    """
+    A priority queue of WorkUnit objects, shared between the main thread (submit) and worker threads (get).
+    """
+
+    def __init__(self, max_age=4):
+        self.max_age = max_age           # tiles queued this many generations ago are dropped
+        self.generation = 0
+        self.heap = []                   # entries [-generation, priority, sequence number, workunit or None when replaced]
+        self.entries = {}                # the live heap entry for each queued cache key
+        self.sequence = count()          # keeps the order stable among equal priorities
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def new_generation(self):
+        """
+        Note that the view has changed, which puts everything queued so far behind anything queued from now on.
+        """
+        with self.condition:
+            self.generation += 1
+            return self.generation
+
+    def submit(self, workunit, priority):
+        """
+        Queue a WorkUnit for the current generation, lower priority values are computed first.
+        A WorkUnit that is queued already is moved to its new place, one that a worker has taken is left alone.
+        """
+
+        with self.condition:
+            if workunit.taken:
+                return
+            old = self.entries.pop(workunit.cache_key, None)
+            if old is not None:
+                old[3] = None                  # leave it in the heap, get() skips it
+            entry = [-self.generation, priority, next(self.sequence), workunit]
+            self.entries[workunit.cache_key] = entry
+            heapq.heappush(self.heap, entry)
+            workunit.generation = self.generation
+            self.condition.notify()
+
+    def requeue(self, workunit, priority):
+        """
+        Put a WorkUnit that a worker has taken back in the queue, for a later pass over it.
+        It keeps the generation it was queued in, the main thread submits it again if it is still in view.
+        It is dropped if another WorkUnit has been queued for its cache key meanwhile (after it was evicted from the tile cache).
+        """
+
+        with self.condition:
+            workunit.taken = False
+            old = self.entries.get(workunit.cache_key)
+            if old is not None:
+                if old[3] is not workunit:
+                    return
+                old[3] = None
+            entry = [-workunit.generation, priority, next(self.sequence), workunit]
+            self.entries[workunit.cache_key] = entry
+            heapq.heappush(self.heap, entry)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Take the most important WorkUnit off the queue, waiting up to timeout seconds for one.  Return None if there was none.
+        """
+
+        with self.condition:
+            while True:
+                while self.heap:
+                    entry = heapq.heappop(self.heap)
+                    negative_generation, _, _, workunit = entry
+                    if workunit is None:
+                        continue
+                    if self.entries.get(workunit.cache_key) is entry:
+                        del self.entries[workunit.cache_key]
+                    if self.generation + negative_generation >= self.max_age:
+                        self.dropped += 1      # nobody has wanted it for a while, it is queued again if it comes back into view
+                        continue
+                    workunit.taken = True
+                    return workunit
+                if not self.condition.wait(timeout):
+                    return None
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")
@@ -0,0 +1,81 @@
+"""
+Check that tiles come back from the tile pack as they went in, also after reopening it and after it filled up.
+"""
+
+from diskcache import TilePack
+from cffi_compute import new_depth, depth_buffer, depth_nbytes
+
+
+
+class Tile():
+    def __init__(self, cache_key, smooth=False, wide=False):
+        self.cache_key = cache_key
+        self.depth_data = new_depth(cache_key[4], smooth, wide)
+
+
+
+def filled_tile(number, size=32, max_recursion=256, smooth=False):
+    tile = Tile((5, number, 2*number, 0.125, size, max_recursion), smooth, max_recursion > 65535)
+    data = depth_buffer(tile.depth_data)
+    data[:] = bytes((number + i) % 251 for i in range(len(data)))
+    return tile
+
+
+
+def test_round_trip(tmp_path):
+    tiles = [filled_tile(1), filled_tile(2, size=64), filled_tile(3, max_recursion=2**17), filled_tile(4, size=128, max_recursion=2**17)]
+    pack = TilePack(str(tmp_path), 32)
+    for tile in tiles:
+        pack.store(tile)
+    pack.close()
+
+    pack = TilePack(str(tmp_path), 32)
+    assert len(pack) == len(tiles)
+    for tile in tiles:
+        loaded = Tile(tile.cache_key)
+        assert pack.load(loaded)
+        assert bytes(depth_buffer(loaded.depth_data)) == bytes(depth_buffer(tile.depth_data))
+    assert not pack.load(Tile((5, 9, 9, 0.125, 32, 256)))
+    pack.close()
+
+
+
+def test_smooth_round_trip(tmp_path):
+    tile = filled_tile(1, smooth=True)
+    pack = TilePack(str(tmp_path), 32, smooth=True)
+    pack.store(tile)
+    loaded = Tile(tile.cache_key, smooth=True)
+    assert pack.load(loaded)
+    assert bytes(depth_buffer(loaded.depth_data)) == bytes(depth_buffer(tile.depth_data))
+    pack.close()
+
+
+
+def test_full_pack_keeps_the_recently_used_tiles(tmp_path):
+    pack = TilePack(str(tmp_path), 32, max_bytes=10 * depth_nbytes(32))
+    tiles = [filled_tile(number) for number in range(10)]
+    for tile in tiles:
+        pack.store(tile)
+    assert len(pack) == 10
+    assert pack.load(Tile(tiles[0].cache_key))      # now the most recently used
+
+    # no room for more, the least recently used are dropped to make it
+    extra = filled_tile(10)
+    pack.store(extra)
+    assert extra.cache_key in pack
+    assert tiles[0].cache_key in pack
+    assert tiles[1].cache_key not in pack
+    assert len(pack) <= 10
+
+    # it keeps taking tiles, and what it kept is still right after reopening it
+    more = [filled_tile(number) for number in range(11, 40)]
+    for tile in more:
+        pack.store(tile)
+    pack.close()
+    pack = TilePack(str(tmp_path), 32, max_bytes=10 * depth_nbytes(32))
+    assert more[-1].cache_key in pack
+    for tile in tiles + [extra] + more:
+        loaded = Tile(tile.cache_key)
+        if pack.load(loaded):
+            assert bytes(depth_buffer(loaded.depth_data)) == bytes(depth_buffer(tile.depth_data))
+    pack.close()
@@ -0,0 +1,112 @@
+"""
+Check the kernel variants against each other.  The builds are cached in kernelcache, so only the first run compiles them.
+"""
+
+import pytest
+
+import cffi_compute
+from cffi_compute import new_depth
+from perturbation import ReferenceOrbit
+
+
+
+# points on or near the boundary of the set, where the iteration counts are the most sensitive to rounding
+boundary_points = [(-1.25, 0.02), (-0.7436438870371587, 0.1318259042), (-0.75, 0.1), (0.28, 0.01), (-0.1, 0.65),
+                   (-1.0625, -0.25), (0.3, 0.5), (-0.16, 1.035), (-1.77, 0.01), (0.25, 0.0)]
+test_tile_size = 64
+
+
+
+@pytest.fixture(scope='module')
+def simple():
+    return cffi_compute.compile_simple()
+
+
+@pytest.fixture(scope='module')
+def vector():
+    return cffi_compute.compile_vector()
+
+
+
+def tiles(computelib, max_recursion, pixel_size, shift=0.0):
+    """
+    Compute a tile centered on each of the boundary points, moved right by shift pixels, and give their depths as lists.
+    """
+
+    result = []
+    for x, y in boundary_points:
+        depth_data = new_depth(test_tile_size)
+        half = pixel_size * test_tile_size / 2
+        computelib.compute_tile(depth_data, x - half + shift * pixel_size, y - half, pixel_size * test_tile_size, test_tile_size, max_recursion)
+        result.append(list(depth_data))
+    return result
+
+
+
+def count_differences(tiles_a, tiles_b):
+    return sum(a != b for tile_a, tile_b in zip(tiles_a, tiles_b) for a, b in zip(tile_a, tile_b))
+
+
+
+@pytest.mark.parametrize('max_recursion', [256, 1024, 4096])
+def test_float_tier_error_is_well_below_a_pixel(simple, vector, max_recursion):
+    # pixels at the float threshold go through mandlebrot_lanes_float(), those of the simple variant are all doubles
+    # near the boundary a tiny move changes many pixels, so the float pixels need only differ less than a move by 1e-3 of a pixel does
+    pixel_size = cffi_compute.float_pixel_scale * max_recursion
+    double = tiles(simple, max_recursion, pixel_size)
+    float_differences = count_differences(double, tiles(vector, max_recursion, pixel_size))
+    moved_differences = count_differences(double, tiles(simple, max_recursion, pixel_size, 1.0e-3))
+    assert float_differences < moved_differences
+
+
+
+@pytest.mark.parametrize('max_recursion', [256, 1024, 4096])
+@pytest.mark.parametrize('pixel_size', [1.2e-5, 1.0e-7, 1.0e-12])
+def test_double_tier_matches_simple(simple, vector, max_recursion, pixel_size):
+    assert cffi_compute.float_pixel_scale * max_recursion > pixel_size
+    assert count_differences(tiles(simple, max_recursion, pixel_size), tiles(vector, max_recursion, pixel_size)) == 0
+
+
+
+@pytest.mark.parametrize('variant', ['compile_simple', 'compile', 'compile_unrolled', 'compile_vector'])
+@pytest.mark.parametrize('level', [0, 3, 5, 12, 20])
+def test_periodicity_matches_plain_iteration(simple, variant, level):
+    # the cycle detection may only stop orbits that really are periodic, so every pixel must get the count of plain iteration
+    max_recursion = 2048
+    simcoord_per_tile = 4.0 / 2**level
+    if variant == 'compile_vector' and simcoord_per_tile / test_tile_size >= cffi_compute.float_pixel_scale * max_recursion:
+        pytest.skip("float pixels, see test_float_tier_error_is_well_below_a_pixel()")
+    computelib = getattr(cffi_compute, variant)()
+    for x, y in boundary_points:
+        depth_data = new_depth(test_tile_size)
+        computelib.compute_tile(depth_data, x, y, simcoord_per_tile, test_tile_size, max_recursion)
+        for i in range(test_tile_size * test_tile_size):
+            row, col = divmod(i, test_tile_size)
+            plain = simple.mandlebrot(x + col * simcoord_per_tile / test_tile_size, y + row * simcoord_per_tile / test_tile_size, 0.0, max_recursion)
+            assert depth_data[i] == plain, (x, y, row, col)
+
+
+
+def test_periodicity_near_slow_escape(vector):
+    # -1.0625-0.25i takes 1063 iterations to escape, which came out as 689 while pixels this small were computed with floats
+    depth_data = new_depth(test_tile_size)
+    vector.compute_tile(depth_data, -1.0625, -0.25, 1.2e-5 * test_tile_size, test_tile_size, 2048)
+    assert depth_data[0] == 1063
+
+
+
+@pytest.mark.parametrize('max_recursion', [256, 1024, 4096])
+@pytest.mark.parametrize('pixel_size', [1.0e-5, 1.0e-9, 1.0e-12])
+def test_perturbation_matches_direct(simple, vector, max_recursion, pixel_size):
+    # the orbit is taken at the center of each tile, the pixels are iterated as offsets from it
+    direct = tiles(simple, max_recursion, pixel_size)
+    moved_differences = count_differences(direct, tiles(simple, max_recursion, pixel_size, 1.0e-3))
+    for computelib in (simple, vector):
+        perturbed = []
+        for x, y in boundary_points:
+            reference = ReferenceOrbit(x, y, max_recursion, pixel_size)
+            depth_data = new_depth(test_tile_size)
+            half = pixel_size * test_tile_size / 2
+            computelib.compute_tile_perturb(depth_data, reference.orbit, reference.length, -half, -half, pixel_size * test_tile_size, test_tile_size, max_recursion)
+            perturbed.append(list(depth_data))
+        assert count_differences(direct, perturbed) <= moved_differences
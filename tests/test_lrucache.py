@@ -0,0 +1,71 @@
+"""
+Check that the tile cache keeps to its byte budget and evicts the least recently used tiles first.
+"""
+
+from lrucache import TileCache
+
+
+
+def filled_cache(sizes, max_bytes, on_evict=None):
+    cache = TileCache(max_bytes, len, on_evict)
+    for number, size in enumerate(sizes):
+        cache[number] = bytes(size)
+    return cache
+
+
+
+def test_bytes_are_accounted_per_entry():
+    cache = filled_cache([10, 20, 30], 100)
+    assert len(cache) == 3
+    assert cache.bytes == 60
+    cache[1] = bytes(5)                     # replacing an entry accounts for its new size
+    assert cache.bytes == 45
+    del cache[0]
+    assert cache.bytes == 35
+    assert 0 not in cache and 1 in cache
+
+
+
+def test_trim_evicts_least_recently_used_first():
+    evicted = []
+    cache = filled_cache([10] * 5, 30, evicted.append)
+    assert cache.get(0) is not None         # now the most recently used
+    assert cache.trim() == 2
+    assert list(cache.entries) == [3, 4, 0]
+    assert evicted == [bytes(10), bytes(10)]
+    assert cache.bytes == 30
+    assert cache.trim() == 0
+    assert cache.stats()['evictions'] == 2
+
+
+
+def test_trim_keeps_the_requested_entries():
+    cache = filled_cache([50] * 4, 60)
+    assert cache.trim(keep=3) == 1
+    assert len(cache) == 3
+    assert cache.bytes > cache.max_bytes
+    assert cache.trim() == 2
+    assert list(cache.entries) == [3]
+
+
+
+def test_peek_does_not_touch_recency_or_counters():
+    cache = filled_cache([10] * 3, 20)
+    assert cache.peek(0) == bytes(10)
+    assert cache.peek(9) is None
+    assert cache.stats()['hits'] == 0 and cache.stats()['misses'] == 0
+    cache.trim()
+    assert 0 not in cache
+
+
+
+def test_get_counts_hits_and_misses():
+    cache = filled_cache([10] * 2, 100)
+    cache.get(0)
+    cache.get(1)
+    cache.get(2)
+    cache.get(2, count=False)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    assert abs(stats['hit_rate'] - 2 / 3) < 1e-9
+    assert list(cache.entries) == [0, 1]
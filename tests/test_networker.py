@@ -0,0 +1,136 @@
+"""
+Check that both ends of the worker protocol refuse malformed messages.
+"""
+
+from queue import SimpleQueue
+import socket, threading
+
+import pytest
+
+import networker
+from networker import (WorkerConnection, RemoteWorker, recv_message, send_message, header, hello, hello_reply, reference_header,
+                       job, result_header, MSG_HELLO, MSG_REFERENCE, MSG_JOBS, MSG_RESULTS, MODE_EDGE, MODE_PERTURB, protocol_version)
+from cffi_compute import new_depth, depth_buffer
+
+
+
+def worker_session(*messages, max_recursion=256):
+    """
+    Say hello to a WorkerConnection, send it the given (kind, payload) messages and close.
+    Give the jobs it queued, and whether it dropped the connection before reading them all.
+    """
+
+    client, server = socket.socketpair()
+    jobs = SimpleQueue()
+    connection = WorkerConnection(server, 'test', jobs, 1)
+    send_message(client, MSG_HELLO, hello.pack(protocol_version, 32, max_recursion))
+    for kind, payload in messages:
+        send_message(client, kind, payload)
+    client.shutdown(socket.SHUT_WR)
+    connection.serve()
+    kind, payload = recv_message(client)
+    assert kind == MSG_HELLO and hello_reply.unpack(payload)[0] == protocol_version
+    client.close()
+    queued = []
+    while not jobs.empty():
+        queued.append(jobs.get())
+    return queued
+
+
+
+def reference_message(ref_id, length, points=None):
+    points = length if points is None else points
+    return MSG_REFERENCE, reference_header.pack(ref_id, length) + bytes(points * 16)
+
+
+
+def job_message(*jobs):
+    return MSG_JOBS, b"".join(job.pack(job_id, mode, 0.0, 0.0, 1.0, 32, 4, 256, ref_id) for job_id, mode, ref_id in jobs)
+
+
+
+def test_recv_message_refuses_long_messages():
+    a, b = socket.socketpair()
+    a.sendall(header.pack(MSG_JOBS, 1000))
+    with pytest.raises(ConnectionError):
+        recv_message(b, 999)
+    a.sendall(header.pack(MSG_JOBS, 3) + b"abc")
+    assert recv_message(b, 3) == (MSG_JOBS, b"abc")
+    a.close()
+    b.close()
+
+
+
+def test_jobs_take_their_reference_along():
+    queued = worker_session(reference_message(7, 10), job_message((1, MODE_PERTURB, 7), (2, MODE_EDGE, 0)))
+    assert [jobtuple[0] for _, jobtuple, _ in queued] == [1, 2]
+    assert queued[0][2] == (bytes(160), 10)
+    assert queued[1][2] is None
+
+
+
+@pytest.mark.parametrize('length, points', [(1, 1), (258, 258), (10, 9), (10, 11)])
+def test_bad_reference_drops_the_connection(length, points):
+    # a reference for max recursion 256 has 2 to 257 points, and the orbit must be as long as it says
+    queued = worker_session(reference_message(0, length, points), job_message((1, MODE_EDGE, 0)))
+    assert queued == []
+
+
+
+def test_unknown_reference_drops_the_connection():
+    queued = worker_session(reference_message(0, 10), job_message((1, MODE_PERTURB, 0), (2, MODE_PERTURB, 5), (3, MODE_EDGE, 0)))
+    assert [jobtuple[0] for _, jobtuple, _ in queued] == [1]
+
+
+
+def test_partial_job_drops_the_connection():
+    kind, payload = job_message((1, MODE_EDGE, 0))
+    assert worker_session((kind, payload + b"x"), job_message((2, MODE_EDGE, 0))) == []
+
+
+
+def test_refuses_references_longer_than_a_message():
+    client, server = socket.socketpair()
+    too_deep = (networker.max_message_size - reference_header.size) // 16
+    send_message(client, MSG_HELLO, hello.pack(protocol_version, 32, too_deep))
+    WorkerConnection(server, 'test', SimpleQueue(), 1).serve()
+    with pytest.raises(ConnectionError):
+        recv_message(client)
+    client.close()
+
+
+
+class Tile():
+    def __init__(self):
+        self.depth_data = new_depth(32)
+
+    def job(self):
+        return MODE_EDGE, 0.0, 0.0, 1.0, 32, 4, 256, None
+
+
+
+def test_cut_short_result_ends_the_session():
+    listener = socket.create_server(('127.0.0.1', 0))          # the client sets TCP options, so no socket pair
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    tiles = [Tile()]
+    finished = []
+    remote = RemoteWorker('test', lambda timeout: tiles.pop() if tiles else None, None, finished.append, 32, 256)
+
+    def worker():
+        recv_message(server)
+        send_message(server, MSG_HELLO, hello_reply.pack(protocol_version, 1))
+        kind, payload = recv_message(server)
+        job_id = job.unpack_from(payload)[0]
+        send_message(server, MSG_RESULTS, result_header.pack(job_id) + bytes(len(depth_buffer(new_depth(32))) - 1))
+        with pytest.raises(ConnectionError):
+            recv_message(server)         # until the client hangs up
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    with pytest.raises(ConnectionError, match="cut short"):
+        remote.session(client, lambda: True)
+    assert finished == []
+    thread.join(5)
+    client.close()
+    server.close()
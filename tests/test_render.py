@@ -0,0 +1,51 @@
+"""
+Check the antialiasing of render.py against edges found on the whole grid of depth values.
+"""
+
+from decimal import Decimal
+from math import floor
+
+import cffi_compute
+import render
+import tilegrid
+from tilegrid import zoom_level_to_screen_w, get_rc_range, tile_screen_position
+from palettes import build_palettes
+
+
+
+def test_antialias_finds_edges_across_tiles():
+    coord_x, coord_y, zoomlevel, width, height, max_recursion, threshold = Decimal('-0.7436'), Decimal('0.1318'), 20, 200, 120, 1024, 2
+    computelib = cffi_compute.compile_vector()
+    palette = build_palettes(max_recursion)[0]
+    _, num_tiles, sampled = render.render(computelib, palette, max_recursion, coord_x, coord_y, zoomlevel, width, height, 2, antialias=2, antialias_threshold=threshold)
+
+    # the same tiles, put together into one grid of depths
+    tile_size = tilegrid.tile_size
+    coordrange_x = zoom_level_to_screen_w(zoomlevel)
+    coordrange_y = coordrange_x * height / width
+    coordmin_x = coord_x - Decimal(coordrange_x)/2
+    coordmin_y = coord_y - Decimal(coordrange_y)/2
+    simcoord_per_tile, min_row, max_row, min_col, max_col = get_rc_range(
+        zoomlevel, coordmin_x, coord_x + Decimal(coordrange_x)/2, coordmin_y, coord_y + Decimal(coordrange_y)/2, width)
+    assert num_tiles == (max_row - min_row + 1) * (max_col - min_col + 1)
+    depths = {}
+    visible = set()
+    for row in range(min_row, max_row+1):
+        for col in range(min_col, max_col+1):
+            depth_data = cffi_compute.new_depth(tile_size)
+            render.compute_tile_depth(computelib, depth_data, row, col, simcoord_per_tile, None, max_recursion)
+            draw_x, draw_y = tile_screen_position(row, col, simcoord_per_tile, coordmin_x, coordmin_y)
+            for y in range(tile_size):
+                for x in range(tile_size):
+                    grid = ((row - min_row) * tile_size + y, (col - min_col) * tile_size + x)
+                    depths[grid] = depth_data[y*tile_size + x]
+                    if 0 <= floor(draw_x) + x < width and 0 <= floor(draw_y) + y < height:
+                        visible.add(grid)
+
+    edges = 0
+    for (y, x) in visible:
+        d = depths[(y, x)]
+        if any(abs(d - depths[neighbour]) > threshold for neighbour in ((y-1, x), (y+1, x), (y, x-1), (y, x+1)) if neighbour in depths):
+            edges += 1
+    assert len(visible) == width * height
+    assert sampled == edges
@@ -0,0 +1,103 @@
+"""
+Check the order the tile scheduler hands out tiles in, across view generations and requeues.
+"""
+
+from scheduler import TileScheduler
+
+
+
+class Tile():
+    def __init__(self, cache_key):
+        self.cache_key = cache_key
+        self.generation = None
+        self.taken = False
+
+
+
+def test_priority_order_within_a_generation():
+    scheduler = TileScheduler()
+    tiles = [Tile(number) for number in range(4)]
+    for tile, priority in zip(tiles, [3, 1, 2, 0]):
+        scheduler.submit(tile, priority)
+    assert len(scheduler) == 4
+    assert [scheduler.get(0) for _ in range(4)] == [tiles[3], tiles[1], tiles[2], tiles[0]]
+    assert scheduler.get(0) is None
+    assert len(scheduler) == 0
+
+
+
+def test_newer_generations_come_first_and_old_ones_are_dropped():
+    scheduler = TileScheduler(max_age=2)
+    old, middle, new = Tile('old'), Tile('middle'), Tile('new')
+    scheduler.submit(old, 0)
+    scheduler.new_generation()
+    scheduler.submit(middle, 5)
+    scheduler.new_generation()
+    scheduler.submit(new, 9)
+    assert scheduler.get(0) is new
+    assert scheduler.get(0) is middle
+    assert scheduler.get(0) is None         # two generations old
+    assert scheduler.dropped == 1
+
+
+
+def test_submit_again_moves_a_queued_tile():
+    scheduler = TileScheduler()
+    a, b = Tile('a'), Tile('b')
+    scheduler.submit(a, 1)
+    scheduler.submit(b, 2)
+    scheduler.new_generation()
+    scheduler.submit(b, 2)
+    assert len(scheduler) == 2
+    assert scheduler.get(0) is b
+    assert b.generation == 1
+    assert scheduler.get(0) is a
+    assert scheduler.get(0) is None
+
+
+
+def test_taken_tile_is_left_alone_until_requeued():
+    scheduler = TileScheduler()
+    tile = Tile('a')
+    scheduler.submit(tile, 0)
+    assert scheduler.get(0) is tile and tile.taken
+    scheduler.submit(tile, 0)
+    assert len(scheduler) == 0
+
+    # it keeps the generation it was queued in
+    scheduler.new_generation()
+    fresh = Tile('b')
+    scheduler.submit(fresh, 5)
+    scheduler.requeue(tile, 0)
+    assert not tile.taken
+    assert scheduler.get(0) is fresh
+    assert scheduler.get(0) is tile
+
+
+
+def test_requeue_yields_to_a_newer_tile_for_the_same_key():
+    scheduler = TileScheduler()
+    tile = Tile('a')
+    scheduler.submit(tile, 0)
+    assert scheduler.get(0) is tile
+
+    # evicted from the tile cache meanwhile, and queued again as a new WorkUnit
+    replacement = Tile('a')
+    scheduler.submit(replacement, 1)
+    scheduler.requeue(tile, 0)
+    assert len(scheduler) == 1
+    assert scheduler.get(0) is replacement
+    assert scheduler.get(0) is None
+
+
+
+def test_get_keeps_a_newer_entry_for_the_same_key():
+    scheduler = TileScheduler()
+    tile = Tile('a')
+    scheduler.submit(tile, 0)
+    scheduler.submit(tile, 1)               # replaces the first entry, which stays in the heap
+    assert len(scheduler) == 1
+    assert scheduler.get(0) is tile
+    assert len(scheduler) == 0
+    assert scheduler.get(0) is None
+
@@ -0,0 +1,205 @@
+"""
+This file is a library that defines the tile grid laid over calculation/simulation/fractalspace.
+It has no user interface dependencies, so that both the interactive and the headless front ends can use it.
+"""
+
+from math import log, log2, floor, ldexp
+import decimal
+from decimal import Decimal
+
+
+
+min_recursion = 256          # the max recursion at shallow zoom, it doubles as the view goes deeper (see recursion_for_level())
+max_recursion_limit = 2**18  # no max recursion beyond this, whatever the zoom (beyond 65535 the depth values take 32 bits)
+recursion_levels = 8         # pyramid levels to the first doubling of the max recursion, each later one takes longer
+recursion_boost_range = (-2, 6)      # how far the tiles seen so far may move the max recursion from its default, in doublings
+tile_size = 32               # the smallest tiles, larger ones are split down to this size where they show detail (see top_tiles())
+large_tile_size = 128        # tiles start out this large (a power of two multiple of tile_size), fewer of them means less thread and cache overhead
+zoom_step = 0.9
+zoom_step_inv = 1 / zoom_step
+minimum_fractalspace_coord = (-2, -2)
+pyramid_extent = 4           # the width (and height) of the one tile at level 0 of the tile pyramid, see pyramid_level()
+perturbation_pixel_size = 1.0e-13    # pixels smaller than this are computed relative to a reference orbit (see perturbation.py)
+minimum_pixel_size = 1.0e-290        # approximate limit, pixel deltas stop fitting in a double somewhere past here
+
+# coordinates are Decimal so that they can be more precise than the smallest pixel
+# this is the default for every thread (contexts are per-thread), so it must be set before threads start
+decimal.DefaultContext.prec = 320
+decimal.setcontext(decimal.Context())
+
+
+
+def zoom_level_to_screen_w(l):
+    """
+    Given a human-friendly zoom level, determine the calculation/simulation/fractalspace coordinate range (as one number) of the screen width.
+    This deals with how much of the fractal is displayable (in the X/col direction).
+    Zoom level 0 is a calculation/simulation/fractalspace X-coordinate width of 2.47.
+    """
+    return 2.47 / zoom_step_inv ** l
+
+
+
+def screen_w_to_zoom_level(w):
+    """
+    Given the calculation/simulation/fractalspace coordinate range (as one number) of the screen width, return a human-friendly zoom level.
+    This deals with how much of the fractal is displayable (in the X/col direction).
+    Zoom level 0 is a calculation/simulation/fractalspace X-coordinate width of 2.47.
+    """
+    ratio = 2.47 / w
+    return int(log(ratio,zoom_step_inv) + 0.5)
+
+
+
+def get_rc_range(zoomlevel, coordmin_x, coordmax_x, coordmin_y, coordmax_y, window_x):
+    """
+    Get the simcoord_per_tile, min_row, max_row, min_col, max_col for the given calculation/simulation/fractalspace box.
+    The row/col values indicate the calculation/simulation/fractalspace tiles which are displayable.
+    """
+
+    # this function defines the tiles which can be seen, which differ by zoom level and by window x dimention
+    # the tiles are defined on a coordinate system that extends from (-2,-2) to approximately (2,2) (note: 'minimum_fractalspace_coord')
+    # the tile coordinates that are valid should not be confused with the tile coordinates which can be seen
+    # for most zoom levels, the valid tiles extend beyond interesting fractal features, but it costs nothing for the coordinates to be valid
+
+    # how much wider the calculation/simulation/fractalspace is than the screen can show (zoomlevel=0 -> wider_than_screen=1)
+    wider_than_screen = zoom_step_inv ** zoomlevel
+
+    tiles_per = wider_than_screen * window_x / tile_size
+    #logger.info("wider_than_screen=%f, tiles_per=%f" % (wider_than_screen, tiles_per))
+    simcoord_per_tile = 2.47 / tiles_per
+    return tile_rc_range(simcoord_per_tile, coordmin_x, coordmax_x, coordmin_y, coordmax_y)
+
+
+
+def tile_rc_range(simcoord_per_tile, coordmin_x, coordmax_x, coordmin_y, coordmax_y):
+    """
+    Get the simcoord_per_tile, min_row, max_row, min_col, max_col of the tiles of the given size which cover the given calculation/simulation/fractalspace box.
+    """
+
+    d = Decimal(simcoord_per_tile)
+    min_row = int(floor((Decimal(coordmin_y) - minimum_fractalspace_coord[1]) / d))
+    max_row = int(floor((Decimal(coordmax_y) - minimum_fractalspace_coord[1]) / d))
+    min_col = int(floor((Decimal(coordmin_x) - minimum_fractalspace_coord[0]) / d))
+    max_col = int(floor((Decimal(coordmax_x) - minimum_fractalspace_coord[0]) / d))
+    #logger.info("simcoord_per_tile=%s, min_row=%d, max_row=%d, min_col=%d, max_col=%d" % (simcoord_per_tile, min_row, max_row, min_col, max_col))
+    return simcoord_per_tile, min_row, max_row, min_col, max_col
+
+
+
+def pyramid_level(zoomlevel, window_x):
+    """
+    Give the level of the tile pyramid whose pixels are closest in size to the screen pixels at the given zoom level.
+
+    The pyramid is a quadtree: level 0 is one tile covering pyramid_extent from minimum_fractalspace_coord, and every level
+    halves the tile size.  Zoom levels step by zoom_step, so several of them in a row share a pyramid level (and its tiles),
+    each showing the tiles scaled by a factor between about 0.71 and 1.41.
+    """
+
+    screen_simcoord_per_pixel = zoom_level_to_screen_w(zoomlevel) / window_x
+    return max(0, int(floor(log2(pyramid_extent / (screen_simcoord_per_pixel * tile_size)) + 0.5)))
+
+
+
+def pyramid_simcoord_per_tile(level):
+    """
+    Give the calculation/simulation/fractalspace size of the tiles at the given level of the tile pyramid (exact, a power of two).
+    """
+    return ldexp(pyramid_extent, -level)
+
+
+
+def top_tiles(level):
+    """
+    Give the pyramid level and size (in pixels across) of the largest tiles that have the pixel size of the given pyramid level.
+
+    Tiles of tile_size pixels at a level cover the same ground as tiles of twice the size one level up, at the same pixel size,
+    so a view first asks for tiles of large_tile_size pixels some levels up.  Where one of them shows detail it is split into
+    the four tiles below it (see tile_children()), and so on down to tile_size, so uniform regions take few work units.
+    """
+
+    steps = min(level, (large_tile_size // tile_size).bit_length() - 1)
+    return level - steps, tile_size << steps
+
+
+
+def tile_children(cache_key):
+    """
+    Give the cache keys of the four tiles (half the size, one pyramid level down) that cover the same ground at the same pixel size and max recursion.
+    """
+
+    level, row, col, simcoord_per_tile, size, max_recursion = cache_key
+    assert size > tile_size, "The smallest tiles are not split."
+    return [(level+1, 2*row+r, 2*col+c, simcoord_per_tile/2, size//2, max_recursion) for r in (0,1) for c in (0,1)]
+
+
+
+def tile_screen_position(row, col, simcoord_per_tile, coordmin_x, coordmin_y, simcoord_per_pixel=None):
+    """
+    Give the screen position (upper left is (0,0)) where the given tile should be drawn.
+    The screen pixels are the tile's own pixels unless simcoord_per_pixel says otherwise (when tiles are drawn scaled).
+    """
+
+    tile_simx = minimum_fractalspace_coord[0] + col * Decimal(simcoord_per_tile)
+    tile_simy = minimum_fractalspace_coord[1] + row * Decimal(simcoord_per_tile)
+    if simcoord_per_pixel is None:
+        simcoord_per_pixel = simcoord_per_tile / tile_size
+    draw_x = float(tile_simx - Decimal(coordmin_x)) / simcoord_per_pixel
+    draw_y = float(tile_simy - Decimal(coordmin_y)) / simcoord_per_pixel
+    return draw_x, draw_y
+
+
+
+def tile_origin(row, col, simcoord_per_tile):
+    """
+    Give the calculation/simulation/fractalspace smallest-corner coordinate of the given tile, as the C components want it.
+    """
+    return minimum_fractalspace_coord[0] + col * simcoord_per_tile, minimum_fractalspace_coord[1] + row * simcoord_per_tile
+
+
+
+def recursion_for_level(level, boost=0):
+    """
+    Give the max recursion for the given level of the tile pyramid, which is part of the cache key of every tile shown there.
+
+    Deeper views need more iterations to tell the points near the set apart, roughly as the square of the zoom depth (in
+    levels), so the default doubles at recursion_levels and then every time the depth grows by a factor of about 1.4.
+    boost moves it by that many doublings, as suggested by recursion_adjustment().  The values are powers of two, so that
+    small changes of opinion do not keep making new tiles.
+    """
+
+    steps = int(floor(2 * log2(1 + level / recursion_levels))) + boost
+    return min(max_recursion_limit, min_recursion << max(0, steps))
+
+
+
+def recursion_adjustment(max_recursion, lowest, highest):
+    """
+    Judge the max recursion of a finished view by the smallest and largest depth of its pixels that escaped (highest is 0
+    if none did): 1 if it should double, -1 if it could halve, 0 if it suits the view.
+
+    When even the quickest pixels to escape take a good part of the max recursion, as around the small copies of the set
+    deep down, the pixels near the boundary are sure to need many more, and the view is mostly black.  When no pixel
+    comes close to it, the black pixels (the expensive ones) are taking more iterations than they need to.  A view where
+    nothing escaped says nothing either way, it is usually inside the set where more iterations only cost more.
+    """
+
+    if highest == 0:
+        return 0
+    if lowest > max_recursion // 4:
+        return 1
+    if highest < max_recursion // 8:
+        return -1
+    return 0
+
+
+
+def needs_perturbation(simcoord_per_tile):
+    """
+    Return True if tiles of this size are too fine to compute with plain doubles.
+    """
+    return simcoord_per_tile / tile_size < perturbation_pixel_size
+
+
+
+if __name__ == '__main__':
+    print("This file is a library.")